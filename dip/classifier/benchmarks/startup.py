@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+'''
+Startup benchmark of control.py subcommands. Every command is run several
+times in a fresh interpreter, wall time to its exit (the first and only
+result of one-shot commands) is measured. One more traced run records time
+of every import which loaded new modules (python 2 has no -X importtime),
+so slow imports of every subcommand can be listed.
+
+usage: python benchmarks/startup.py [--repeat N] [--bayes_model PATH]
+                                    [--svm_model PATH] [--json FILE]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CLASSIFIER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTROL = os.path.join(CLASSIFIER, 'control.py')
+
+# subcommands measured by their help, it parses arguments only
+HELP_COMMANDS = [['--help'], ['svm', 'data', '--help'],
+        ['svm', 'classify', '--help'], ['bayes', 'model', '--help'],
+        ['bayes', 'classify', '--help'], ['serve', '--help'],
+        ['classify-bulk', '--help']]
+
+def _trace(output, args):
+    '''
+    Run control.py with given arguments and store times of imports.
+    @param output: path of JSON output -- list of {module, depth, time,
+                   loaded} records and total import time
+    @param args: arguments of control.py
+    '''
+    import __builtin__
+    import runpy
+    original = __builtin__.__import__
+    records = []
+    depth = [0]
+
+    def timed_import(name, *args, **kwargs):
+        count = len(sys.modules)
+        depth[0] += 1
+        start = time.time()
+        try:
+            return original(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            depth[0] -= 1
+            if len(sys.modules) > count:
+                records.append({'module':name, 'depth':depth[0],
+                    'time':elapsed, 'loaded':len(sys.modules) - count})
+
+    sys.argv = [CONTROL] + args
+    sys.path[0] = CLASSIFIER
+    __builtin__.__import__ = timed_import
+    try:
+        runpy.run_path(CONTROL, run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        __builtin__.__import__ = original
+        f = open(output, 'w')
+        json.dump({'imports':records, 'modules':len(sys.modules),
+            'import_time':sum([r['time'] for r in records
+                if r['depth'] == 0])}, f)
+        f.close()
+
+def measure(args, repeat=5):
+    '''
+    Measure startup of control.py subcommand.
+    @param args: arguments of control.py
+    @param repeat: number of timed runs
+    @return: dictionary {command, wall_min, wall_median, import_time,
+             modules, slowest} -- times in seconds, slowest are the slowest
+             top level imports
+    '''
+    devnull = open(os.devnull, 'w')
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        subprocess.call([sys.executable, CONTROL] + args, stdout=devnull,
+                stderr=devnull)
+        times.append(time.time() - start)
+    handle, output = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    subprocess.call([sys.executable, os.path.abspath(__file__), '--trace',
+        output, '--'] + args, stdout=devnull, stderr=devnull)
+    trace = json.load(open(output))
+    os.remove(output)
+    devnull.close()
+    times.sort()
+    slowest = sorted([r for r in trace['imports'] if r['depth'] == 0],
+            key=lambda r: -r['time'])[:5]
+    return {'command':' '.join(args), 'wall_min':times[0],
+            'wall_median':times[len(times) / 2],
+            'import_time':trace['import_time'], 'modules':trace['modules'],
+            'slowest':[(r['module'], r['time']) for r in slowest]}
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark of control.py subcommands')
+    parser.add_argument('--repeat', type=int, default=5,
+            help='Pocet mereni kazdeho prikazu')
+    parser.add_argument('--bayes_model', type=str, default=None,
+            help='Bayesovsky model pro mereni prikazu bayes classify')
+    parser.add_argument('--svm_model', type=str, default=None,
+            help='SVM model pro mereni prikazu svm classify')
+    parser.add_argument('--json', type=str, default=None,
+            help='Soubor pro vysledky ve formatu JSON')
+    parser.add_argument('--trace', type=str, default=None,
+            help=argparse.SUPPRESS)
+    args, rest = parser.parse_known_args()
+    if args.trace is not None:
+        _trace(args.trace, rest[1:] if rest[:1] == ['--'] else rest)
+        return
+
+    commands = list(HELP_COMMANDS)
+    if args.bayes_model is not None:
+        commands.append(['bayes', 'classify', '-m', args.bayes_model, '-t',
+            'I have a terrible headache'])
+    if args.svm_model is not None:
+        commands.append(['svm', 'classify', '-m', args.svm_model, '-t',
+            'I have a terrible headache'])
+    results = []
+    print '{0:<60} {1:>9} {2:>9} {3:>9} {4:>8}'.format('command', 'min s',
+            'median s', 'import s', 'modules')
+    for command in commands:
+        result = measure(command, args.repeat)
+        results.append(result)
+        print '{0:<60} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>8}'.format(
+                result['command'][:60], result['wall_min'],
+                result['wall_median'], result['import_time'],
+                result['modules'])
+        print '    slowest imports: {0}'.format(', '.join(['{0} {1:.3f}s'
+            .format(module, t) for module, t in result['slowest']]))
+    if args.json is not None:
+        f = open(args.json, 'w')
+        json.dump(results, f, indent=2)
+        f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+'''
+Benchmark suite of hot paths of the classifiers. Every benchmark prepares its
+input (not measured), then its hot path is run several times and the best time
+is kept. Each benchmark runs in its own process, so peak RSS reported by the
+process belongs to the benchmark only.
+
+Results are JSON {"meta": {...}, "results": {name: {docs, seconds,
+docs_per_s, peak_rss_kb}}} and may be compared with a saved baseline.
+'''
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import Queue
+import resource
+import sys
+import time
+
+import numpy as np
+
+# all features in the first variant
+FEATURES = {'emoticon':1, 'sentence':1, 'url':1, 'tag':1, 'time':1, 'date':1,
+        'user_tag':1, 'email':1}
+
+def _tokenize(rows, options):
+    from src.common.entry import Entry
+    entries = [Entry(id=None, guid=None, entry=row[1], language=row[0],
+        max_token_size=options['max_token_size']) for row in rows]
+
+    def run():
+        for entry in entries:
+            for token in entry.get_token_all():
+                pass
+    return len(rows), run
+
+def _data_matrix(rows, options):
+    from src.svm.src.data import Data
+    data = Data(dbfile=options['db_file'],
+            max_token_size=options['max_token_size'], workers=1)
+    return len(rows), lambda: data._generate_X1_X2(rows)
+
+def _svm_dataset(rows, options):
+    '''
+    @return: tuple (SVM object, X, Y) of the first svm_count relevant and
+             irelevant rows
+    '''
+    from src.svm.src.data import Data, split_X1_X2
+    from src.svm.src.kernels import str2kernel
+    from src.svm.svm_classifier import SVM
+    count = options['svm_count']
+    rows = [row for row in rows if row[2] == 1][:count] + \
+            [row for row in rows if row[2] != 1][:count]
+    data = Data(dbfile=options['db_file'],
+            max_token_size=options['max_token_size'], workers=1)
+    X1, X2 = data._generate_X1_X2(rows)
+    X, Y = split_X1_X2(X1, X2, 1)
+    svm = SVM(str2kernel[options['kernel']](param=options['param']),
+            C=options['C'], silent=True)
+    return svm, X, Y
+
+def _gram(rows, options):
+    svm, X, Y = _svm_dataset(rows, options)
+    return len(X), lambda: svm.gram_matrix(X)
+
+def _svm_train(rows, options):
+    svm, X, Y = _svm_dataset(rows, options)
+    return len(X), lambda: svm.train(X, Y)
+
+def _svm_predict(rows, options):
+    svm, X, Y = _svm_dataset(rows, options)
+    svm.train(X, Y)
+    return len(X), lambda: svm.predict(X)
+
+def _annealing_step(rows, options):
+    from src.svm.src.annealing import _thread_get_energy
+    svm, X, Y = _svm_dataset(rows, options)
+    X1, X2 = X[Y == 1], X[Y != 1]
+    dataset = (X1, X2, np.ones(len(X1)), np.ones(len(X2)))
+    n_fold_cv = options['n_fold_cv']
+
+    def run():
+        # energy of one state -- svm is trained on every fold
+        for i in xrange(n_fold_cv):
+            _thread_get_energy(svm, dataset, (svm.kernel.param, svm.C), i,
+                    n_fold_cv, n_fold_cv)
+    return len(X) * n_fold_cv, run
+
+def _bayes_train(rows, options):
+    from src.bayes.bayesian_classifier import BayesianClassifier
+    from src.common.entry import Entry
+    entries = [Entry(id=None, guid=None, entry=row[1], language=row[0],
+        max_token_size=options['max_token_size']) for row in rows]
+
+    def run():
+        bcl = BayesianClassifier(max_token_size=options['max_token_size'])
+        for entry, row in zip(entries, rows):
+            bcl.train(entry, row[2] == 1, FEATURES)
+    return len(rows), run
+
+def _bayes_train_many(rows, options):
+    from src.bayes.bayesian_classifier import BayesianClassifier
+
+    def run():
+        bcl = BayesianClassifier(max_token_size=options['max_token_size'])
+        bcl.train_many([row[:2] for row in rows], [row[2] == 1
+            for row in rows], FEATURES, workers=1)
+    return len(rows), run
+
+def _bayes_model(rows, options):
+    '''
+    @return: tuple (BayesianClassifier object, rows of its most common
+             language)
+    '''
+    from src.bayes.bayesian_classifier import BayesianClassifier
+    bcl = BayesianClassifier(max_token_size=options['max_token_size'])
+    bcl.train_many([row[:2] for row in rows], [row[2] == 1 for row in rows],
+            FEATURES, workers=1)
+    languages = [row[0] for row in rows]
+    language = max(set(languages), key=languages.count)
+    return bcl, [row for row in rows if row[0] == language]
+
+def _bayes_classify(rows, options):
+    bcl, rows = _bayes_model(rows, options)
+
+    def run():
+        for row in rows:
+            bcl.classify(row[1], row[0], FEATURES)
+    return len(rows), run
+
+def _bayes_classify_many(rows, options):
+    bcl, rows = _bayes_model(rows, options)
+    texts = [row[1] for row in rows]
+    return len(rows), lambda: bcl.classify_many(texts, rows[0][0], FEATURES)
+
+# (name, setup function returning number of documents and hot path)
+BENCHMARKS = [('tokenize', _tokenize), ('data_matrix', _data_matrix),
+        ('gram', _gram), ('svm_train', _svm_train),
+        ('svm_predict', _svm_predict), ('annealing_step', _annealing_step),
+        ('bayes_train', _bayes_train), ('bayes_train_many', _bayes_train_many),
+        ('bayes_classify', _bayes_classify),
+        ('bayes_classify_many', _bayes_classify_many)]
+
+def _run_child(queue, setup, rows, options):
+    '''
+    Run one benchmark, output of the measured code is suppressed.
+    '''
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        np.random.seed(options['seed'])
+        docs, run = setup(rows, options)
+        times = []
+        for i in xrange(options['repeat']):
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+        queue.put({'docs':docs, 'seconds':min(times),
+            'docs_per_s':docs / (min(times) + 0.0000000000001),
+            'peak_rss_kb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    except Exception, ex:
+        queue.put({'error':'{0}: {1}'.format(type(ex).__name__, ex)})
+
+def run_benchmark(name, rows, options):
+    '''
+    Run benchmark in a new process.
+    @param name: name of benchmark from BENCHMARKS
+    @param rows: list of (lang, text, label) tuples
+    @param options: dictionary of options of run_suite()
+    @return: dictionary {docs, seconds, docs_per_s, peak_rss_kb} or {error}
+    '''
+    setup = dict(BENCHMARKS)[name]
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_child,
+            args=(queue, setup, rows, options))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            # killed benchmark (e.g. out of memory) never reports
+            if not process.is_alive():
+                try:
+                    result = queue.get(timeout=1)
+                except Queue.Empty:
+                    result = {'error':'Benchmark process exited with code {0}'
+                            .format(process.exitcode)}
+                break
+    process.join()
+    return result
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    Compare throughput of results with baseline.
+    @param results: results of run_suite()
+    @param baseline: results of earlier run_suite()
+    @param tolerance: allowed relative slowdown
+    @return: dictionary {name: {baseline_docs_per_s, ratio, regression}} of
+             benchmarks present in both results, ratio > 1 is speedup,
+             benchmark failing now but not in baseline is a regression with
+             ratio 0
+    '''
+    comparison = {}
+    for name, result in results['results'].iteritems():
+        old = baseline['results'].get(name)
+        if old is None or 'docs_per_s' not in old:
+            continue
+        if 'error' in result:
+            comparison[name] = {'baseline_docs_per_s':old['docs_per_s'],
+                    'ratio':0.0, 'regression':True}
+            continue
+        ratio = result['docs_per_s'] / (old['docs_per_s'] + 0.0000000000001)
+        comparison[name] = {'baseline_docs_per_s':old['docs_per_s'],
+                'ratio':ratio, 'regression':ratio < 1 - tolerance}
+    return comparison
+
+def run_suite(rows, db_file=None, names=None, repeat=3, max_token_size=1,
+        svm_count=100, kernel='linear', param=1.0, C=1.0, n_fold_cv=2, seed=1):
+    '''
+    Run benchmarks.
+    @param rows: list of (lang, text, label) tuples, label is 1 for relevant
+                 entries
+    @param db_file: source of rows, recorded in results only
+    @param names: names of benchmarks to run, all if None
+    @param repeat: number of runs of every hot path, the best one is kept
+    @param max_token_size: maximal size of n-tuples
+    @param svm_count: count of relevant and irelevant rows used by SVM
+                      benchmarks (gram matrix grows quadratically)
+    @param kernel: name of SVM kernel
+    @param param: parameter of kernel
+    @param C: C parameter of SVM
+    @param n_fold_cv: number of folds of annealing step
+    @param seed: seed of numpy random generator
+    @return: dictionary {meta, results}
+    '''
+    logger = logging.getLogger()
+    options = {'db_file':db_file, 'repeat':repeat,
+            'max_token_size':max_token_size, 'svm_count':svm_count,
+            'kernel':kernel, 'param':param, 'C':C, 'n_fold_cv':n_fold_cv, 'seed':seed}
+    meta = dict(options)
+    meta.update({'rows':len(rows), 'python':platform.python_version(),
+        'numpy':np.__version__, 'platform':platform.platform(),
+        'cpus':multiprocessing.cpu_count(),
+        'time':time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        logger.info('Benchmark {0}...'.format(name))
+        results[name] = run_benchmark(name, rows, options)
+        if 'error' in results[name]:
+            logger.error('Benchmark {0} failed: {1}'.format(name,
+                results[name]['error']))
+    return {'meta':meta, 'results':results}
+
+def print_results(results, comparison=None, f=sys.stdout):
+    '''
+    Print table of results.
+    '''
+    f.write('{0:<20} {1:>8} {2:>10} {3:>12} {4:>10} {5:>9}\n'.format(
+        'benchmark', 'docs', 'seconds', 'docs/s', 'RSS MB', 'baseline'))
+    for name, setup in BENCHMARKS:
+        result = results['results'].get(name)
+        if result is None:
+            continue
+        if 'error' in result:
+            f.write('{0:<20} {1}{2}\n'.format(name, result['error'],
+                ' !' if comparison and name in comparison else ''))
+            continue
+        ratio = ''
+        if comparison and name in comparison:
+            ratio = '{0:.2f}x{1}'.format(comparison[name]['ratio'],
+                    ' !' if comparison[name]['regression'] else '')
+        f.write('{0:<20} {1:>8} {2:>10.4f} {3:>12.1f} {4:>10.1f} {5:>9}\n'
+                .format(name, result['docs'], result['seconds'],
+                    result['docs_per_s'], result['peak_rss_kb'] / 1024.0,
+                    ratio))
+
+def load_results(path):
+    f = open(path)
+    results = json.load(f)
+    f.close()
+    return results
+
+def store_results(path, results):
+    f = open(path, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
@@ -2,35 +2,39 @@
 # This is controll script for entire diploma thesis.
 
 import argparse
-import numpy as np
-import pp
+import logging
+import multiprocessing
+import sys
 
-from src.svm.svm_test import *
-from src.svm.svm_classifier import *
-from src.svm.src.data import *
-from src.svm.src.kernels import *
-
-from src.bayes.bayesian_test import BayesianTest
-from src.bayes.bayesian_classifier import BayesianClassifier
-
-from src.common.entry import Entry
+# only light modules are imported here, every subcommand imports modules it
+# uses (numpy, nltk, cvxopt and pp take long to import)
+from src.common.backend import create_backend, serve_worker, DEFAULT_PORT
+from src.common import metrics
 
 # SVM
 def svm_data(args):
     '''
     Functinon runs data regeneration according to input arguments
     '''
+    from src.svm.svm_test import SVMTest
     t = SVMTest()
     t.regenerate_data(dbfile=args.db_file, count=args.count,
-            max_token_size=args.max_token_size)
+            max_token_size=args.max_token_size, workers=args.workers,
+            stream=args.stream, vocabulary=_vocabulary(args),
+            dedup=_dedup(args))
 
 def svm_annealing(args):
     '''
     Function starts simulated annealing to find out ideal parameters for SVM
     classifier with given data.
     '''
+    from src.svm.svm_test import SVMTest
     t = SVMTest()
-    t.run_annealing(n_fold_cv=args.n_fold_cv, kernel=args.kernel)
+    backend = create_backend(args.backend, servers=args.servers,
+            processes=args.processes)
+    t.run_annealing(n_fold_cv=args.n_fold_cv, kernel=args.kernel,
+            chains=args.chains, backend=backend)
+    backend.destroy()
 
 def svm_test(args):
     '''
@@ -38,6 +42,7 @@ def svm_test(args):
     parameters. Only possible with previously created dataset - use svm_data()
     before using this!
     '''
+    from src.svm.svm_test import SVMTest
     t = SVMTest()
     t.run(c=args.c, param=args.param, n_fold_cv=args.n_fold_cv,
             kernel=args.kernel)
@@ -46,8 +51,13 @@ def svm_create_model(args):
     '''
     Create SVM classifier model for separate classification
     '''
+    from src.svm.svm_classifier import SVM
+    from src.svm.src.data import Data
+    from src.svm.src.kernels import str2kernel
     # load data
-    data = Data(dbfile=args.db_file, max_token_size=args.max_token_size)
+    data = Data(dbfile=args.db_file, max_token_size=args.max_token_size,
+            workers=args.workers, vocabulary=_vocabulary(args),
+            dedup=_dedup(args))
     data.regenerate_X1_X2(99999)
     X, Y = data.get()
 
@@ -56,7 +66,7 @@ def svm_create_model(args):
 
     # crete classifier
     svm = SVM(kernel=k, C=args.c)
-    svm.train(X, Y)
+    svm.train(X, Y, data.get_weights())
     # store model
     svm.store_model(args.model, data.get_token_list())
 
@@ -64,6 +74,9 @@ def svm_classify(args):
     '''
     Manually classify given text with some SVM model
     '''
+    import numpy as np
+    from src.svm.svm_classifier import SVM
+    from src.common.entry import Entry
     # load model and create classifier
     svm = SVM(kernel=None, C=None)
     token_list = svm.load_model(args.model)
@@ -85,7 +98,10 @@ def bayes_test(args):
     Function starts test of bayesian classifier with given dataset and classifier
     parameters.
     '''
-    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size)
+    from src.bayes.bayesian_test import BayesianTest
+    from src.common.entry import Entry
+    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size,
+            workers=args.workers)
 
     if args.feats is not None:
         features = eval(args.feats)
@@ -95,7 +111,7 @@ def bayes_test(args):
                 print 'Incorrect format of feature dictionary'
                 return
     else:
-        features = bt.get_best_features(count=args.count, n_fold_cv=args.n_fold_cv)
+        features = _best_features(bt, args)
 
     bt.run(features=features, count=args.count, n_fold_cv=args.n_fold_cv)
 
@@ -104,16 +120,39 @@ def bayes_features(args):
     Function starts strats process of finding most suitable feature combination
     for selected dataset
     '''
+    from src.bayes.bayesian_test import BayesianTest
     # process features
     # run
-    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size)
-    bt.get_best_features(count=args.count, n_fold_cv=args.n_fold_cv)
+    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size,
+            workers=args.workers)
+    _best_features(bt, args)
+
+def _best_features(bt, args):
+    '''
+    Find best features, feature configurations are evaluated in parallel by
+    selected backend.
+    @param bt: BayesianTest object
+    @return: dictionary of best features
+    '''
+    backend = create_backend(args.backend, servers=args.servers,
+            processes=args.processes)
+    features = bt.get_best_features(count=args.count, n_fold_cv=args.n_fold_cv,
+            backend=backend)
+    backend.destroy()
+    return features
 
 def bayes_generate_model(args):
     '''
     Function creates model for bayesian classifier
     '''
-    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size)
+    from src.bayes.bayesian_test import BayesianTest
+    from src.common.entry import Entry
+    sketch = None
+    if args.sketch:
+        sketch = int(args.sketch * 2 ** 20)
+    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size,
+            workers=args.workers, vocabulary=_vocabulary(args), sketch=sketch,
+            dedup=_dedup(args))
 
     if args.feats is not None:
         features = eval(args.feats)
@@ -123,18 +162,97 @@ def bayes_generate_model(args):
                 print 'Incorrect format of feature dictionary'
                 return
     else:
-        features = bt.get_best_features(count=args.count, n_fold_cv=args.n_fold_cv)
+        features = _best_features(bt, args)
 
-    bt.create_model(args.model, used_features=features, count=args.count)
+    backend = None
+    if args.shards:
+        backend = create_backend(args.backend, servers=args.servers,
+                processes=args.processes)
+    bt.create_model(args.model, used_features=features, count=args.count,
+            model_format=args.format, stream=args.stream, shards=args.shards,
+            backend=backend)
+    if backend is not None:
+        backend.destroy()
 
 
+def bayes_sketch_bench(args):
+    '''
+    Compare accuracy and memory of sketch dictionaries with exact dictionary
+    '''
+    from src.bayes.bayesian_test import BayesianTest
+    from src.common.entry import Entry
+    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size,
+            workers=args.workers)
+    features = eval(args.feats)
+    e = Entry(id=None, guid=None, entry=None, language=None)
+    if not e.check_feats(features):
+        print 'Incorrect format of feature dictionary'
+        return
+    results = bt.benchmark_sketch(features,
+            [int(budget * 2 ** 20) for budget in args.budgets], args.count)
+    print '{0:>10} {1:>12} {2:>9} {3:>10} {4:>8} {5:>8}'.format('budget MB',
+            'bytes', 'accuracy', 'difference', 'train s', 'class. s')
+    for r in results:
+        print '{0:>10} {1:>12} {2:>9.4f} {3:>10.4f} {4:>8.2f} {5:>8.2f}'.format(
+                'exact' if r['budget'] is None else
+                    '{0:.2f}'.format(r['budget'] / 2.0 ** 20),
+                r['bytes'], r['accuracy'], r['difference'], r['train_time'],
+                r['classify_time'])
+
+def bayes_merge(args):
+    '''
+    Merge bayesian models trained on different data into one model
+    '''
+    from src.bayes.src.worddictionary import WordDictionary
+    from src.bayes.src.sharding import merge_tree
+    dictionaries = []
+    for path in args.models:
+        word_dict = WordDictionary()
+        word_dict.load(path)
+        dictionaries.append(word_dict.dump_data())
+    word_dict = WordDictionary()
+    word_dict.load_data(merge_tree(dictionaries))
+    word_dict.store(args.output)
+    word_dict.log_memory_usage()
+
+def bayes_update(args):
+    '''
+    Train newly annotated entries into existing bayesian model
+    '''
+    from src.bayes.bayesian_test import BayesianTest
+    from src.common.entry import Entry
+    bt = BayesianTest(dbfile=args.db_file, max_token_size=args.max_token_size,
+            workers=args.workers, vocabulary=_vocabulary(args))
+    features = None
+    if args.feats is not None:
+        features = eval(args.feats)
+        if isinstance(features,dict):
+            e = Entry(id=None, guid=None, entry=None, language=None)
+            if not e.check_feats(features):
+                print 'Incorrect format of feature dictionary'
+                return
+    bt.update_model(args.model, used_features=features,
+            compact_every=args.compact_every, compact=args.compact,
+            mark_consumed=args.mark_consumed)
+
 def bayes_classify(args):
     '''
     Manually classify given text with some bayesian model
     '''
+    from src.bayes.bayesian_classifier import BayesianClassifier
+    bcl = BayesianClassifier()
+    bcl.load_word_dict(args.model)
+    print bcl.classify(text=args.text, language='en', features=bcl.word_dict.features)
+
+def bayes_export(args):
+    '''
+    Export bayesian model with quantized log-odds for classification only
+    '''
+    from src.bayes.bayesian_classifier import BayesianClassifier
     bcl = BayesianClassifier()
     bcl.load_word_dict(args.model)
-    print bcl.classify(text=args.text, language='en', features=bcl.word_dict.words['features'])
+    bcl.export_word_dict(args.output, dtype=args.dtype,
+            model_format=args.format)
 
 
 # COMMON
@@ -176,9 +294,9 @@ def _print_results(t,tp, fp, tn, fn, u=None, c=None):
 def _thread_svm(db_file, count, max_token_size, n_fold_cv, kernel):
     from src.svm.svm_test import SVMTest
     t = SVMTest()
-    # load data
+    # load data, job itself runs in parallel with other ones
     t.regenerate_data(dbfile=db_file, count=count,
-            max_token_size=max_token_size)
+            max_token_size=max_token_size, workers=1)
     # run simulated annealing
     state, energy = t.run_annealing(n_fold_cv=n_fold_cv, kernel=kernel)
     # run test with optimal parameters
@@ -189,7 +307,9 @@ def _thread_svm(db_file, count, max_token_size, n_fold_cv, kernel):
 
 def _thread_bayes(db_file, count, n_fold_cv, max_token_size):
     from src.bayes.bayesian_test import BayesianTest
-    bt = BayesianTest(dbfile=db_file, max_token_size=max_token_size)
+    # job itself runs in parallel with other ones
+    bt = BayesianTest(dbfile=db_file, max_token_size=max_token_size,
+            workers=1)
     # run feature selection
     features = bt.get_best_features(count=count, n_fold_cv=n_fold_cv)
     # run test with best features
@@ -202,15 +322,16 @@ def common_run(args):
     Run comparison of SVM and bayesian classifiers
     '''
     # setup job server
-    job_server = pp.Server()
-    job_server.set_ncpus()
+    backend = create_backend(args.backend, servers=args.servers,
+            processes=args.processes)
     # create jobs
     jobs = []
-    jobs.append(job_server.submit(_thread_svm, (args.db_file, args.count,
+    jobs.append(backend.submit(_thread_svm, (args.db_file, args.count,
         args.max_token_size, args.n_fold_cv, args.kernel)))
-    jobs.append(job_server.submit(_thread_bayes, (args.db_file, args.count,
+    jobs.append(backend.submit(_thread_bayes, (args.db_file, args.count,
         args.n_fold_cv, args.max_token_size)))
     result = [job() for job in jobs]
+    backend.destroy()
     # print result
     print result
     for r in result:
@@ -225,11 +346,304 @@ def common_run(args):
                 fp=r['result']['false_positive'], tn=r['result']['true_negative'],
                 fn=r['result']['false_negative'])
 
+# DISTRIBUTED
+def worker(args):
+    '''
+    Run TCP worker evaluating jobs for remote coordinators
+    '''
+    processes = []
+    for i in xrange(1, args.processes):
+        process = multiprocessing.Process(target=serve_worker,
+                args=(args.host, args.port + i))
+        process.start()
+        processes.append(process)
+    serve_worker(args.host, args.port)
+
+# SERVING
+def serve(args):
+    '''
+    Serve classification requests by models loaded once
+    '''
+    if args.http is None and args.socket is None:
+        print 'Specify --http port or --socket path'
+        return
+    from src.common.models import load_model
+    from src.common.server import ClassificationServer
+    models = dict([load_model(spec, args.svm_max_token_size, args.cache,
+        args.cache_mode, args.cascade_low, args.cascade_high)
+        for spec in args.models])
+    server = ClassificationServer(models, max_batch=args.max_batch,
+            max_delay=args.latency_ms / 1000.0)
+    server.serve(http_port=args.http, socket_path=args.socket)
+
+def bulk_classify(args):
+    '''
+    Classify stream of texts from database, JSONL file or stdin
+    '''
+    from src.common.bulk import (classify_bulk, read_docs, read_jsonl,
+            DocsWriter, JSONLWriter)
+    name = 'label' if args.labels else 'probability'
+    if args.jsonl is not None and args.where is not None:
+        sys.exit('Condition --where can be used only with --db_file')
+    if args.db_file is not None:
+        chunks = read_docs(args.db_file, args.where, args.chunk_size)
+        writer = DocsWriter(args.db_file, args.commit_size)
+    else:
+        f = sys.stdin if args.jsonl == '-' else open(args.jsonl)
+        chunks = read_jsonl(f, args.chunk_size)
+        output = sys.stdout if args.output is None else open(args.output, 'w')
+        writer = JSONLWriter(output, name)
+    classify_bulk(args.model, chunks, writer, workers=args.workers,
+            svm_max_token_size=args.svm_max_token_size, labels=args.labels,
+            cache_size=args.cache, cache_mode=args.cache_mode,
+            cascade_low=args.cascade_low, cascade_high=args.cascade_high)
+
+def cascade(args):
+    '''
+    Compare accuracy and throughput of cascade of bayesian and SVM model with
+    both models alone
+    '''
+    from src.common.models import load_model
+    from src.common.cascade import compare_cascade
+    from src.common.pipeline import read_annotated
+    rows = list(read_annotated(args.db_file, args.count))
+    model = load_model('cascade:{0},{1}'.format(args.bayes, args.svm),
+            args.svm_max_token_size, cascade_low=args.cascade_low,
+            cascade_high=args.cascade_high)[1]
+    results = compare_cascade(model, [row[1] for row in rows],
+            [row[0] for row in rows], [row[2] == 1 for row in rows])
+    print '{0:>10} {1:>10} {2:>12} {3:>10}'.format('model', 'accuracy',
+            'docs/s', 'escalated')
+    for result in results:
+        print '{0:>10} {1:>10.4f} {2:>12.1f} {3:>10}'.format(result['model'],
+                result['accuracy'], result['docs_per_s'],
+                '{0:.1%}'.format(result['escalated_fraction'])
+                if 'escalated_fraction' in result else '-')
+    svm_time = results[1]['time']
+    print 'Cascade speedup against SVM: {0:.2f}x'.format(svm_time /
+            (results[2]['time'] + 0.0000000000001))
+
+# BENCHMARKS
+def bench(args):
+    '''
+    Benchmark hot paths of classifiers on annotated or synthetic database
+    '''
+    from benchmarks.suite import (run_suite, compare, print_results,
+            load_results, store_results)
+    from src.common.pipeline import read_annotated
+    import os
+    import tempfile
+    db_file = args.db_file
+    if args.synthetic is not None:
+        # synthetic database exists only during the benchmark
+        handle, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        _synthetic(args).write(db_file, args.synthetic)
+    try:
+        rows = list(read_annotated(db_file, args.count))
+        results = run_suite(rows, db_file=db_file, names=args.only,
+                repeat=args.repeat, max_token_size=args.max_token_size,
+                svm_count=args.svm_count, kernel=args.kernel,
+                param=args.param, C=args.c, n_fold_cv=args.n_fold_cv,
+                seed=args.seed)
+    finally:
+        if args.synthetic is not None:
+            os.remove(db_file)
+    if args.synthetic is not None:
+        results['meta']['db_file'] = None
+        results['meta']['synthetic'] = dict([(name, getattr(args, name))
+            for name in ('synthetic', 'vocabulary', 'topic_words',
+                'correlation', 'relevant', 'density', 'min_words',
+                'max_words')])
+    comparison = None
+    if args.baseline is not None:
+        comparison = compare(results, load_results(args.baseline),
+                args.tolerance)
+        results['comparison'] = comparison
+    print_results(results, comparison)
+    if args.output is not None:
+        store_results(args.output, results)
+    if args.save_baseline is not None:
+        store_results(args.save_baseline, results)
+    failed = sorted([name for name, result in results['results'].iteritems()
+        if 'error' in result])
+    if failed:
+        print 'Failed benchmarks: {0}'.format(', '.join(failed))
+    regression = comparison and any([c['regression']
+        for c in comparison.values()])
+    if regression:
+        print 'Regression against baseline {0}!'.format(args.baseline)
+    if failed or regression:
+        sys.exit(1)
+
+def synthetic(args):
+    '''
+    Generate synthetic annotated database for scaling tests
+    '''
+    try:
+        _synthetic(args).write(args.db_file, args.rows, append=args.append)
+    except ValueError, ex:
+        sys.exit('{0}, use --append to add texts to it'.format(ex))
+
+def _add_cache_args(parser):
+    '''
+    Add arguments of classification cache to given parser
+    @param parser: argparse parser
+    '''
+    parser.add_argument('--cache', type=int, default=0,
+            help='Velikost cache vysledku klasifikace (pocet textu), 0 vypne cache')
+    parser.add_argument('--cache_mode', type=str, default='strict',
+            choices=['strict', 'loose'],
+            help='Normalizace textu pro cache: strict (jen bile znaky), loose (i velikost pismen, RT a @zminky)')
+
+def _add_cascade_args(parser):
+    '''
+    Add arguments of cascade models to given parser
+    @param parser: argparse parser
+    '''
+    parser.add_argument('--cascade_low', type=float, default=0.2,
+            help='Bayesovska pravdepodobnost, do ktere je text kaskadou oznacen jako irelevantni')
+    parser.add_argument('--cascade_high', type=float, default=0.8,
+            help='Bayesovska pravdepodobnost, od ktere je text kaskadou oznacen jako relevantni, texty mezi prahy klasifikuje SVM')
+
+def _add_backend_args(parser):
+    '''
+    Add arguments selecting execution backend to given parser
+    @param parser: argparse parser
+    '''
+    parser.add_argument('--backend', type=str, default='pp',
+            choices=['pp', 'tcp', 'local'],
+            help='Zpusob paralelniho vypoctu: pp (parallel python), tcp (vzdaleni workeri), local (workeri na localhostu)')
+    parser.add_argument('--servers', type=str, default=None,
+            help='Seznam adres host:port oddelenych carkou (ppservery nebo tcp workeri)')
+    parser.add_argument('--processes', type=int, default=None,
+            help='Pocet lokalnich workeru pro backend local')
+
+def _add_workers_arg(parser):
+    '''
+    Add argument selecting number of tokenization processes to given parser
+    @param parser: argparse parser
+    '''
+    parser.add_argument('--workers', type=int, default=None,
+            help='Pocet procesu pro tokenizaci textu, implicitne pocet CPU')
+
+def _add_vocabulary_args(parser, decay=True):
+    '''
+    Add arguments of vocabulary policy to given parser
+    @param parser: argparse parser
+    @param decay: add also argument of time decay of counts
+    '''
+    parser.add_argument('--min_df', type=int, default=1,
+            help='Minimalni pocet dokumentu, ve kterych se token musi vyskytnout')
+    parser.add_argument('--max_vocabulary', type=int, default=None,
+            help='Maximalni velikost slovniku, tokeny s nejnizsim poctem vyskytu jsou vyrazeny')
+    if decay:
+        parser.add_argument('--decay', type=float, default=None,
+                help='Koeficient exponencialniho utlumu poctu vyskytu pred kazdou davkou uceni (napr. 0.99)')
+
+def _vocabulary(args):
+    '''
+    Create vocabulary policy from parsed arguments
+    @return: VocabularyPolicy object or None if vocabulary is not bounded
+    '''
+    from src.common.vocabulary import VocabularyPolicy
+    decay = getattr(args, 'decay', None)
+    if args.min_df <= 1 and args.max_vocabulary is None and decay is None:
+        return None
+    return VocabularyPolicy(min_df=args.min_df, max_size=args.max_vocabulary,
+            decay=decay)
+
+def _add_synthetic_args(parser):
+    '''
+    Add arguments of synthetic corpus to given parser
+    @param parser: argparse parser
+    '''
+    parser.add_argument('--vocabulary', type=int, default=10000,
+            help='Pocet spolecnych slov synteticke databaze')
+    parser.add_argument('--topic_words', type=int, default=200,
+            help='Pocet tematickych slov kazde tridy')
+    parser.add_argument('--correlation', type=float, default=0.2,
+            help='Sila korelace textu s tridou (0 az 1), pravdepodobnost tematickeho slova')
+    parser.add_argument('--relevant', type=float, default=0.25,
+            help='Podil relevantnich textu')
+    parser.add_argument('--density', type=str, nargs='+', default=[],
+            help='Podil textu s priznakem ve tvaru priznak=podil (url, email, emoticon, tag, user_tag, time, date)')
+    parser.add_argument('--min_words', type=int, default=5,
+            help='Minimalni pocet slov textu')
+    parser.add_argument('--max_words', type=int, default=26,
+            help='Maximalni pocet slov textu')
+
+def _synthetic(args):
+    '''
+    Create synthetic corpus generator from parsed arguments
+    @return: SyntheticCorpus object
+    '''
+    from src.common.synthetic import SyntheticCorpus
+    densities = {}
+    for density in args.density:
+        try:
+            feature, value = density.split('=')
+            densities[feature] = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Incorrect density "{0}", use feature=fraction'
+                    .format(density))
+    try:
+        return SyntheticCorpus(vocabulary=args.vocabulary,
+                topic_words=args.topic_words, correlation=args.correlation,
+                relevant=args.relevant, densities=densities,
+                min_words=args.min_words, max_words=args.max_words,
+                seed=args.seed)
+    except ValueError, ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+def _add_dedup_args(parser):
+    '''
+    Add arguments of near-duplicate collapsing to given parser
+    @param parser: argparse parser
+    '''
+    parser.add_argument('--dedup', type=float, default=None,
+            help='Sloucit temer duplicitni texty s odhadem Jaccardovy podobnosti alespon DEDUP (napr. 0.8)')
+    parser.add_argument('--dedup_perm', type=int, default=64,
+            help='Pocet hashovacich funkci MinHash signatury')
+    parser.add_argument('--dedup_bands', type=int, default=8,
+            help='Pocet LSH pasem signatury')
+    parser.add_argument('--dedup_report', type=str, default=None,
+            help='Soubor se seznamem sloucenych textu (JSON radky)')
+
+def _dedup(args):
+    '''
+    Create near-duplicate filter from parsed arguments
+    @return: NearDuplicateFilter object or None if texts are not collapsed
+    '''
+    if args.dedup is None:
+        return None
+    from src.common.dedup import NearDuplicateFilter
+    return NearDuplicateFilter(threshold=args.dedup, num_perm=args.dedup_perm,
+            bands=args.dedup_bands, report=args.dedup_report)
+
 def parse_args():
     '''
     Function for parsing commandline arguments
     '''
     parser = argparse.ArgumentParser(description='''Tento program ma za cil porovnat dva casto pouzivane klasifikatory -- SVM a Bayesovsky klasifikator. V obou implementovanych klasifikatorech je kladen duraz na vyber optimalnich priznaku ziskavanych z textu. Jsou ziskavany dva typy priznaku  -- textove priznaky a specialni priznaky.  Program vznikl jako implementacni cast diplomove prace ve ktere taky zkoumame vliv techto priznaku na klasifikacni schopnosti klasifikatoru.''')
+    parser.add_argument('--token_cache', type=str, default=None,
+            help='Soubor perzistentni cache tokenizovanych textu (sqlite)')
+    parser.add_argument('--metrics', action='store_true', default=False,
+            help='Merit dobu trvani jednotlivych fazi a vypsat souhrn na stderr')
+    parser.add_argument('--metrics_file', type=str, default=None,
+            help='Soubor pro namerene metriky (zapina --metrics), - pro stdout')
+    parser.add_argument('--metrics_format', type=str, default='json',
+            choices=['json', 'prometheus'],
+            help='Format souboru s metrikami')
+    parser.add_argument('--profile', type=str, default=None,
+            choices=['cprofile', 'sampling'],
+            help='Profilovat prikaz vcetne uloh workeru deterministickym (cprofile) nebo vzorkovacim profilerem')
+    parser.add_argument('--profile_output', type=str, default='profile',
+            help='Prefix vystupnich souboru profilu (.pstats, .collapsed pro flame graph, .txt)')
+    parser.add_argument('--profile_top', type=int, default=30,
+            help='Pocet funkci v reportu profilu')
+    parser.add_argument('--profile_interval', type=float, default=0.005,
+            help='Interval vzorkovani v sekundach procesoroveho casu')
     subparsers = parser.add_subparsers()
 
     # SVM
@@ -247,6 +661,11 @@ def parse_args():
             help='Pocet pouzitych zaznamu z databazoveho souboru')
     parser_svm_data.add_argument('--max_token_size','-t', default=1, type=int,
             help='Maximalni delka n-tic textovych priznaku')
+    parser_svm_data.add_argument('--stream', action='store_true', default=False,
+            help='Zpracovani proudem -- cteni, tokenizace a uceni bezi soubezne s omezenou pameti')
+    _add_workers_arg(parser_svm_data)
+    _add_vocabulary_args(parser_svm_data, decay=False)
+    _add_dedup_args(parser_svm_data)
     parser_svm_data.set_defaults(func=svm_data)
 
     # SVM - anneailng process
@@ -256,6 +675,9 @@ def parse_args():
             help='Pocet iteraci n-nasobne krizove validace')
     parser_svm_annealing.add_argument('--kernel', '-k', type=str, default='RBF',
             choices=['RBF', 'linear', 'polynomial'], help='Vyber jaderne funkce')
+    parser_svm_annealing.add_argument('--chains', type=int, default=1,
+            help='Pocet soubezne bezicich retezcu s ruznymi teplotami (parallel tempering)')
+    _add_backend_args(parser_svm_annealing)
     parser_svm_annealing.set_defaults(func=svm_annealing)
 
     # SVM - train svm model from annotated db file and store it to file
@@ -273,6 +695,9 @@ def parse_args():
             help='Parametr C SVM klasifikatoru')
     parser_svm_model.add_argument('--kernel', '-k', type=str, default='RBF',
             choices=['RBF', 'linear', 'polynomial'], help='Vyber jaderne funkce')
+    _add_workers_arg(parser_svm_model)
+    _add_vocabulary_args(parser_svm_model, decay=False)
+    _add_dedup_args(parser_svm_model)
     parser_svm_model.set_defaults(func=svm_create_model)
 
 
@@ -318,6 +743,8 @@ def parse_args():
     parser_bayes_test.add_argument('--feats', '-f', type=str,
             default=None,
             help='Slovnik pythonu definujici uzite spec. priznaky, pokud neni definovan, je spusteno hledani optimalnich spec. priznaku')
+    _add_backend_args(parser_bayes_test)
+    _add_workers_arg(parser_bayes_test)
     parser_bayes_test.set_defaults(func=bayes_test)
 
     # BAYES - run select features
@@ -331,6 +758,8 @@ def parse_args():
             help='Pocet iteraci n-nasobne krizove validace')
     parser_bayes_feature.add_argument('--max_token_size','-t', default=1, type=int,
             help='Maximalni delka n-tic textovych priznaku')
+    _add_backend_args(parser_bayes_feature)
+    _add_workers_arg(parser_bayes_feature)
     parser_bayes_feature.set_defaults(func=bayes_features)
 
     # BAYES - generate model
@@ -349,8 +778,69 @@ def parse_args():
     parser_bayes_model.add_argument('--feats', '-f', type=str,
             default=None,
             help='Slovnik pythonu definujici uzite spec. priznaky, pokud neni definovan, je spusteno hledani optimalnich spec. priznaku')
+    parser_bayes_model.add_argument('--format', type=str, default='pickle',
+            choices=['pickle', 'mmap'],
+            help='Format modelu: pickle nebo binarni model mapovany do pameti')
+    _add_backend_args(parser_bayes_model)
+    parser_bayes_model.add_argument('--shards', type=int, default=None,
+            help='Uceni vsech anotovanych zaznamu rozdelenych podle rowid do daneho poctu casti, ktere jsou nakonec slouceny (--count neni pouzit)')
+    parser_bayes_model.add_argument('--stream', action='store_true', default=False,
+            help='Zpracovani proudem -- cteni, tokenizace a uceni bezi soubezne s omezenou pameti')
+    parser_bayes_model.add_argument('--sketch', type=float, default=None,
+            help='Priblizny slovnik (Count-Min sketch) s danou pameti v MB na jazyk misto presneho slovniku')
+    _add_workers_arg(parser_bayes_model)
+    _add_vocabulary_args(parser_bayes_model)
+    _add_dedup_args(parser_bayes_model)
     parser_bayes_model.set_defaults(func=bayes_generate_model)
 
+    # BAYES - sketch benchmark
+    parser_bayes_sketch = subparsers_bayes.add_parser('sketch_bench',
+            help='Porovna presnost a pamet priblizneho slovniku (Count-Min sketch) s presnym slovnikem')
+    parser_bayes_sketch.add_argument('--db_file', '-d', type=str, required=True,
+            help='Cesta k databazovemu souboru s anotovanymi daty')
+    parser_bayes_sketch.add_argument('--count', '-c', type=int, default=5000,
+            help='Pocet pouzitych zaznamu z databazoveho souboru')
+    parser_bayes_sketch.add_argument('--max_token_size','-t', default=3, type=int,
+            help='Maximalni delka n-tic textovych priznaku')
+    parser_bayes_sketch.add_argument('--feats', '-f', type=str, required=True,
+            help='Slovnik pythonu definujici uzite spec. priznaky')
+    parser_bayes_sketch.add_argument('--budgets', type=float, nargs='+',
+            default=[0.25, 1, 4, 16],
+            help='Pamet porovnavanych sketchu v MB na jazyk')
+    _add_workers_arg(parser_bayes_sketch)
+    parser_bayes_sketch.set_defaults(func=bayes_sketch_bench)
+
+    # BAYES - merge models
+    parser_bayes_merge = subparsers_bayes.add_parser('merge',
+            help='Slouci modely Bayesovskeho klasifikatoru naucene na ruznych datech')
+    parser_bayes_merge.add_argument('--models', '-m', type=str, nargs='+',
+            required=True, help='Soubory slucovanych modelu')
+    parser_bayes_merge.add_argument('--output', '-o', type=str, required=True,
+            help='Soubor slouceneho modelu')
+    parser_bayes_merge.set_defaults(func=bayes_merge)
+
+    # BAYES - update model
+    parser_bayes_update = subparsers_bayes.add_parser('update',
+            help='Douci model Bayesovskeho klasifikatoru nove anotovanymi zaznamy')
+    parser_bayes_update.add_argument('--model', '-m', type=str, required=True,
+            help='Soubor aktualizovaneho modelu, pokud neexistuje, je vytvoren')
+    parser_bayes_update.add_argument('--db_file', '-d', type=str, required=True,
+            help='Cesta k databazovemu souboru s anotovanymi daty')
+    parser_bayes_update.add_argument('--max_token_size','-t', default=1, type=int,
+            help='Maximalni delka n-tic textovych priznaku noveho modelu')
+    parser_bayes_update.add_argument('--feats', '-f', type=str,
+            default=None,
+            help='Slovnik pythonu definujici uzite spec. priznaky noveho modelu')
+    parser_bayes_update.add_argument('--compact_every', type=int, default=10,
+            help='Pocet aktualizaci v logu, po kterem je log sloucen do modelu')
+    parser_bayes_update.add_argument('--compact', action='store_true', default=False,
+            help='Sloucit log aktualizaci do modelu ihned')
+    parser_bayes_update.add_argument('--mark_consumed', action='store_true', default=False,
+            help='Pouze oznaci vsechny anotovane zaznamy jako obsazene v modelu (model vytvoreny z cele databaze)')
+    _add_workers_arg(parser_bayes_update)
+    _add_vocabulary_args(parser_bayes_update)
+    parser_bayes_update.set_defaults(func=bayes_update)
+
     # BAYES - classify
     parser_bayes_classify = subparsers_bayes.add_parser('classify',
             help='Klasifikuje dany vstupni tex za pouziti modelu.')
@@ -361,6 +851,21 @@ def parse_args():
 
     parser_bayes_classify.set_defaults(func=bayes_classify)
 
+    # BAYES - export quantized model
+    parser_bayes_export = subparsers_bayes.add_parser('export',
+            help='Exportuje model s kvantizovanymi hodnotami log-odds, ktery slouzi pouze ke klasifikaci.')
+    parser_bayes_export.add_argument('--model', '-m', type=str, required=True,
+            help='Soubor klasifikacniho modelu')
+    parser_bayes_export.add_argument('--output', '-o', type=str, required=True,
+            help='Soubor exportovaneho modelu')
+    parser_bayes_export.add_argument('--dtype', type=str, default='float16',
+            choices=['float16', 'int8', 'float32'],
+            help='Datovy typ kvantizovanych hodnot')
+    parser_bayes_export.add_argument('--format', type=str, default='pickle',
+            choices=['pickle', 'mmap'],
+            help='Format modelu: pickle nebo binarni model mapovany do pameti')
+    parser_bayes_export.set_defaults(func=bayes_export)
+
     # COMMON - compare svm and bayesian classifiers
     parser_common = subparsers.add_parser('common',
             help='''Porovnani Bayesovskeho a SVM klasifikatoru. Tento proces muze v zavislosti na zvolenych parametrech trvat velmi dlouho a zabrat velke mnozstvi pameti.''')
@@ -376,14 +881,169 @@ def parse_args():
     parser_common.add_argument('--kernel', '-k', type=str, default='RBF',
             choices=['RBF', 'linear', 'polynomial'],
             help='SVM: Vyber jaderne funkce')
+    _add_backend_args(parser_common)
     parser_common.set_defaults(func=common_run)
 
+    # DISTRIBUTED - worker for tcp backend
+    parser_worker = subparsers.add_parser('worker',
+            help='Spusti workera, ktery vykonava ulohy vzdaleneho koordinatora (backend tcp).')
+    parser_worker.add_argument('--host', type=str, default='127.0.0.1',
+            help='Adresa na ktere worker nasloucha')
+    parser_worker.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
+            help='Port prvniho workera, dalsi workeri pouziji nasledujici porty')
+    parser_worker.add_argument('--processes', type=int, default=1,
+            help='Pocet spustenych workeru')
+    parser_worker.set_defaults(func=worker)
+
+    # SERVING - classification server
+    parser_serve = subparsers.add_parser('serve',
+            help='Spusti server, ktery klasifikuje texty modely nactenymi jen jednou.')
+    parser_serve.add_argument('--models', '-m', type=str, nargs='+', required=True,
+            help='Modely ve tvaru [jmeno=]typ:soubor, typ je bayes, svm nebo cascade (soubor je bayes_soubor,svm_soubor)')
+    parser_serve.add_argument('--http', type=int, default=None,
+            help='Port HTTP serveru na localhostu (POST /classify, GET /stats)')
+    parser_serve.add_argument('--socket', type=str, default=None,
+            help='Cesta k Unix socketu (jeden JSON pozadavek na radek)')
+    parser_serve.add_argument('--max_batch', type=int, default=256,
+            help='Maximalni pocet textu v jedne davce')
+    parser_serve.add_argument('--latency_ms', type=float, default=10,
+            help='Maximalni doba cekani pozadavku na doplneni davky v ms')
+    parser_serve.add_argument('--svm_max_token_size', type=int, default=1,
+            help='Maximalni delka n-tic textovych priznaku SVM modelu')
+    _add_cache_args(parser_serve)
+    _add_cascade_args(parser_serve)
+    parser_serve.set_defaults(func=serve)
+
+    # SERVING - bulk classification
+    parser_bulk = subparsers.add_parser('classify-bulk',
+            help='Klasifikuje proud textu z databaze, JSONL souboru nebo stdin.')
+    parser_bulk.add_argument('--model', '-m', type=str, required=True,
+            help='Model ve tvaru typ:soubor, typ je bayes, svm nebo cascade (soubor je bayes_soubor,svm_soubor)')
+    bulk_input = parser_bulk.add_mutually_exclusive_group(required=True)
+    bulk_input.add_argument('--db_file', '-d', type=str,
+            help='Databazovy soubor, vysledky jsou zapsany do sloupce relevance tabulky docs')
+    bulk_input.add_argument('--jsonl', type=str,
+            help='JSONL soubor s klici text, id a lang, - pro stdin')
+    parser_bulk.add_argument('--where', type=str, default=None,
+            help='SQL podminka vybirajici klasifikovane zaznamy tabulky docs (pouze s --db_file)')
+    parser_bulk.add_argument('--output', '-o', type=str, default=None,
+            help='Vystupni JSONL soubor, implicitne stdout')
+    parser_bulk.add_argument('--labels', action='store_true', default=False,
+            help='Zapsat tridy 1/0 misto pravdepodobnosti')
+    parser_bulk.add_argument('--chunk_size', type=int, default=1000,
+            help='Pocet textu klasifikovanych najednou jednim procesem')
+    parser_bulk.add_argument('--commit_size', type=int, default=20000,
+            help='Pocet zaznamu zapsanych do databaze v jedne transakci')
+    parser_bulk.add_argument('--svm_max_token_size', type=int, default=1,
+            help='Maximalni delka n-tic textovych priznaku SVM modelu')
+    _add_workers_arg(parser_bulk)
+    _add_cache_args(parser_bulk)
+    _add_cascade_args(parser_bulk)
+    parser_bulk.set_defaults(func=bulk_classify)
+
+    # SERVING - cascade
+    parser_cascade = subparsers.add_parser('cascade',
+            help='Porovna kaskadu Bayes + SVM se samotnymi klasifikatory.')
+    parser_cascade.add_argument('--bayes', '-b', type=str, required=True,
+            help='Model bayesovskeho klasifikatoru')
+    parser_cascade.add_argument('--svm', '-s', type=str, required=True,
+            help='Model SVM klasifikatoru')
+    parser_cascade.add_argument('--db_file', '-d', type=str, required=True,
+            help='Databazovy soubor s anotovanymi texty')
+    parser_cascade.add_argument('--count', '-c', type=int, default=1000,
+            help='Pocet relevantnich a irelevantnich textu')
+    parser_cascade.add_argument('--svm_max_token_size', type=int, default=1,
+            help='Maximalni delka n-tic textovych priznaku SVM modelu')
+    _add_cascade_args(parser_cascade)
+    parser_cascade.set_defaults(func=cascade)
+
+    # BENCHMARKS
+    parser_bench = subparsers.add_parser('bench',
+            help='Zmeri rychlost a pametovou narocnost klasifikatoru.')
+    bench_input = parser_bench.add_mutually_exclusive_group(required=True)
+    bench_input.add_argument('--db_file', '-d', type=str,
+            help='Databazovy soubor s anotovanymi texty')
+    bench_input.add_argument('--synthetic', type=int, default=None,
+            help='Vygenerovat syntetickou databazi s danym poctem textu')
+    parser_bench.add_argument('--count', '-c', type=int, default=1000,
+            help='Pocet relevantnich a irelevantnich textu')
+    parser_bench.add_argument('--svm_count', type=int, default=100,
+            help='Pocet relevantnich a irelevantnich textu pro SVM')
+    parser_bench.add_argument('--only', type=str, nargs='+', default=None,
+            help='Spustit jen vybrane testy (tokenize, data_matrix, gram, svm_train, svm_predict, annealing_step, bayes_train, bayes_train_many, bayes_classify, bayes_classify_many)')
+    parser_bench.add_argument('--repeat', type=int, default=3,
+            help='Pocet opakovani kazdeho testu, pouzije se nejlepsi cas')
+    parser_bench.add_argument('--max_token_size', type=int, default=1,
+            help='Maximalni delka n-tic textovych priznaku')
+    parser_bench.add_argument('--kernel', '-k', type=str, default='linear',
+            choices=['linear', 'RBF', 'polynomial'],
+            help='Jadro SVM klasifikatoru')
+    parser_bench.add_argument('--param', '-p', type=float, default=1.0,
+            help='Parametr jaderne funkce')
+    parser_bench.add_argument('--c', type=float, default=1.0,
+            help='Parametr C SVM klasifikatoru')
+    parser_bench.add_argument('--n_fold_cv', type=int, default=2,
+            help='Pocet casti krizove validace kroku zihani')
+    parser_bench.add_argument('--seed', type=int, default=1,
+            help='Seed generatoru nahodnych cisel')
+    parser_bench.add_argument('--output', '-o', type=str, default=None,
+            help='Soubor pro vysledky ve formatu JSON')
+    parser_bench.add_argument('--baseline', type=str, default=None,
+            help='Ulozene vysledky, se kterymi jsou nove porovnany')
+    parser_bench.add_argument('--tolerance', type=float, default=0.1,
+            help='Povolene relativni zpomaleni oproti baseline')
+    parser_bench.add_argument('--save_baseline', type=str, default=None,
+            help='Ulozit vysledky jako novou baseline')
+    _add_synthetic_args(parser_bench)
+    parser_bench.set_defaults(func=bench)
+
+    # BENCHMARKS - synthetic database
+    parser_synthetic = subparsers.add_parser('synthetic',
+            help='Vygeneruje syntetickou anotovanou databazi pro testy skalovatelnosti.')
+    parser_synthetic.add_argument('--db_file', '-d', type=str, required=True,
+            help='Vystupni databazovy soubor (tabulka docs)')
+    parser_synthetic.add_argument('--rows', '-n', type=int, default=100000,
+            help='Pocet textu')
+    parser_synthetic.add_argument('--seed', type=int, default=1,
+            help='Seed generatoru nahodnych cisel')
+    parser_synthetic.add_argument('--append', action='store_true', default=False,
+            help='Pridat texty do neprazdne tabulky docs')
+    _add_synthetic_args(parser_synthetic)
+    parser_synthetic.set_defaults(func=synthetic)
+
     # run argparse
     args = parser.parse_args()
+    if args.token_cache:
+        from src.common.entry import Entry
+        from src.common.tokencache import TokenCache
+        Entry.token_cache = TokenCache(args.token_cache)
+    if args.metrics or args.metrics_file:
+        metrics.enable()
+    profiler = None
+    if args.profile:
+        from src.common import backend
+        from src.common.profiling import Profiler
+        profiler = Profiler(args.profile, args.profile_interval)
+        # jobs of backends are profiled in workers
+        backend.job_profiler = profiler
+        profiler.start()
     try:
-        args.func(args)
+        with metrics.timer(args.func.__name__):
+            args.func(args)
     except argparse.ArgumentTypeError, ex:
         print ex
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            sys.stderr.write(profiler.write(args.profile_output,
+                args.profile_top) + '\n')
+        if args.token_cache:
+            Entry.token_cache.log_stats()
+            Entry.token_cache.close()
+        if metrics.is_enabled():
+            sys.stderr.write(metrics.format_table() + '\n')
+            if args.metrics_file:
+                metrics.dump(args.metrics_file, args.metrics_format)
 
 
 
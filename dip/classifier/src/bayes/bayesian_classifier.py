@@ -1,10 +1,88 @@
 #!/usr/bin/env python
 
 import logging
+import numpy as np
 
 from src.worddictionary import WordDictionary
+from src.mappedmodel import MappedModel, write_mapped_model
+from src.updatelog import UpdateLog
+from src.sketch import SketchDictionary
 from ..common.entry import Entry
-from ..common.feature import Ntuple
+from ..common.corpus import tokenize_corpus
+from ..common.pipeline import run_pipeline
+from ..common import metrics
+
+def _thread_tokenize(texts, language, features, max_token_size):
+    '''
+    This function tokenizes chunk of texts. This is a separate function
+    because of parallelisation restrictions in python.
+    @param texts: list of input texts
+    @param language: language of input texts
+    @param features: features to be used to tokenize texts
+    @param max_token_size: text tokenization parameter
+    @return: list of token lists
+    '''
+    # absolute import, src would be resolved as src.bayes.src here
+    import importlib
+    Entry = importlib.import_module('src.common.entry').Entry
+    return [list(Entry(id=None, guid=None, entry=text, language=language,
+        max_token_size=max_token_size).get_token(features)) for text in texts]
+
+class _TokenCounter:
+    '''
+    Consumer of training pipeline (see run_pipeline()). Counter stage sums
+    relevant and irelevant occurrences of tokens of every chunk, trainer stage
+    adds them to the word dictionary.
+    @param classifier: trained BayesianClassifier object
+    '''
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+
+    def count(self, corpus, meta, weights=None):
+        '''
+        @param weights: numpy array of weights of rows (occurrences of their
+                        tokens are counted weight times), None for ones
+        '''
+        ids, interned = corpus.data_ids([lang for lang, label in meta])
+        relevant = np.array([label == 1 for lang, label in meta],
+                dtype=bool)[corpus.rows()]
+        if weights is None:
+            return (interned, np.bincount(ids[relevant],
+                minlength=len(interned)), np.bincount(ids[~relevant],
+                    minlength=len(interned)))
+        weights = weights[corpus.rows()]
+        return (interned, np.bincount(ids[relevant], weights=weights[relevant],
+            minlength=len(interned)).astype(np.int64),
+            np.bincount(ids[~relevant], weights=weights[~relevant],
+                minlength=len(interned)).astype(np.int64))
+
+    def train(self, update):
+        hr_prob = self.classifier.HR_PROB
+        word_dict = self.classifier.word_dict
+        policy = self.classifier.vocabulary
+        if policy is not None and policy.decay is not None:
+            policy.evicted += word_dict.decay(policy.decay)
+        interned, relevant, irelevant = update
+        weights = relevant * hr_prob + irelevant * (1 - hr_prob)
+        counts = relevant + irelevant
+        # tokens are added by languages
+        languages = {}
+        for i, (language, token) in enumerate(interned):
+            languages.setdefault(language, []).append(i)
+        for language, indexes in languages.iteritems():
+            word_dict.add_many(language, [interned[i][1] for i in indexes],
+                    weights[indexes], counts[indexes])
+        if policy is not None:
+            word_dict.prune(policy)
+
+    def finish(self):
+        word_dict = self.classifier.word_dict
+        policy = self.classifier.vocabulary
+        if policy is not None:
+            word_dict.prune(policy, final=True)
+            policy.log_stats(word_dict.memory_usage()[1], 'Word dictionary')
+        return word_dict
 
 class BayesianClassifier:
     '''
@@ -13,19 +91,35 @@ class BayesianClassifier:
     bayesian filter.
     @param low: classification threshold
     @param high: classification threshold
+    @param max_token_size: text tokenization parameter
+    @param vocabulary: VocabularyPolicy bounding word dictionary during
+                       training, unbounded if None
+    @param sketch: memory budget of approximate word dictionary of one
+                   language in bytes (see SketchDictionary), exact word
+                   dictionary is used if None
     '''
 
     HR_PROB = 0.99
+    # number of jobs batch tokenization is split into
+    TOKENIZE_JOBS = 16
 
-    def __init__(self, low=0.5, high=0.5):
+    def __init__(self, low=0.5, high=0.5, max_token_size=2, vocabulary=None,
+            sketch=None, cache=None):
         # classification thresholds
         self._low = float(low)
         self._high = float(high)
+        self.max_token_size = max_token_size
+        self.vocabulary = vocabulary
+        # ClassificationCache object or None
+        self.cache = cache
         # add and setup logger
         self._logger = logging.getLogger()
         logging.basicConfig(level=logging.DEBUG)
         # setup dictionary
-        self.word_dict = WordDictionary()
+        if sketch:
+            self.word_dict = SketchDictionary.with_budget(sketch)
+        else:
+            self.word_dict = WordDictionary()
 
     def train(self, entry, classification, features):
         '''
@@ -34,17 +128,69 @@ class BayesianClassifier:
         @param classification: human classified label
         @param features: features to be used to tokenize entry
         '''
+        self._clear_cache()
         language = entry.get_language()
+        if classification:
+            weight = self.HR_PROB
+        else:
+            weight = 1 - self.HR_PROB
         # for each token add to word dictionary
         for token in entry.get_token(features):
-            self.word_dict.words.setdefault(language, {}).setdefault(
-                    token.get_data(), {'count':0, 'weight':0})['count'] += 1
-            if classification:
-                self.word_dict.words[language][token.get_data()]['weight'] += \
-                    self.HR_PROB
-            else:
-                self.word_dict.words[language][token.get_data()]['weight'] += \
-                    (1 - self.HR_PROB)
+            self.word_dict.add(language, token.get_data(), weight)
+
+    def train_many(self, rows, labels, features, workers=None, dedup=None):
+        '''
+        Train batch of texts. Texts are tokenized in parallel and occurrences
+        of every token are counted before they are added to word dictionary.
+        @param rows: list of (lang, text) tuples
+        @param labels: human classified labels of rows
+        @param features: features to be used to tokenize texts
+        @param workers: number of tokenization processes
+        @param dedup: NearDuplicateFilter collapsing near-duplicate texts of
+                      the same language and label, tokens of representative
+                      are counted as many times as there are texts in its
+                      cluster
+        '''
+        self._clear_cache()
+        with metrics.timer('bayes_train'):
+            corpus = tokenize_corpus(rows, features, self.max_token_size,
+                    workers)
+            weights = None
+            if dedup is not None:
+                with metrics.timer('dedup'):
+                    weights = dedup.find(corpus, [(row[0], bool(label))
+                        for row, label in zip(rows, labels)],
+                        [row[1] for row in rows]).row_weights()
+            with metrics.timer('count'):
+                counter = _TokenCounter(self)
+                counter.train(counter.count(corpus, [(row[0],
+                    1 if label else -1) for row, label in zip(rows, labels)],
+                    weights))
+                counter.finish()
+        metrics.count('bayes_trained', len(rows))
+
+    def train_stream(self, rows, features, workers=None):
+        '''
+        Train texts read lazily from iterable. Reading, tokenization,
+        counting and training run as overlapping pipeline stages, so memory
+        does not grow with number of texts (if size of word dictionary is
+        bounded by vocabulary policy).
+        @param rows: iterable of (lang, text, label) tuples, label 1 marks
+                     relevant texts
+        @param features: features to be used to tokenize texts
+        @param workers: number of tokenization processes
+        '''
+        self._clear_cache()
+        with metrics.timer('bayes_train_stream'):
+            run_pipeline(rows, _TokenCounter(self), features,
+                    self.max_token_size, workers)
+
+    def _clear_cache(self):
+        '''
+        Cached results are not valid when word dictionary changes.
+        '''
+        if self.cache is not None:
+            self.cache.clear()
 
     def classify(self, text, language, features):
         '''
@@ -60,57 +206,113 @@ class BayesianClassifier:
                  p1p2p3........pn                           a
         P = ------------------------------------------ = -------
            p1p2p3........pn + (1-p1)(1-p2)...(1-pn)       a + b
+
+        a and b are calculated as sums of logarithms by the dictionary
+        compiled into CompiledScorer so that they do not underflow
+        --------------------------------------------------------------
+        Results are looked up in the cache (if given) first, they are cached
+        separately for every set of features.
         --------------------------------------------------------------
         @param text: input text
         @param language: input text language
         @return: probability that text is relevant
 
         '''
-        input_entry = Entry(id=None, guid=None, entry=text, language=language)
-        self.word_dict.words.setdefault(language, {})
-        a = 1.0
-        b = 1.0
-        a_feature = 1.0
-        b_feature = 1.0
-        for token in input_entry.get_token(features):
-            if not token.get_data() in self.word_dict.words[language]:
-                    probability = 0.5
-            else:
-                token_stats = self.word_dict.words[language][token.get_data()]
-                probability = token_stats['weight'] / token_stats['count']
-            # separate classifiers for tokens and features
-            if isinstance(token, Ntuple):
-                a *= probability
-                b *= 1 - probability
+        if self.cache is not None:
+            key = self.cache.key(text, language, features)
+            result = self.cache.get(key)
+            if result is None:
+                result = self._classify(text, language, features)
+                self.cache.put(key, result)
+            return result
+        return self._classify(text, language, features)
+
+    def _classify(self, text, language, features):
+        metrics.count('bayes_classified')
+        input_entry = Entry(id=None, guid=None, entry=text, language=language,
+                max_token_size=self.max_token_size)
+        scorer = self.word_dict.compile(language)
+        return scorer.score(input_entry.get_token(features))
+
+    def classify_many(self, texts, language, features, backend=None):
+        '''
+        Classify batch of texts of the same language, see classify(). Texts
+        are tokenized (in parallel if backend is given) and all of them are
+        scored at once by the compiled dictionary.
+        @param texts: list of input texts
+        @param language: input texts language
+        @param features: features to be used to tokenize texts
+        @param backend: execution backend used for tokenization
+        @return: numpy array of probabilities that texts are relevant
+        '''
+        if self.cache is not None:
+            # only texts missing in the cache are tokenized
+            return self.cache.classify_many(texts, [language] * len(texts),
+                    lambda texts, languages: self._classify_many(texts,
+                        language, features, backend), features)
+        return self._classify_many(texts, language, features, backend)
+
+    def _classify_many(self, texts, language, features, backend=None):
+        metrics.count('bayes_classified', len(texts))
+        with metrics.timer('bayes_classify_tokenize'):
+            if backend is None:
+                documents = _thread_tokenize(texts, language, features,
+                        self.max_token_size)
             else:
-                a_feature *= probability
-                b_feature *= 1 - probability
-        # classifiers results
-        if a + b == 0:
-            token_classifier = 0
-        else:
-            token_classifier = a / (a + b)
-        # feature results
-        if a_feature + b_feature == 0:
-            feature_classifier = 0
-        else:
-            feature_classifier = a_feature / (a_feature + b_feature)
-        #return weighted average
-        return (feature_classifier + token_classifier) / 2
+                # one chunk for each job
+                chunk = max(1, len(texts) / self.TOKENIZE_JOBS)
+                jobs = [backend.submit(_thread_tokenize, (texts[i:i + chunk],
+                    language, features, self.max_token_size))
+                    for i in xrange(0, len(texts), chunk)]
+                documents = []
+                for job in jobs:
+                    documents.extend(job())
+        with metrics.timer('bayes_classify_score'):
+            return self.word_dict.compile(language).score_many(documents)
 
     def store_word_dict(self, path, features):
         '''
         Method storing word dictionary to target path
         @param path: target path of word dict (model)
         '''
-        self.word_dict.words['features'] = features
+        self.word_dict.features = features
+        self.word_dict.max_token_size = self.max_token_size
         self.word_dict.store(path)
+        self.word_dict.log_memory_usage()
 
     def load_word_dict(self, path):
         '''
-        Method storing word dictionary to target path
+        Method loading word dictionary from target path. Memory mapped models
+        are opened read-only and can be used only for classification. Pending
+        updates of the model (see UpdateLog) are applied.
         @param path: target path of word dict (model)
         '''
-        self.word_dict.load(path)
+        self._clear_cache()
+        if MappedModel.is_mapped(path):
+            self.word_dict = MappedModel(path)
+        elif SketchDictionary.is_sketch(path):
+            self.word_dict = SketchDictionary()
+            self.word_dict.load(path)
+        else:
+            self.word_dict = WordDictionary()
+            self.word_dict.load(path)
+            UpdateLog(path).apply(self.word_dict)
+        # classify with the same tokenization the model was trained with
+        if self.word_dict.max_token_size is not None:
+            self.max_token_size = self.word_dict.max_token_size
+
+    def export_word_dict(self, path, dtype='float16', model_format='pickle'):
+        '''
+        Method exporting quantized word dictionary for classification only
+        @param path: target path of exported model
+        @param dtype: type of quantized values -- float32, float16 or int8
+        @param model_format: 'pickle' or 'mmap' (memory mapped model)
+        '''
+        if isinstance(self.word_dict, SketchDictionary):
+            raise ValueError('Sketch dictionary can not be exported')
+        if model_format == 'mmap':
+            write_mapped_model(path, self.word_dict, dtype)
+        else:
+            self.word_dict.export_log_odds(path, dtype)
 
 
@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 
+import os
 import sqlite3
 import itertools
+import time
 from math import sqrt
 import copy
+import numpy as np
 
 from bayesian_classifier import BayesianClassifier
+from src.crossvalidation import CountingCrossValidation
+from src.featureselection import TaggedCorpus
+from src.sharding import train_sharded
+from src.updatelog import UpdateLog
+from src.worddictionary import WordDictionary
+from src.mappedmodel import MappedModel
+from src.sketch import SketchDictionary
 from ..common.entry import Entry
+from ..common.pipeline import read_annotated
+from ..common import metrics
 
 class BayesianTest:
     '''
@@ -15,17 +27,30 @@ class BayesianTest:
     @param high: classification threshold
     @param dbfile: source db file containing table docs
                    (lang, relevance, text annotation)
+    @param workers: number of tokenization processes
+    @param vocabulary: VocabularyPolicy bounding trained models
+    @param sketch: memory budget of approximate word dictionary of one
+                   language in bytes, exact dictionary is used if None
+    @param dedup: NearDuplicateFilter collapsing near-duplicate training
+                  entries
     '''
 
-    def __init__(self, dbfile=None, low=0.5, high=0.5, max_token_size=2):
+    def __init__(self, dbfile=None, low=0.5, high=0.5, max_token_size=2,
+            workers=None, vocabulary=None, sketch=None, dedup=None):
         # classification thresholds
         self._low = float(low)
         self._high = float(high)
         # create instance of classifier
-        self.bcl = BayesianClassifier(low=low, high=high)
+        self.bcl = BayesianClassifier(low=low, high=high,
+                max_token_size=max_token_size, vocabulary=vocabulary,
+                sketch=sketch)
         # dbfile with labeled data
         self.dbfile = dbfile
         self.max_token_size = max_token_size
+        self.workers = workers
+        self.vocabulary = vocabulary
+        self.sketch = sketch
+        self.dedup = dedup
 
     def _test_corelation(self, test_res):
         '''
@@ -113,42 +138,40 @@ class BayesianTest:
         @param used_features: defines which features to use.
         @return: results of cross validation
         '''
+        # tokenize all entries once, models of folds are derived from counts
+        self.bcl._logger.info('Tokenizing {0} relevant and {1} irelevant entries...'.format(
+            len(used_relevant), len(used_irelevant)))
+        start = time.time()
+        with metrics.timer('bayes_cv_tokenize'):
+            engine = CountingCrossValidation.tokenize(used_relevant,
+                    used_irelevant, used_features, self.max_token_size,
+                    self.bcl.HR_PROB, self.workers)
+        self.bcl._logger.info('Tokenized in {0:.2f}s, {1} distinct tokens'.format(
+            time.time() - start, engine.size))
+
+        start = time.time()
+        with metrics.timer('bayes_cv_folds'):
+            folds = engine.run(n_fold_cv, count)
+        metrics.count('bayes_cv_classified', sum([len(r) + len(i)
+            for r, i in folds]))
+        self.bcl._logger.info('Classification speed: {0:.1f} docs/s'.format(
+            sum([len(r) + len(i) for r, i in folds]) /
+            (time.time() - start + 0.0000000000001)))
+        return self._evaluate_folds(folds)
+
+    def _evaluate_folds(self, folds):
+        '''
+        Evaluate results of cross validation folds
+        @param folds: list of tuples (relevant_results, irelevant_results)
+                      containing probabilities of tested entries
+        @return: results of cross validation
+        '''
+        n_fold_cv = len(folds)
         # dictionary containing n-fold-cross-validation results
         results = []
 
-        # start n-fold-cross-validation
-        for i in xrange(n_fold_cv):
+        for i, (relevant_results, irelevant_results) in enumerate(folds):
             self.bcl._logger.info('Iteration: {0}'.format(i))
-
-            # clear dictionary from previous iterations
-            self.bcl.word_dict.wipe()
-
-            # create test and train sets
-            self.bcl._logger.info('Creating dataset...')
-            to_test_relevant = \
-                    used_relevant[i*(count/n_fold_cv):(i+1)*(count/n_fold_cv)]
-            to_test_irelevant = \
-                    used_irelevant[i*(count/n_fold_cv):(i+1)*(count/n_fold_cv)]
-            to_train_relevant = used_relevant[:i*(count/n_fold_cv)]
-            to_train_relevant.extend(used_relevant[(i+1)*(count/n_fold_cv):])
-            to_train_irelevant = used_irelevant[:i*(count/n_fold_cv)]
-            to_train_irelevant.extend(used_irelevant[(i+1)*(count/n_fold_cv):])
-
-            # train
-            self.bcl._logger.info('Training starts...')
-            for db_entry in to_train_relevant:
-                entry = Entry(id=None, guid=None, entry=db_entry[1],
-                        language=db_entry[0], max_token_size=self.max_token_size)
-                self.bcl.train(entry, True, used_features)
-            for db_entry in to_train_irelevant:
-                entry = Entry(id=None, guid=None, entry=db_entry[1],
-                        language=db_entry[0], max_token_size=self.max_token_size)
-                self.bcl.train(entry, False, used_features)
-            self.bcl._logger.info('Trained {0} relevant and {1} irelevant entries'.format(
-                len(to_train_relevant), len(to_train_irelevant)))
-
-            # run tests
-            self.bcl._logger.info('Testing starts...')
             clas_res = {}
             clas_res['true_positive'] = 0
             clas_res['true_negative'] = 0
@@ -156,8 +179,7 @@ class BayesianTest:
             clas_res['false_negative'] = 0
             clas_res['unknown'] = 0
             corelation_test_res = []
-            for db_entry in to_test_relevant:
-                result = self.bcl.classify(db_entry[1], db_entry[0], used_features)
+            for result in relevant_results:
                 corelation_test_res.append((result, self.bcl.HR_PROB))
                 if result >= self._high:
                     clas_res['true_positive'] += 1
@@ -165,8 +187,7 @@ class BayesianTest:
                     clas_res['unknown'] += 1
                 elif result <= self._low:
                     clas_res['false_negative'] += 1
-            for db_entry in to_test_irelevant:
-                result = self.bcl.classify(db_entry[1], db_entry[0], used_features)
+            for result in irelevant_results:
                 corelation_test_res.append((result, 1.0 - self.bcl.HR_PROB))
                 if result <= self._low:
                     clas_res['true_negative'] += 1
@@ -175,7 +196,7 @@ class BayesianTest:
                 elif result >= self._high:
                     clas_res['false_positive'] += 1
             self.bcl._logger.info('Tested {0} relevant and {1} irelevant entries'.format(
-                len(to_test_relevant), len(to_test_irelevant)))
+                len(relevant_results), len(irelevant_results)))
 
             # calculate corelation
             clas_res['corelation'] = self._test_corelation(corelation_test_res)
@@ -202,14 +223,17 @@ class BayesianTest:
         # return all cross-validation results
         return clas_res
 
-    def get_best_features(self, count=100, n_fold_cv=10):
+    def get_best_features(self, count=100, n_fold_cv=10, backend=None):
         '''
         Method rus test of available features and select one most fitting for
         current dataset. This is a smart version of get_best_features().
         It calculates best corelation of each feature and use only the best
         corelation of a type and only if it is better than without it.
+        Entries are tokenized only once with all feature variants, tokens of
+        tested configurations are selected from them.
         @param count: count of processed entries (count*relevant,count*irelevant)
         @param n_fold_cv: n-fold-cross-validation setup
+        @param backend: execution backend used to evaluate configurations
         @return dictionary containing best suiting features for current dataset
         '''
         # connect to database
@@ -236,12 +260,36 @@ class BayesianTest:
         used_relevant = relevant[:count]
         used_irelevant = irelevant[:count]
 
-        # create controll run without features
+        # tokenize entries with all features
+        self.bcl._logger.info('Tokenizing {0} relevant and {1} irelevant entries...'.format(
+            len(used_relevant), len(used_irelevant)))
+        start = time.time()
+        with metrics.timer('bayes_features_tokenize'):
+            corpus = TaggedCorpus(used_relevant, used_irelevant,
+                    self.max_token_size, self.bcl.HR_PROB, self.workers)
+        self.bcl._logger.info('Tokenized in {0:.2f}s, {1} distinct tokens'.format(
+            time.time() - start, corpus.size))
+
+        # controll run without features is the first candidate
         tmp_entry = Entry(id=None, guid=None, entry=None, language=None,
                 max_token_size=self.max_token_size)
         no_feat = {f:len(tmp_entry.features_func[f])-1 for f in tmp_entry.features_func}
-        controll_run = self._cross_validation(used_relevant, used_irelevant,
-                    n_fold_cv, count, no_feat)
+        candidates = [(None, None, no_feat)]
+        for f in tmp_entry.features_func:
+            for i in xrange(1, len(tmp_entry.features_func[f])):
+                used_feat = copy.deepcopy(no_feat)
+                used_feat[f] -= i
+                candidates.append((f, i, used_feat))
+
+        # calculate n_fold_cv of all candidates
+        start = time.time()
+        with metrics.timer('bayes_features_evaluate'):
+            folds = corpus.evaluate([c[2] for c in candidates], n_fold_cv,
+                    count, backend)
+        metrics.count('feature_configurations', len(candidates))
+        self.bcl._logger.info('Evaluated {0} feature configurations in {1:.2f}s'.format(
+            len(candidates), time.time() - start))
+        controll_run = self._evaluate_folds(folds[0])
 
         # impact of each tested feature
         impact = {}
@@ -250,19 +298,14 @@ class BayesianTest:
         for f in tmp_entry.features_func:
             results[f] = {}
             impact[f] = {}
-            for i in xrange(1, len(tmp_entry.features_func[f])):
-                used_feat = copy.deepcopy(no_feat)
-                used_feat[f] -= i
-
-                # calculate n_fold_cv
-                result = self._cross_validation(used_relevant, used_irelevant,
-                        n_fold_cv, count, used_feat)
+        for (f, i, used_feat), result in zip(candidates[1:], folds[1:]):
+            result = self._evaluate_folds(result)
 
-                # save impact on corellation
-                impact[f][used_feat[f]] = result['corelation'] - controll_run['corelation']
+            # save impact on corellation
+            impact[f][used_feat[f]] = result['corelation'] - controll_run['corelation']
 
-                if result['corelation'] > controll_run['corelation']:
-                    results[f][i] = result
+            if result['corelation'] > controll_run['corelation']:
+                results[f][i] = result
 
         # create best feat dictionary
         self.bcl._logger.info('No feat: {0}'.format(no_feat))
@@ -275,10 +318,41 @@ class BayesianTest:
         self.bcl._logger.info('Impact of each feat: {}'.format(impact))
         return best_feat
 
-    def create_model(self, path, used_features, count=100):
+    def create_model(self, path, used_features, count=100,
+            model_format='pickle', stream=False, shards=None, backend=None):
         '''
         Method creates model for future classification
+        @param path: path of created model
+        @param used_features: defines which features to use
+        @param count: count of processed entries (count*relevant,count*irelevant)
+        @param model_format: 'pickle' or 'mmap' (memory mapped model)
+        @param stream: train by pipeline reading entries lazily from database
+        @param shards: train all annotated entries in this number of shards
+                       merged together, count is not used then
+        @param backend: execution backend used for sharded training
         '''
+        if self.sketch and (shards or model_format == 'mmap'):
+            self.bcl._logger.error('Sketch dictionary can not be trained in shards or stored as mmap model!')
+            return
+        if self.dedup and (shards or stream):
+            self.bcl._logger.error('Near-duplicates can not be collapsed in sharded or streaming training!')
+            return
+
+        if shards:
+            self.bcl._logger.info('Sharded training starts...')
+            with metrics.timer('bayes_train_sharded'):
+                self.bcl.word_dict = train_sharded(self.dbfile, used_features,
+                        self.max_token_size, shards, backend, self.vocabulary)
+            self._store_model(path, used_features, model_format)
+            return
+
+        if stream:
+            self.bcl._logger.info('Streaming training starts...')
+            self.bcl.train_stream(read_annotated(self.dbfile, count),
+                    used_features, self.workers)
+            self._store_model(path, used_features, model_format)
+            return
+
         # connect to database
         try:
             conn = sqlite3.connect(self.dbfile)
@@ -305,18 +379,182 @@ class BayesianTest:
 
         # train
         self.bcl._logger.info('Training starts...')
-        for db_entry in to_train_relevant:
-            entry = Entry(id=None, guid=None, entry=db_entry[1],
-                    language=db_entry[0], max_token_size=self.max_token_size)
-            self.bcl.train(entry, True, used_features)
-        for db_entry in to_train_irelevant:
-            entry = Entry(id=None, guid=None, entry=db_entry[1],
-                    language=db_entry[0], max_token_size=self.max_token_size)
-            self.bcl.train(entry, False, used_features)
+        self.bcl.train_many(to_train_relevant + to_train_irelevant,
+                [True] * len(to_train_relevant) +
+                [False] * len(to_train_irelevant), used_features, self.workers,
+                self.dedup)
         self.bcl._logger.info('Trained {0} relevant and {1} irelevant entries'.format(
             len(to_train_relevant), len(to_train_irelevant)))
 
-        self.bcl.store_word_dict(path, used_features)
+        self._store_model(path, used_features, model_format)
+
+    def update_model(self, path, used_features=None, compact_every=10,
+            compact=False, mark_consumed=False):
+        '''
+        Method trains annotated entries which were not used by the model yet
+        and appends them as delta to the update log of the model (see
+        UpdateLog). Only rowids of annotated entries are read to find the new
+        ones, so cost of the update grows with number of new entries. Entry
+        is used only once, later changes of its annotation are ignored.
+        @param path: path of the model, new empty model is created if it does
+                     not exist
+        @param used_features: features of newly created model, features of
+                              existing model are used otherwise
+        @param compact_every: log is compacted into the base model when it
+                              contains this number of updates
+        @param compact: compact the log after this update
+        @param mark_consumed: only record all annotated entries as contained
+                              in the model (for models created by
+                              create_model() from the whole database)
+        @return: number of trained entries
+        '''
+        log = UpdateLog(path)
+        if os.path.exists(path) and (MappedModel.is_mapped(path) or
+                SketchDictionary.is_sketch(path)):
+            self.bcl._logger.error('Memory mapped or sketch model {0} can not be updated!'.format(path))
+            return 0
+
+        # connect to database
+        try:
+            conn = sqlite3.connect(self.dbfile)
+            cur = conn.cursor()
+        except:
+            self.bcl._logger.error('DB file {0} was not loaded!'.format(self.dbfile))
+            return 0
+        cur.execute('select rowid from docs where annotation in (0, 1)')
+        annotated = [row[0] for row in cur.fetchall()]
+
+        if mark_consumed:
+            log.mark_consumed(annotated)
+            self.bcl._logger.info('Marked {0} entries as contained in {1}'.format(
+                len(annotated), path))
+            return 0
+        if not os.path.exists(path):
+            if used_features is None:
+                self.bcl._logger.error('Features of new model {0} are not defined!'.format(path))
+                return 0
+            self.bcl.store_word_dict(path, used_features)
+        elif not log.has_state():
+            self.bcl._logger.error('Entries of model {0} are not tracked, mark them '
+                    'as contained in the model first!'.format(path))
+            return 0
+
+        # model is tokenized the same way as before
+        base = WordDictionary()
+        base.load(path)
+        features = base.features
+        max_token_size = base.max_token_size or self.max_token_size
+        consumed = log.consumed()
+        new = [rowid for rowid in annotated if rowid not in consumed]
+        if not new:
+            self.bcl._logger.info('No new entries for {0}'.format(path))
+            conn.close()
+            # pending updates are compacted even without new entries
+            if compact:
+                log.compact(self.vocabulary)
+            return 0
+
+        rows = set()
+        for i in xrange(0, len(new), 500):
+            chunk = new[i:i + 500]
+            cur.execute('select lang, text, annotation from docs where rowid in '
+                    '({0})'.format(','.join('?' * len(chunk))), chunk)
+            rows.update(cur.fetchall())
+        rows = list(rows)
+        conn.close()
+
+        start = time.time()
+        bcl = BayesianClassifier(max_token_size=max_token_size)
+        bcl.train_many([row[:2] for row in rows], [row[2] == 1 for row in rows],
+                features, self.workers)
+        bcl.word_dict.features = features
+        bcl.word_dict.max_token_size = max_token_size
+        log.append(bcl.word_dict, new, self.vocabulary and self.vocabulary.decay)
+        self.bcl._logger.info('Appended update of {0} entries to {1} in {2:.2f}s'.format(
+            len(new), log.log_path, time.time() - start))
+
+        if compact or len(log.records()) >= compact_every:
+            log.compact(self.vocabulary)
+        return len(new)
+
+    def benchmark_sketch(self, used_features, budgets, count=5000):
+        '''
+        Compare accuracy and memory of sketch dictionaries with the exact
+        word dictionary. Every fifth entry is used for testing, the rest for
+        training.
+        @param used_features: defines which features to use
+        @param budgets: list of memory budgets of sketches in bytes
+        @param count: count of processed entries (count*relevant,count*irelevant)
+        @return: list of dictionaries with results, the first one is exact
+                 dictionary
+        '''
+        # connect to database
+        try:
+            conn = sqlite3.connect(self.dbfile)
+            cur = conn.cursor()
+        except:
+            self.bcl._logger.error('DB file {0} was not loaded!'.format(self.dbfile))
+            return
+
+        # load entries from database
+        cur.execute('select distinct lang, text from docs where (annotation=1)')
+        relevant = cur.fetchall()
+        cur.execute('select distinct lang, text from docs where (annotation=0)')
+        irelevant = cur.fetchall()
+        count = min(count, len(relevant), len(irelevant))
+        rows = relevant[:count] + irelevant[:count]
+        labels = np.array([True] * count + [False] * count)
+        test = np.arange(len(rows)) % 5 == 0
+        train_rows = [row for row, t in zip(rows, test) if not t]
+        test_rows = [row for row, t in zip(rows, test) if t]
+
+        results = []
+        exact = None
+        for budget in [None] + list(budgets):
+            bcl = BayesianClassifier(max_token_size=self.max_token_size,
+                    sketch=budget)
+            start = time.time()
+            bcl.train_many(train_rows, labels[~test], used_features,
+                    self.workers)
+            train_time = time.time() - start
+            start = time.time()
+            probabilities = np.zeros(len(test_rows))
+            for language in set([row[0] for row in test_rows]):
+                indexes = [i for i, row in enumerate(test_rows)
+                        if row[0] == language]
+                probabilities[indexes] = bcl.classify_many(
+                        [test_rows[i][1] for i in indexes], language,
+                        used_features)
+            classify_time = time.time() - start
+            if exact is None:
+                exact = probabilities
+            result = {'budget':budget,
+                    'bytes':bcl.word_dict.memory_usage()[0],
+                    'accuracy':np.mean((probabilities >= 0.5) == labels[test]),
+                    'difference':np.mean(np.abs(probabilities - exact)),
+                    'train_time':train_time, 'classify_time':classify_time}
+            results.append(result)
+            self.bcl._logger.info('{0:>12} {1:>12} bytes, accuracy {2:.4f}, mean difference {3:.4f}, '
+                    'train {4:.2f}s, classify {5:.2f}s'.format(
+                        'exact' if budget is None else budget, result['bytes'],
+                        result['accuracy'], result['difference'], train_time,
+                        classify_time))
+        return results
+
+    def _store_model(self, path, used_features, model_format):
+        '''
+        Store trained model
+        @param path: path of created model
+        @param used_features: features used to train the model
+        @param model_format: 'pickle' or 'mmap' (memory mapped model)
+        '''
+        with metrics.timer('bayes_store_model'):
+            if model_format == 'mmap':
+                self.bcl.word_dict.features = used_features
+                self.bcl.word_dict.max_token_size = self.max_token_size
+                self.bcl.export_word_dict(path, 'float32', model_format)
+            else:
+                self.bcl.store_word_dict(path, used_features)
 
     def run(self, features, count=100, n_fold_cv=10):
         '''
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from scorer import CompiledScorer
+from ...common.corpus import tokenize_corpus
+
+def offsets(documents, count):
+    '''
+    Calculate offsets of ragged array from document indexes of its items.
+    @param documents: sorted numpy array of document index of every item
+    @param count: number of documents
+    @return: numpy array of starts of documents followed by number of items
+    '''
+    return np.append(0, np.cumsum(np.bincount(documents, minlength=count)))
+
+class CountingCrossValidation:
+    '''
+    Cross validation of bayesian classifier working on documents tokenized
+    only once. Training is just counting of tokens, so token counts of the
+    whole corpus are calculated once and model of every fold is obtained by
+    subtracting counts of its test documents.
+    Documents are given as ragged arrays of token ids, relevant documents
+    first. Numbers of relevant and irelevant occurrences are kept as integers,
+    weights are calculated from them, so subtraction does not accumulate
+    rounding errors.
+    @param n_relevant: number of relevant documents
+    @param n_irelevant: number of irelevant documents
+    @param size: number of distinct token ids
+    @param ntuples: concatenated n-tuple ids of all documents
+    @param ntuple_offsets: start of every document in ntuples, followed by
+                           length of ntuples
+    @param features: concatenated special feature ids of all documents
+    @param feature_offsets: start of every document in features, followed by
+                            length of features
+    @param hr_prob: weight of token occurrence in relevant document
+    '''
+
+    def __init__(self, n_relevant, n_irelevant, size, ntuples, ntuple_offsets,
+            features, feature_offsets, hr_prob=0.99):
+        self.hr_prob = hr_prob
+        self.n_relevant = n_relevant
+        self.n_irelevant = n_irelevant
+        self.size = size
+        self.ntuples = np.asarray(ntuples, dtype=np.int64)
+        self.ntuple_offsets = np.asarray(ntuple_offsets, dtype=np.int64)
+        self.features = np.asarray(features, dtype=np.int64)
+        self.feature_offsets = np.asarray(feature_offsets, dtype=np.int64)
+        # counts of the whole corpus
+        self.relevant_counts = self._count(0, self.n_relevant)
+        self.irelevant_counts = self._count(self.n_relevant,
+                self.n_relevant + self.n_irelevant)
+
+    @classmethod
+    def tokenize(cls, relevant, irelevant, features, max_token_size,
+            hr_prob=0.99, workers=None):
+        '''
+        Tokenize documents and create cross validation of them. Tokens are
+        interned to ids by (language, token) so dictionaries of different
+        languages stay separated.
+        @param relevant: list of (lang, text) tuples of relevant documents
+        @param irelevant: list of (lang, text) tuples of irelevant documents
+        @param features: features to be used to tokenize documents
+        @param max_token_size: text tokenization parameter
+        @param hr_prob: weight of token occurrence in relevant document
+        @param workers: number of tokenization processes
+        @return: CountingCrossValidation object
+        '''
+        rows = list(relevant) + list(irelevant)
+        corpus = tokenize_corpus(rows, features, max_token_size, workers)
+        ids, interned = corpus.data_ids([row[0] for row in rows])
+        ntuple = corpus.is_ntuple()[corpus.ids]
+        documents = corpus.rows()
+        return cls(len(relevant), len(irelevant), len(interned), ids[ntuple],
+                offsets(documents[ntuple], len(rows)), ids[~ntuple],
+                offsets(documents[~ntuple], len(rows)), hr_prob)
+
+    def _count(self, first, last):
+        '''
+        Count occurrences of tokens in documents first..last-1.
+        @return: numpy array of counts indexed by token ids
+        '''
+        ntuples = self.ntuples[
+                self.ntuple_offsets[first]:self.ntuple_offsets[last]]
+        features = self.features[
+                self.feature_offsets[first]:self.feature_offsets[last]]
+        return (np.bincount(ntuples, minlength=self.size) +
+                np.bincount(features, minlength=self.size))
+
+    def _ragged(self, ranges):
+        '''
+        Gather ids of documents from given ranges.
+        @param ranges: list of (first, last) document ranges
+        @return: tuple (ntuples, ntuple_lengths, features, feature_lengths)
+        '''
+        result = []
+        for ids, offsets in ((self.ntuples, self.ntuple_offsets),
+                (self.features, self.feature_offsets)):
+            result.append(np.concatenate([ids[offsets[first]:offsets[last]]
+                for first, last in ranges]))
+            result.append(np.concatenate([np.diff(offsets[first:last + 1])
+                for first, last in ranges]))
+        return tuple(result)
+
+    def probabilities(self, relevant_counts, irelevant_counts):
+        '''
+        Calculate token probabilities weight / count from occurrence counts,
+        tokens which do not occur are unknown.
+        @return: numpy array of probabilities indexed by token ids
+        '''
+        counts = relevant_counts + irelevant_counts
+        weights = (relevant_counts * self.hr_prob +
+                irelevant_counts * (1 - self.hr_prob))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, weights / counts,
+                    CompiledScorer.UNKNOWN_PROB)
+
+    def run_fold(self, i, n_fold_cv, count):
+        '''
+        Train model without documents of i-th fold and classify them.
+        Documents i*(count/n_fold_cv)..(i+1)*(count/n_fold_cv)-1 of both
+        relevant and irelevant documents are tested.
+        @param i: index of the fold
+        @param n_fold_cv: n-fold-cross-validation setup
+        @param count: count of used entries of each class
+        @return: tuple of numpy arrays -- probabilities of tested relevant
+                 and irelevant documents
+        '''
+        size = count / n_fold_cv
+        relevant = (min(i * size, self.n_relevant),
+                min((i + 1) * size, self.n_relevant))
+        irelevant = (self.n_relevant + min(i * size, self.n_irelevant),
+                self.n_relevant + min((i + 1) * size, self.n_irelevant))
+        # model of the fold is the whole corpus without tested documents
+        scorer = CompiledScorer({}, self.probabilities(
+            self.relevant_counts - self._count(*relevant),
+            self.irelevant_counts - self._count(*irelevant)))
+        results = scorer.score_ids(*self._ragged([relevant, irelevant]))
+        tested = relevant[1] - relevant[0]
+        return (results[:tested], results[tested:])
+
+    def run(self, n_fold_cv, count):
+        '''
+        Run all folds of cross validation.
+        @param n_fold_cv: n-fold-cross-validation setup
+        @param count: count of used entries of each class
+        @return: list of results of run_fold()
+        '''
+        return [self.run_fold(i, n_fold_cv, count) for i in xrange(n_fold_cv)]
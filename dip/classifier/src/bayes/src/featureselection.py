@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from crossvalidation import CountingCrossValidation, offsets
+from ...common.corpus import tokenize_corpus
+
+def _thread_cross_validation(corpus, candidates, n_fold_cv, count):
+    '''
+    This function cross validates feature configurations on tagged corpus.
+    This is a separate function because of parallelisation restrictions in
+    python.
+    @param corpus: TaggedCorpus object
+    @param candidates: list of feature configurations
+    @param n_fold_cv: n-fold-cross-validation setup
+    @param count: count of used entries of each class
+    @return: list of fold results of every candidate
+    '''
+    return [corpus.select(features).run(n_fold_cv, count)
+            for features in candidates]
+
+class TaggedCorpus:
+    '''
+    Documents tokenized once with every variant of every feature. Each
+    special feature token is tagged by (feature, variant) which produced it,
+    so tokens of any feature configuration are obtained by selecting tokens
+    of its tags, without tokenizing the documents again. N-tuples are used
+    by every configuration and are not tagged.
+    @param relevant: list of (lang, text) tuples of relevant documents
+    @param irelevant: list of (lang, text) tuples of irelevant documents
+    @param max_token_size: text tokenization parameter
+    @param hr_prob: weight of token occurrence in relevant document
+    @param workers: number of tokenization processes
+    '''
+
+    def __init__(self, relevant, irelevant, max_token_size, hr_prob=0.99,
+            workers=None):
+        self.hr_prob = hr_prob
+        self.n_relevant = len(relevant)
+        self.n_irelevant = len(irelevant)
+        rows = list(relevant) + list(irelevant)
+        corpus = tokenize_corpus(rows, None, max_token_size, workers)
+        # ids of (language, token), {(feature, variant): tag}
+        ids, interned = corpus.data_ids([row[0] for row in rows])
+        self.size = len(interned)
+        self.tags = dict([(tag, i) for i, tag in enumerate(corpus.tags)
+            if tag is not None])
+        ntuple = np.array([tag is None for tag in corpus.tags],
+                dtype=bool)[corpus.tag_ids]
+        documents = corpus.rows()
+        self.ntuples = ids[ntuple]
+        self.ntuple_offsets = offsets(documents[ntuple], len(rows))
+        self.features = ids[~ntuple]
+        self.feature_tags = corpus.tag_ids[~ntuple]
+        # document index of every feature token
+        self.feature_documents = documents[~ntuple]
+
+    def select(self, features):
+        '''
+        Select tokens of feature configuration.
+        @param features: dictionary containing chosen features and it's types
+        @return: CountingCrossValidation object of the configuration
+        '''
+        selected = np.zeros(len(self.tags) + 1, dtype=bool)
+        for feature, variant in features.iteritems():
+            if (feature, variant) in self.tags:
+                selected[self.tags[(feature, variant)]] = True
+        mask = selected[self.feature_tags]
+        return CountingCrossValidation(self.n_relevant, self.n_irelevant,
+                self.size, self.ntuples, self.ntuple_offsets,
+                self.features[mask], offsets(self.feature_documents[mask],
+                    self.n_relevant + self.n_irelevant), self.hr_prob)
+
+    def evaluate(self, candidates, n_fold_cv, count, backend=None):
+        '''
+        Cross validate several feature configurations. Candidates are
+        independent, so they are evaluated in parallel if backend is given.
+        @param candidates: list of feature configurations
+        @param n_fold_cv: n-fold-cross-validation setup
+        @param count: count of used entries of each class
+        @param backend: execution backend used for evaluation
+        @return: list of fold results of every candidate
+        '''
+        if backend is None:
+            return _thread_cross_validation(self, candidates, n_fold_cv, count)
+        corpus = backend.share(self)
+        jobs = [backend.submit(_thread_cross_validation, (corpus, [features],
+            n_fold_cv, count)) for features in candidates]
+        return [job()[0] for job in jobs]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import json
+import struct
+import hashlib
+import numpy as np
+
+from scorer import CompiledScorer
+
+# file starts with magic string and length of json header
+MAGIC = 'DIPBAYES'
+VERSION = 1
+# maximal ratio of used slots of the hash table
+LOAD_FACTOR = 0.5
+
+def token_hash(token):
+    '''
+    Calculate stable 64 bit hash of token. Equal tokens have to have equal
+    hashes regardless of str/unicode type of their words, bool values are
+    hashed as numbers the same way dictionary keys are compared.
+    Value 0 marks empty slot, so it is never returned.
+    @param token: token data (tuple of words or value of feature)
+    @return: hash as integer
+    '''
+    if isinstance(token, tuple):
+        data = 't' + '\x1f'.join([_to_str(word) for word in token])
+    elif isinstance(token, (bool, int, long)):
+        data = 'i' + str(int(token))
+    else:
+        data = 's' + _to_str(token)
+    return struct.unpack('<Q', hashlib.md5(data).digest()[:8])[0] or 1
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def write_mapped_model(path, word_dict, dtype='float32'):
+    '''
+    Write word dictionary as memory mappable model. Header contains feature
+    configuration, max_token_size and position of open-addressing hash table
+    of every language. Table maps token hashes to log-odds log(p/(1-p)),
+    tokens themselves are not stored so the model can not be trained anymore.
+    @param path: path of the model file
+    @param word_dict: WordDictionary object
+    @param dtype: type of stored log-odds -- float32, float16 or int8
+    '''
+    header = {'version':VERSION, 'features':word_dict.features,
+            'max_token_size':word_dict.max_token_size, 'dtype':dtype,
+            'languages':{}}
+    sections = []
+    offset = 0
+    for language in word_dict.languages():
+        tokens = word_dict.tokens(language)
+        p = word_dict.probabilities(language)
+        with np.errstate(divide='ignore'):
+            log_odds = np.log(p) - np.log1p(-p)
+        # quantization
+        scale = 1.0
+        if dtype == 'int8':
+            finite = np.abs(log_odds[np.isfinite(log_odds)])
+            if len(finite):
+                scale = max(finite.max(), 0.0000000000001) / 127
+            log_odds = np.clip(np.round(log_odds / scale), -127, 127)
+
+        # fill the table using linear probing
+        size = 8
+        while size * LOAD_FACTOR < len(tokens):
+            size *= 2
+        mask = size - 1
+        hashes = np.zeros(size, dtype='<u8')
+        values = np.zeros(size, dtype=dtype)
+        for token, value in zip(tokens, log_odds):
+            h = token_hash(token)
+            slot = h & mask
+            while hashes[slot] and hashes[slot] != h:
+                slot = (slot + 1) & mask
+            hashes[slot] = h
+            values[slot] = value
+
+        # offsets are relative to the end of header
+        header['languages'][language] = {'slots':size, 'scale':scale}
+        for name, array in (('hashes', hashes), ('values', values)):
+            header['languages'][language][name] = offset
+            sections.append((offset, array))
+            offset = _align(offset + array.nbytes)
+
+    header = json.dumps(header)
+    f = open(path, 'wb')
+    f.write(MAGIC + struct.pack('<I', len(header)) + header)
+    start = _align(len(MAGIC) + 4 + len(header))
+    position = len(MAGIC) + 4 + len(header)
+    for offset, array in sections:
+        f.write('\0' * (start + offset - position))
+        f.write(array.tostring())
+        position = start + offset + array.nbytes
+    f.close()
+
+
+class MappedScorer(CompiledScorer):
+    '''
+    Scorer looking tokens up directly in memory mapped hash table.
+    @param hashes: memory mapped array of token hashes, 0 for empty slot
+    @param values: memory mapped array of log-odds
+    @param scale: value of one quantization step
+    '''
+
+    def __init__(self, hashes, values, scale=1.0):
+        self.hashes = hashes
+        self.values = values
+        self.scale = scale
+        self.mask = len(hashes) - 1
+
+    def _ids(self, tokens, ntuples, features):
+        '''
+        Append hashes of tokens to given lists.
+        '''
+        ntuple_count = len(ntuples)
+        feature_count = len(features)
+        for token in tokens:
+            data = token.get_data()
+            if isinstance(data, tuple):
+                ntuples.append(token_hash(data))
+            else:
+                features.append(token_hash(data))
+        return (len(ntuples) - ntuple_count, len(features) - feature_count)
+
+    def lookup(self, hashes):
+        '''
+        Find log-odds of tokens by linear probing of all of them at once.
+        @param hashes: numpy array of token hashes
+        @return: numpy array of log-odds, 0 for unknown tokens
+        '''
+        result = np.zeros(len(hashes))
+        pending = np.arange(len(hashes))
+        slots = hashes & np.uint64(self.mask)
+        while len(pending):
+            stored = self.hashes[slots]
+            found = stored == hashes[pending]
+            result[pending[found]] = self.values[slots[found]] * self.scale
+            # continue with next slot until token or empty slot is found
+            collision = ~found & (stored != 0)
+            pending = pending[collision]
+            slots = (slots[collision] + np.uint64(1)) & np.uint64(self.mask)
+        return result
+
+    def _score_ragged(self, hashes, lengths):
+        hashes = np.array(hashes, dtype=np.uint64)
+        documents = self._documents(lengths)
+        log_odds = np.bincount(documents, weights=self.lookup(hashes),
+                minlength=len(lengths))
+        with np.errstate(over='ignore'):
+            return 1.0 / (1.0 + np.exp(-log_odds))
+
+
+class MappedModel:
+    '''
+    Read-only bayesian model memory mapped from file written by
+    write_mapped_model(). Opening reads only the header, tables are paged in
+    on demand and shared by all processes using the same model. It can be
+    used instead of WordDictionary for classification.
+    @param path: path of the model file
+    '''
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a memory mapped model'.format(path))
+        length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(length))
+        f.close()
+        start = _align(len(MAGIC) + 4 + length)
+        self.features = header['features']
+        self.max_token_size = header['max_token_size']
+        self._scorers = {}
+        for language, table in header['languages'].iteritems():
+            hashes = np.memmap(path, dtype='<u8', mode='r',
+                    offset=start + table['hashes'], shape=(table['slots'],))
+            values = np.memmap(path, dtype=header['dtype'], mode='r',
+                    offset=start + table['values'], shape=(table['slots'],))
+            self._scorers[language] = MappedScorer(hashes, values,
+                    table['scale'])
+        # scorer of language which is not present in the model
+        self._empty = MappedScorer(np.zeros(1, dtype='<u8'), np.zeros(1))
+
+    @staticmethod
+    def is_mapped(path):
+        '''
+        Check whether file is memory mapped model.
+        @param path: path of the model file
+        @return: True if file starts with magic string
+        '''
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return False
+        magic = f.read(len(MAGIC))
+        f.close()
+        return magic == MAGIC
+
+    def compile(self, language):
+        '''
+        Get scorer of given language.
+        @param language: language of classified texts
+        @return: MappedScorer object
+        '''
+        return self._scorers.get(language, self._empty)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+class CompiledScorer:
+    '''
+    Word dictionary of one language frozen for fast classification. Tokens are
+    mapped to ids and log(p) and log(1-p) of every token are kept in numpy
+    arrays. Ids of n-tuples and special features of a document are gathered
+    separately and probability of the document is then calculated from sums
+    of logarithms which, unlike product of probabilities, does not underflow
+    for long documents.
+    Unknown tokens are mapped to the last id with probability 0.5.
+    @param ids: dictionary mapping tokens to ids, ids not lower than size of
+                probability array are treated as unknown
+    @param prob: numpy array of token probabilities indexed by ids
+    '''
+
+    UNKNOWN_PROB = 0.5
+
+    def __init__(self, ids, prob):
+        self.ids = ids
+        self.unknown = len(prob)
+        self.log_p, self.log_q = self._to_logs(prob)
+
+    def _to_logs(self, prob):
+        '''
+        Convert array of token probabilities into arrays of logarithms, unknown
+        token probability is appended.
+        @param prob: array of probabilities
+        @return: tuple of arrays log(p) and log(1-p)
+        '''
+        p = np.append(np.asarray(prob, dtype=np.float64), self.UNKNOWN_PROB)
+        with np.errstate(divide='ignore'):
+            return (np.log(p), np.log1p(-p))
+
+    def _ids(self, tokens, ntuples, features):
+        '''
+        Map tokens to ids and append them to given lists. N-tuples are tuples
+        of words, special features are plain values.
+        @param tokens: iterable of Feature objects
+        @param ntuples: list of n-tuple ids
+        @param features: list of special feature ids
+        @return: tuple of numbers of appended n-tuple and feature ids
+        '''
+        unknown = self.unknown
+        ntuple_count = len(ntuples)
+        feature_count = len(features)
+        for token in tokens:
+            data = token.get_data()
+            i = self.ids.get(data, unknown)
+            # token added to dictionary after compilation
+            if i > unknown:
+                i = unknown
+            if isinstance(data, tuple):
+                ntuples.append(i)
+            else:
+                features.append(i)
+        return (len(ntuples) - ntuple_count, len(features) - feature_count)
+
+    def ids_of(self, tokens):
+        '''
+        Map tokens to ids.
+        @param tokens: iterable of Feature objects
+        @return: tuple of arrays -- n-tuple ids and special feature ids
+        '''
+        ntuples = []
+        features = []
+        self._ids(tokens, ntuples, features)
+        return (np.array(ntuples, dtype=np.int64),
+                np.array(features, dtype=np.int64))
+
+    def combine(self, log_a, log_b):
+        '''
+        Calculate a / (a + b) from logarithms of a and b.
+        @param log_a: log(p1p2p3........pn), number or array
+        @param log_b: log((1-p1)(1-p2)...(1-pn)), number or array
+        @return: probability, 0 if both a and b are 0
+        '''
+        log_a = np.asarray(log_a, dtype=np.float64)
+        log_b = np.asarray(log_b, dtype=np.float64)
+        with np.errstate(over='ignore', invalid='ignore'):
+            result = 1.0 / (1.0 + np.exp(log_b - log_a))
+        return np.where((log_a == -np.inf) & (log_b == -np.inf), 0.0, result)
+
+    def score(self, tokens):
+        '''
+        Calculate probability of document being relevant to topic. Results of
+        n-tuple and special feature classifiers are merged with classical
+        average.
+        @param tokens: iterable of Feature objects of the document
+        @return: probability that document is relevant
+        '''
+        return float(self.score_many([tokens])[0])
+
+    def score_many(self, documents):
+        '''
+        Calculate probabilities of several documents at once. Ids of all
+        documents are concatenated into one ragged array and sums of
+        logarithms of all documents are calculated by one reduction.
+        @param documents: list of iterables of Feature objects
+        @return: numpy array of probabilities that documents are relevant
+        '''
+        ntuples = []
+        features = []
+        ntuple_lengths = []
+        feature_lengths = []
+        for tokens in documents:
+            ntuple_count, feature_count = self._ids(tokens, ntuples, features)
+            ntuple_lengths.append(ntuple_count)
+            feature_lengths.append(feature_count)
+        return self.score_ids(ntuples, ntuple_lengths, features,
+                feature_lengths)
+
+    def score_ids(self, ntuples, ntuple_lengths, features, feature_lengths):
+        '''
+        Calculate probabilities of documents given as ragged arrays of ids.
+        @param ntuples: concatenated n-tuple ids of all documents
+        @param ntuple_lengths: number of n-tuple ids of every document
+        @param features: concatenated special feature ids of all documents
+        @param feature_lengths: number of feature ids of every document
+        @return: numpy array of probabilities that documents are relevant
+        '''
+        token_classifier = self._score_ragged(ntuples, ntuple_lengths)
+        feature_classifier = self._score_ragged(features, feature_lengths)
+        return (feature_classifier + token_classifier) / 2
+
+    def _documents(self, lengths):
+        '''
+        Create array containing document index of every id in ragged array.
+        @param lengths: number of ids of every document
+        @return: numpy array of document indexes
+        '''
+        return np.repeat(np.arange(len(lengths)),
+                np.asarray(lengths, dtype=np.int64))
+
+    def _score_ragged(self, ids, lengths):
+        '''
+        Calculate a / (a + b) of every document in ragged array of ids.
+        @param ids: concatenated ids of all documents
+        @param lengths: number of ids of every document
+        @return: numpy array of probabilities
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        documents = self._documents(lengths)
+        log_a = np.bincount(documents, weights=self.log_p[ids],
+                minlength=len(lengths))
+        log_b = np.bincount(documents, weights=self.log_q[ids],
+                minlength=len(lengths))
+        return self.combine(log_a, log_b)
+
+
+class QuantizedScorer(CompiledScorer):
+    '''
+    Scorer using quantized log-odds log(p/(1-p)) of tokens, used for serving
+    exported models (see WordDictionary.export_log_odds()). Since
+    a / (a + b) = 1 / (1 + exp(-sum(log-odds))), one array is sufficient.
+    @param ids: dictionary mapping tokens to ids
+    @param values: numpy array of quantized log-odds (float16 or int8)
+    @param scale: value of one quantization step
+    '''
+
+    def __init__(self, ids, values, scale=1.0):
+        self.ids = ids
+        self.unknown = len(values)
+        # unknown token has probability 0.5, i.e. log-odds 0
+        self.log_odds = np.append(values.astype(np.float64) * scale, 0.0)
+
+    def _score_ragged(self, ids, lengths):
+        ids = np.asarray(ids, dtype=np.int64)
+        documents = self._documents(lengths)
+        log_odds = np.bincount(documents, weights=self.log_odds[ids],
+                minlength=len(lengths))
+        with np.errstate(over='ignore'):
+            return 1.0 / (1.0 + np.exp(-log_odds))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import logging
+import sqlite3
+import time
+
+from worddictionary import WordDictionary
+
+def _thread_train_shard(dbfile, first, last, features, max_token_size):
+    '''
+    This function trains partial word dictionary on annotated entries with
+    rowid in range first..last-1. This is a separate function because of
+    parallelisation restrictions in python.
+    @param dbfile: source db file containing table docs
+    @param first: first rowid of the shard
+    @param last: rowid following the shard
+    @param features: features to be used to tokenize entries
+    @param max_token_size: text tokenization parameter
+    @return: tuple (data of word dictionary, number of trained entries)
+    '''
+    import sqlite3
+    # absolute import, src would be resolved as src.bayes.src here
+    import importlib
+    BayesianClassifier = importlib.import_module(
+            'src.bayes.bayesian_classifier').BayesianClassifier
+    conn = sqlite3.connect(dbfile)
+    cur = conn.cursor()
+    cur.execute('select distinct lang, text, annotation from docs where '
+            'rowid >= ? and rowid < ? and annotation in (0, 1)', (first, last))
+    rows = cur.fetchall()
+    conn.close()
+    bcl = BayesianClassifier(max_token_size=max_token_size)
+    bcl.train_many([row[:2] for row in rows], [row[2] == 1 for row in rows],
+            features, workers=1)
+    bcl.word_dict.features = features
+    bcl.word_dict.max_token_size = max_token_size
+    return (bcl.word_dict.dump_data(), len(rows))
+
+def _thread_merge(first, second):
+    '''
+    This function merges two word dictionaries. This is a separate function
+    because of parallelisation restrictions in python.
+    @param first: data of word dictionary
+    @param second: data of word dictionary
+    @return: data of merged word dictionary
+    '''
+    import importlib
+    WordDictionary = importlib.import_module(
+            'src.bayes.src.worddictionary').WordDictionary
+    result = WordDictionary()
+    result.load_data(first)
+    other = WordDictionary()
+    other.load_data(second)
+    result.merge(other)
+    return result.dump_data()
+
+def rowid_ranges(dbfile, shards):
+    '''
+    Split table docs into shards of equal rowid ranges.
+    @param dbfile: source db file containing table docs
+    @param shards: number of shards
+    @return: list of (first, last) rowid ranges, last rowid is not included
+    '''
+    conn = sqlite3.connect(dbfile)
+    low, high = conn.execute('select min(rowid), max(rowid) from docs').fetchone()
+    conn.close()
+    if low is None:
+        return []
+    size = (high - low) / shards + 1
+    return [(first, min(first + size, high + 1))
+            for first in xrange(low, high + 1, size)]
+
+def merge_tree(dictionaries, backend=None):
+    '''
+    Merge data of many word dictionaries. Dictionaries are merged in pairs
+    in rounds, so with backend the merges of a round run in parallel and only
+    log2(n) rounds are needed.
+    @param dictionaries: list of data of word dictionaries (see
+                         WordDictionary.dump_data())
+    @param backend: execution backend used for merging
+    @return: data of merged word dictionary
+    '''
+    while len(dictionaries) > 1:
+        pairs = zip(dictionaries[::2], dictionaries[1::2])
+        if backend is None:
+            merged = [_thread_merge(first, second) for first, second in pairs]
+        else:
+            jobs = [backend.submit(_thread_merge, pair) for pair in pairs]
+            merged = [job() for job in jobs]
+        # odd dictionary waits for the next round
+        if len(dictionaries) % 2:
+            merged.append(dictionaries[-1])
+        dictionaries = merged
+    if not dictionaries:
+        return WordDictionary().dump_data()
+    return dictionaries[0]
+
+def train_sharded(dbfile, features, max_token_size, shards, backend=None,
+        vocabulary=None):
+    '''
+    Train word dictionary on all annotated entries of database. Entries are
+    partitioned into shards by rowid ranges, partial dictionary of every
+    shard is trained as separate job and the dictionaries are merged by
+    merge_tree(). Duplicate entries are removed only within shards.
+    @param dbfile: source db file containing table docs
+    @param features: features to be used to tokenize entries
+    @param max_token_size: text tokenization parameter
+    @param shards: number of shards
+    @param backend: execution backend used for training and merging
+    @param vocabulary: VocabularyPolicy applied to the merged dictionary
+    @return: WordDictionary object
+    '''
+    logger = logging.getLogger()
+    start = time.time()
+    ranges = rowid_ranges(dbfile, shards)
+    args = [(dbfile, first, last, features, max_token_size)
+            for first, last in ranges]
+    if backend is None:
+        results = [_thread_train_shard(*arg) for arg in args]
+    else:
+        jobs = [backend.submit(_thread_train_shard, arg) for arg in args]
+        results = [job() for job in jobs]
+    logger.info('Trained {0} entries in {1} shards in {2:.2f}s'.format(
+        sum([count for data, count in results]), len(ranges),
+        time.time() - start))
+    start = time.time()
+    word_dict = WordDictionary()
+    word_dict.load_data(merge_tree([data for data, count in results], backend))
+    logger.info('Merged shards in {0:.2f}s'.format(time.time() - start))
+    if vocabulary is not None:
+        word_dict.prune(vocabulary, final=True)
+        vocabulary.log_stats(word_dict.memory_usage()[1], 'Word dictionary')
+    return word_dict
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import struct
+import numpy as np
+
+from scorer import CompiledScorer
+from mappedmodel import token_hash, _align
+
+# file starts with magic string and length of json header
+MAGIC = 'DIPSKTCH'
+VERSION = 1
+# bytes of one cell -- int32 count and float64 weight
+CELL_SIZE = 12
+
+def _token_hashes(tokens):
+    return np.array([token_hash(token) for token in tokens], dtype=np.uint64)
+
+class SketchScorer(CompiledScorer):
+    '''
+    Scorer looking tokens up in Count-Min sketch. Probability of token is
+    weight / count of the cell with the lowest count among cells of the
+    token, unknown tokens (count 0) have probability 0.5.
+    @param sketch: SketchDictionary object
+    @param language: language of classified texts
+    '''
+
+    def __init__(self, sketch, language):
+        self.sketch = sketch
+        self.language = language
+
+    def _ids(self, tokens, ntuples, features):
+        '''
+        Append hashes of tokens to given lists.
+        '''
+        ntuple_count = len(ntuples)
+        feature_count = len(features)
+        for token in tokens:
+            data = token.get_data()
+            if isinstance(data, tuple):
+                ntuples.append(token_hash(data))
+            else:
+                features.append(token_hash(data))
+        return (len(ntuples) - ntuple_count, len(features) - feature_count)
+
+    def _score_ragged(self, hashes, lengths):
+        hashes = np.array(hashes, dtype=np.uint64)
+        counts, weights = self.sketch.estimate_hashes(self.language, hashes)
+        p = np.where(counts > 0, weights / np.maximum(counts, 1),
+                self.UNKNOWN_PROB)
+        documents = self._documents(lengths)
+        with np.errstate(divide='ignore'):
+            log_a = np.bincount(documents, weights=np.log(p),
+                    minlength=len(lengths))
+            log_b = np.bincount(documents, weights=np.log1p(-p),
+                    minlength=len(lengths))
+        return self.combine(log_a, log_b)
+
+
+class SketchDictionary:
+    '''
+    Approximate word dictionary with fixed memory. Counts and weights of
+    tokens of every language are stored in a pair of Count-Min sketches
+    sharing hash functions -- depth rows of width cells, token is added to
+    one cell of every row. Collisions only add to cells, so the cell with the
+    lowest count is the closest one and weight of the token is taken from
+    the same cell. Tokens themselves are not stored, so the dictionary can be
+    trained and used for classification, but not listed.
+    It can be used instead of WordDictionary (see BayesianClassifier).
+    @param width: number of cells of one row
+    @param depth: number of rows (hash functions)
+    '''
+
+    def __init__(self, width=2 ** 20, depth=4):
+        self._logger = logging.getLogger()
+        self.width = width
+        self.depth = depth
+        self.features = None
+        self.max_token_size = None
+        # {language: array (depth, width)}
+        self._counts = {}
+        self._weights = {}
+
+    @classmethod
+    def with_budget(cls, budget, depth=4):
+        '''
+        Create sketch using given number of bytes per language.
+        @param budget: memory budget of one language in bytes
+        @param depth: number of rows
+        @return: SketchDictionary object
+        '''
+        return cls(max(1, budget / (CELL_SIZE * depth)), depth)
+
+    def invalidate(self):
+        '''
+        Sketch is compiled to nothing, scorers read it directly.
+        '''
+        pass
+
+    def _language(self, language):
+        if language not in self._counts:
+            self._counts[language] = np.zeros((self.depth, self.width),
+                    dtype=np.int32)
+            self._weights[language] = np.zeros((self.depth, self.width),
+                    dtype=np.float64)
+        return (self._counts[language], self._weights[language])
+
+    def _cells(self, hashes):
+        '''
+        Calculate cells of hashes in every row by double hashing.
+        @param hashes: numpy array of 64 bit token hashes
+        @return: numpy array (depth, len(hashes)) of cell indexes
+        '''
+        low = hashes & np.uint64(0xffffffff)
+        high = (hashes >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, np.newaxis]
+        return ((low + rows * high) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, language, token, weight, count=1):
+        '''
+        Add occurrence of token to the dictionary.
+        @param language: language of the token
+        @param token: token data (tuple of words or value of feature)
+        @param weight: weight of the occurrence
+        @param count: number of occurrences
+        '''
+        self.add_many(language, [token], [weight], [count])
+
+    def add_many(self, language, tokens, weights, counts):
+        '''
+        Add occurrences of several tokens at once.
+        @param language: language of the tokens
+        @param tokens: list of token data
+        @param weights: weights of the tokens
+        @param counts: numbers of occurrences of the tokens
+        '''
+        if not len(tokens):
+            return
+        sketch_counts, sketch_weights = self._language(language)
+        cells = self._cells(_token_hashes(tokens))
+        counts = np.asarray(counts, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        for row in xrange(self.depth):
+            np.add.at(sketch_counts[row], cells[row], counts)
+            np.add.at(sketch_weights[row], cells[row], weights)
+
+    def estimate_hashes(self, language, hashes):
+        '''
+        Estimate statistics of tokens given by their hashes.
+        @param language: language of the tokens
+        @param hashes: numpy array of token hashes
+        @return: tuple of numpy arrays (counts, weights)
+        '''
+        if language not in self._counts or not len(hashes):
+            return (np.zeros(len(hashes)), np.zeros(len(hashes)))
+        cells = self._cells(hashes)
+        columns = np.arange(len(hashes))
+        counts = self._counts[language][np.arange(self.depth)[:, np.newaxis],
+                cells]
+        best = np.argmin(counts, axis=0)
+        return (counts[best, columns].astype(np.float64),
+                self._weights[language][best, cells[best, columns]])
+
+    def get(self, language, token):
+        '''
+        Get estimated statistics of token.
+        @param language: language of the token
+        @param token: token data
+        @return: tuple (count, weight) or None for unknown token
+        '''
+        counts, weights = self.estimate_hashes(language,
+                _token_hashes([token]))
+        if not counts[0]:
+            return None
+        return (int(counts[0]), weights[0])
+
+    def languages(self):
+        '''
+        @return: list of languages present in the dictionary
+        '''
+        return self._counts.keys()
+
+    def compile(self, language):
+        '''
+        @param language: language of the dictionary
+        @return: SketchScorer object
+        '''
+        return SketchScorer(self, language)
+
+    def merge(self, other):
+        '''
+        Add other sketch of the same shape to this one.
+        @param other: SketchDictionary object
+        '''
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Sketches of different shape can not be merged')
+        for language in other.languages():
+            counts, weights = self._language(language)
+            counts += other._counts[language]
+            weights += other._weights[language]
+
+    def prune(self, policy, final=False):
+        '''
+        Memory of sketch is fixed, nothing is evicted.
+        '''
+        pass
+
+    def decay(self, factor):
+        '''
+        Multiply counts and weights by decay factor, probabilities of cells
+        do not change.
+        @param factor: decay factor
+        @return: number of evicted tokens, always 0
+        '''
+        for language in self.languages():
+            counts = self._counts[language]
+            decayed = np.round(counts * factor)
+            self._weights[language] *= decayed / np.maximum(counts, 1)
+            self._counts[language] = decayed.astype(np.int32)
+        return 0
+
+    def memory_usage(self):
+        '''
+        @return: tuple (number of bytes, number of used cells of the first
+                 rows)
+        '''
+        size = 0
+        used = 0
+        for language in self.languages():
+            size += self._counts[language].nbytes
+            size += self._weights[language].nbytes
+            used += np.count_nonzero(self._counts[language][0])
+        return (size, used)
+
+    def log_memory_usage(self):
+        '''
+        Log memory used by the sketch.
+        '''
+        size, used = self.memory_usage()
+        self._logger.info('Sketch dictionary: {0}x{1} cells per language, {2} bytes, {3:.1f}% of cells used'
+                .format(self.depth, self.width, size, 100.0 * used /
+                    (self.width * len(self.languages()) + 0.0000000000001)))
+
+    @staticmethod
+    def is_sketch(path):
+        '''
+        Check whether file is stored sketch.
+        @param path: path of the model file
+        @return: True if file starts with magic string
+        '''
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return False
+        magic = f.read(len(MAGIC))
+        f.close()
+        return magic == MAGIC
+
+    def store(self, path):
+        '''
+        Store sketch as flat arrays. Header contains feature configuration,
+        max_token_size, shape of sketches and positions of arrays of every
+        language.
+        @param path: path of the model file
+        '''
+        header = {'version':VERSION, 'features':self.features,
+                'max_token_size':self.max_token_size, 'width':self.width,
+                'depth':self.depth, 'languages':{}}
+        sections = []
+        offset = 0
+        for language in self.languages():
+            header['languages'][language] = {}
+            for name, array in (('counts', self._counts[language]),
+                    ('weights', self._weights[language])):
+                header['languages'][language][name] = offset
+                sections.append((offset, array))
+                offset = _align(offset + array.nbytes)
+        header = json.dumps(header)
+        f = open(path, 'wb')
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        start = _align(len(MAGIC) + 4 + len(header))
+        position = len(MAGIC) + 4 + len(header)
+        for offset, array in sections:
+            f.write('\0' * (start + offset - position))
+            f.write(array.astype(array.dtype.newbyteorder('<')).tostring())
+            position = start + offset + array.nbytes
+        f.close()
+
+    def load(self, path):
+        '''
+        Load sketch stored by store().
+        @param path: path of the model file
+        '''
+        f = open(path, 'rb')
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a sketch model'.format(path))
+        length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(length))
+        start = _align(len(MAGIC) + 4 + length)
+        self.features = header['features']
+        self.max_token_size = header['max_token_size']
+        self.width = header['width']
+        self.depth = header['depth']
+        self._counts = {}
+        self._weights = {}
+        shape = (self.depth, self.width)
+        for language, sections in header['languages'].iteritems():
+            f.seek(start + sections['counts'])
+            self._counts[language] = np.fromfile(f, dtype='<i4',
+                    count=self.depth * self.width).reshape(shape)
+            f.seek(start + sections['weights'])
+            self._weights[language] = np.fromfile(f, dtype='<f8',
+                    count=self.depth * self.width).reshape(shape)
+        f.close()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import pickle
+import time
+import uuid
+from array import array
+
+from worddictionary import WordDictionary
+
+class UpdateLog:
+    '''
+    Append-only log of incremental updates of bayesian model. Every update
+    appends word dictionary trained on new entries (delta) together with
+    rowids of these entries. Compaction merges all deltas into the base model
+    and moves their rowids into the set of consumed rows. The base model
+    keeps ids of log records merged into it, so records left in the log by
+    interrupted compaction are never applied twice.
+    Files next to the model:
+        <model>.log -- pickled update records, one after another
+        <model>.rows -- rowids of entries contained in the base model
+    @param path: path of the base model
+    '''
+
+    def __init__(self, path):
+        self._logger = logging.getLogger()
+        self.path = path
+        self.log_path = path + '.log'
+        self.rows_path = path + '.rows'
+
+    def records(self):
+        '''
+        Read records of the log. Incomplete record at the end of the log
+        (interrupted write) is ignored.
+        @return: list of dictionaries with keys 'id', 'time', 'rows',
+                 'dictionary' and 'decay'
+        '''
+        records = []
+        if not os.path.exists(self.log_path):
+            return records
+        f = open(self.log_path, 'rb')
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                break
+            except Exception, ex:
+                self._logger.warning('Incomplete record at the end of {0} ignored: {1}'
+                        .format(self.log_path, ex))
+                break
+        f.close()
+        return records
+
+    def _base_rows(self):
+        rows = array('l')
+        if os.path.exists(self.rows_path):
+            f = open(self.rows_path, 'rb')
+            rows.fromfile(f, os.path.getsize(self.rows_path) / rows.itemsize)
+            f.close()
+        return rows
+
+    def consumed(self):
+        '''
+        @return: set of rowids of entries contained in the model and its log
+        '''
+        rows = set(self._base_rows())
+        for record in self.records():
+            rows.update(record['rows'])
+        return rows
+
+    def has_state(self):
+        '''
+        @return: True if consumed rows of the model are tracked
+        '''
+        return os.path.exists(self.rows_path) or os.path.exists(self.log_path)
+
+    def append(self, word_dict, rows, decay=None):
+        '''
+        Append update to the log. Record is flushed to disk before return.
+        @param word_dict: WordDictionary trained on new entries
+        @param rows: list of rowids of the new entries
+        @param decay: factor counts of the model are decayed by before the
+                      update is applied, None for no decay
+        '''
+        f = open(self.log_path, 'ab')
+        pickle.dump({'id':uuid.uuid4().hex, 'time':time.time(),
+            'rows':array('l', rows), 'dictionary':word_dict.dump_data(),
+            'decay':decay}, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def _pending(self, word_dict, records):
+        '''
+        @return: records which are not merged into word dictionary yet
+        '''
+        merged = set(word_dict.updates)
+        base_rows = None
+        pending = []
+        for record in records:
+            if 'id' in record:
+                if record['id'] not in merged:
+                    pending.append(record)
+                continue
+            # records of older versions are recognized by their rows
+            if base_rows is None:
+                base_rows = set(self._base_rows())
+            if not base_rows.issuperset(record['rows']):
+                pending.append(record)
+        return pending
+
+    def apply(self, word_dict, records=None):
+        '''
+        Merge deltas of the log into word dictionary, records already merged
+        into the base model are skipped.
+        @param word_dict: WordDictionary loaded from the base model
+        @param records: records of the log, read if not given
+        @return: number of applied records
+        '''
+        if records is None:
+            records = self.records()
+        records = self._pending(word_dict, records)
+        for record in records:
+            if record.get('decay') is not None:
+                word_dict.decay(record['decay'])
+            delta = WordDictionary()
+            delta.load_data(record['dictionary'])
+            word_dict.merge(delta)
+        return len(records)
+
+    def compact(self, vocabulary=None):
+        '''
+        Merge all deltas into the base model and clear the log. Renaming of
+        the new model (which keeps ids of all records of the log) commits the
+        compaction, rows file is replaced and the log is removed after that.
+        Interrupted compaction leaves records which are skipped by apply()
+        and their rows are moved to rows file by the next compaction.
+        @param vocabulary: VocabularyPolicy applied to the compacted model
+        @return: number of compacted records
+        '''
+        records = self.records()
+        if not records:
+            return 0
+        word_dict = WordDictionary()
+        word_dict.load(self.path)
+        applied = self.apply(word_dict, records)
+        if vocabulary is not None:
+            word_dict.prune(vocabulary, final=True)
+            vocabulary.log_stats(word_dict.memory_usage()[1], 'Word dictionary')
+        word_dict.updates = [r['id'] for r in records if 'id' in r]
+        rows = array('l', sorted(set(self._base_rows()).union(
+            *[r['rows'] for r in records])))
+        word_dict.store(self.path + '.tmp', sync=True)
+        os.rename(self.path + '.tmp', self.path)
+        self._store_rows(rows)
+        os.remove(self.log_path)
+        self._logger.info('Compacted {0} updates into {1}'.format(applied,
+            self.path))
+        return applied
+
+    def _store_rows(self, rows):
+        '''
+        Replace rows file, the new file is flushed to disk before renaming.
+        @param rows: array of rowids
+        '''
+        f = open(self.rows_path + '.tmp', 'wb')
+        rows.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(self.rows_path + '.tmp', self.rows_path)
+
+    def mark_consumed(self, rows):
+        '''
+        Record rows as contained in the base model without training them,
+        used for models trained before their rows were tracked.
+        @param rows: list of rowids
+        '''
+        self._store_rows(array('l', sorted(set(self._base_rows()).union(rows))))
@@ -1,41 +1,384 @@
 import logging
+import os
 import pickle
+import sys
+from array import array
+
+import numpy as np
+
+from scorer import CompiledScorer, QuantizedScorer
 
 class WordDictionary:
-    '''Class contains probability values of all allready treined tkoens.'''
+    '''
+    Class contains probability values of all allready treined tkoens.
+    Tokens of every language are interned to ids, counts and weights of tokens
+    are stored in parallel arrays indexed by these ids.
+    '''
 
     def __init__(self):
         self._logger = logging.getLogger()
-        self.words = {}
+        # features and tokenization parameter used to train stored model
+        self.features = None
+        self.max_token_size = None
+        self.wipe()
 
     def wipe(self):
-        self.words = {}
+        # {language: {token: id}}
+        self._ids = {}
+        # {language: array of counts}, {language: array of weights}
+        self._counts = {}
+        self._weights = {}
+        # scorers loaded from exported log-odds
+        self._quantized = {}
+        # ids of update log records merged into the model (see UpdateLog)
+        self.updates = []
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Drop compiled scorers, has to be called after words are modified.
+        '''
+        self._compiled = {}
+
+    def _language(self, language):
+        '''
+        Get storage of given language, create it if it does not exist.
+        @param language: language of the dictionary
+        @return: tuple of token to id mapping, counts and weights
+        '''
+        if language not in self._ids:
+            self._ids[language] = {}
+            self._counts[language] = array('i')
+            self._weights[language] = array('d')
+        return (self._ids[language], self._counts[language],
+                self._weights[language])
+
+    def add(self, language, token, weight, count=1):
+        '''
+        Add occurrence of token to the dictionary.
+        @param language: language of the token
+        @param token: token data (tuple of words or value of feature)
+        @param weight: weight of the occurrence
+        @param count: number of occurrences
+        '''
+        if self._quantized:
+            raise ValueError('Dictionary loaded from log-odds can not be trained')
+        if self._compiled:
+            self.invalidate()
+        ids, counts, weights = self._language(language)
+        i = ids.get(token)
+        if i is None:
+            i = ids[token] = len(counts)
+            counts.append(0)
+            weights.append(0.0)
+        counts[i] += count
+        weights[i] += weight
+
+    def add_many(self, language, tokens, weights, counts):
+        '''
+        Add occurrences of several tokens at once, see add().
+        @param language: language of the tokens
+        @param tokens: list of token data
+        @param weights: weights of the tokens
+        @param counts: numbers of occurrences of the tokens
+        '''
+        for token, weight, count in zip(tokens, weights, counts):
+            self.add(language, token, weight, int(count))
+
+    def get(self, language, token):
+        '''
+        Get statistics of token.
+        @param language: language of the token
+        @param token: token data
+        @return: tuple (count, weight) or None for unknown token
+        '''
+        i = self._ids.get(language, {}).get(token)
+        if i is None:
+            return None
+        return (self._counts[language][i], self._weights[language][i])
+
+    def languages(self):
+        '''
+        @return: list of languages present in the dictionary
+        '''
+        return self._ids.keys()
+
+    def tokens(self, language):
+        '''
+        Get tokens of language ordered by their ids.
+        @param language: language of the dictionary
+        @return: list of tokens
+        '''
+        ids = self._ids.get(language, {})
+        tokens = [None] * len(ids)
+        for token, i in ids.iteritems():
+            tokens[i] = token
+        return tokens
+
+    def items(self, language):
+        '''
+        Yield all tokens of language together with their statistics.
+        @param language: language of the dictionary
+        @return: yields tuples (token, count, weight)
+        '''
+        counts = self._counts.get(language, [])
+        weights = self._weights.get(language, [])
+        for token, i in self._ids.get(language, {}).iteritems():
+            yield (token, counts[i], weights[i])
+
+    def probabilities(self, language):
+        '''
+        Get probabilities weight / count of all tokens of language.
+        @param language: language of the dictionary
+        @return: numpy array of probabilities indexed by token ids
+        '''
+        counts = np.frombuffer(self._counts.get(language, array('i')),
+                dtype=np.int32)
+        weights = np.frombuffer(self._weights.get(language, array('d')),
+                dtype=np.float64)
+        return weights / counts
+
+    def compile(self, language):
+        '''
+        Get word dictionary of given language frozen into CompiledScorer.
+        Scorer is cached until the dictionary is modified.
+        @param language: language of the dictionary
+        @return: CompiledScorer object
+        '''
+        if language in self._quantized:
+            return self._quantized[language]
+        if language not in self._compiled:
+            self._compiled[language] = CompiledScorer(
+                    self._ids.get(language, {}), self.probabilities(language))
+        return self._compiled[language]
+
+    def memory_usage(self):
+        '''
+        Estimate memory used by the dictionary. Strings shared by several
+        n-tuples are counted for each of them, so this is an upper estimate.
+        @return: tuple (number of bytes, number of tokens)
+        '''
+        size = 0
+        count = 0
+        for language, ids in self._ids.iteritems():
+            size += sys.getsizeof(ids)
+            for token in ids:
+                size += sys.getsizeof(token)
+                if isinstance(token, tuple):
+                    size += sum([sys.getsizeof(word) for word in token])
+            for values in (self._counts[language], self._weights[language]):
+                size += values.buffer_info()[1] * values.itemsize
+            count += len(ids)
+        return (size, count)
+
+    def log_memory_usage(self):
+        '''
+        Log memory used by the dictionary.
+        '''
+        size, count = self.memory_usage()
+        self._logger.info('Word dictionary: {0} tokens, {1} bytes, {2:.1f} bytes/token'
+                .format(count, size, size / (count + 0.0000000000001)))
 
     def load(self, path):
         '''
-        Load word dictionary from pickle file
+        Load word dictionary from pickle file. Models stored as nested
+        dictionaries and exported log-odds are also accepted.
         @param path: path to pickle file
         '''
         try:
             filehandler = open(path, 'rb')
         except IOError:
-            self._logger.warning('Pickle file ' + self.filename + \
+            self._logger.warning('Pickle file ' + path + \
                     ' does not exist, no previous word dictionaries loaded')
             return
-        self.words = pickle.load(filehandler)
+        self.load_data(pickle.load(filehandler))
+        filehandler.close()
 
-    def store(self, path):
+    def load_data(self, data):
+        '''
+        Load word dictionary from data unpickled from model file or created
+        by dump_data().
+        @param data: dictionary describing the model
+        '''
+        self.wipe()
+        if 'format' not in data:
+            # {language: {token: {'count':int, 'weight':float}}}
+            self.features = data.pop('features', None)
+            self.max_token_size = None
+            for language in data:
+                for token, stats in data[language].iteritems():
+                    self.add(language, token, stats['weight'], stats['count'])
+        elif data['format'] == 'arrays':
+            self.features = data['features']
+            self.max_token_size = data.get('max_token_size')
+            self.updates = data.get('updates', [])
+            for language, (tokens, counts, weights) in \
+                    data['languages'].iteritems():
+                self._ids[language] = dict(zip(tokens, xrange(len(tokens))))
+                self._counts[language] = array('i')
+                self._counts[language].fromstring(counts)
+                self._weights[language] = array('d')
+                self._weights[language].fromstring(weights)
+        elif data['format'] == 'log_odds':
+            self.features = data['features']
+            self.max_token_size = data.get('max_token_size')
+            for language, (tokens, dtype, values, scale) in \
+                    data['languages'].iteritems():
+                self._quantized[language] = QuantizedScorer(
+                        dict(zip(tokens, xrange(len(tokens)))),
+                        np.fromstring(values, dtype=dtype), scale)
+
+    def dump_data(self):
+        '''
+        Get picklable data of word dictionary, see load_data().
+        @return: dictionary describing the model
+        '''
+        languages = {}
+        for language in self._ids:
+            languages[language] = (self.tokens(language),
+                    self._counts[language].tostring(),
+                    self._weights[language].tostring())
+        return {'format':'arrays', 'features':self.features,
+                'max_token_size':self.max_token_size, 'languages':languages,
+                'updates':self.updates}
+
+    def store(self, path, sync=False):
         '''
         Store word dictionary to pickle file
         @param path: path of word dictionary file
+        @param sync: flush the file to disk before return
+        '''
+        filehandler = open(path, 'wb')
+        pickle.dump(self.dump_data(), filehandler, pickle.HIGHEST_PROTOCOL)
+        if sync:
+            filehandler.flush()
+            os.fsync(filehandler.fileno())
+        filehandler.close()
+
+    def merge(self, other):
+        '''
+        Add counts and weights of all tokens of other dictionary to this one.
+        Dictionaries trained on different parts of corpus (or on different
+        days) merged together are equal to dictionary trained on all of them.
+        @param other: WordDictionary object
+        '''
+        if self._quantized or other._quantized:
+            raise ValueError('Dictionary loaded from log-odds can not be merged')
+        for attr in ('features', 'max_token_size'):
+            mine = getattr(self, attr)
+            theirs = getattr(other, attr)
+            if mine is not None and theirs is not None and mine != theirs:
+                raise ValueError('Dictionaries with different {0} can not be merged'
+                        .format(attr))
+        if self.features is None:
+            self.features = other.features
+        if self.max_token_size is None:
+            self.max_token_size = other.max_token_size
+        for language in other.languages():
+            counts = other._counts[language]
+            weights = other._weights[language]
+            for token, i in other._ids[language].iteritems():
+                self.add(language, token, weights[i], counts[i])
+
+    def _retain(self, language, keep, counts, weights):
+        '''
+        Replace tokens of language by selected ones, kept tokens get new ids.
+        @param language: language of the dictionary
+        @param keep: numpy bool array, True for kept tokens
+        @param counts: numpy array of new counts indexed by old ids
+        @param weights: numpy array of new weights indexed by old ids
+        '''
+        tokens = self.tokens(language)
+        kept = np.flatnonzero(keep)
+        self._ids[language] = dict(zip([tokens[i] for i in kept],
+            xrange(len(kept))))
+        self._counts[language] = array('i')
+        self._counts[language].fromstring(
+                counts[kept].astype(np.int32).tostring())
+        self._weights[language] = array('d')
+        self._weights[language].fromstring(
+                weights[kept].astype(np.float64).tostring())
+        self.invalidate()
+
+    def _arrays(self, language):
+        return (np.frombuffer(self._counts[language], dtype=np.int32),
+                np.frombuffer(self._weights[language], dtype=np.float64))
+
+    def prune(self, policy, final=False):
+        '''
+        Evict tokens according to vocabulary policy. Counts of tokens are
+        used as their document frequencies, tokens are rarely repeated within
+        one short text.
+        @param policy: VocabularyPolicy object
+        @param final: training is finished, apply also minimal document
+                      frequency
+        '''
+        if self._quantized:
+            raise ValueError('Dictionary loaded from log-odds can not be pruned')
+        # languages pruned at once are counted as one prune
+        pruned = False
+        for language in self._ids.keys():
+            counts, weights = self._arrays(language)
+            if final or policy.needs_pruning(len(counts)):
+                keep = policy.select(counts, final=final, prune=not pruned)
+                pruned = True
+                if not keep.all():
+                    self._retain(language, keep, counts, weights)
+
+    def decay(self, factor):
+        '''
+        Multiply counts and weights of all tokens by decay factor. Counts are
+        rounded and weights are scaled the same way, so probabilities of
+        tokens do not change. Tokens decayed to zero count are evicted.
+        @param factor: decay factor
+        @return: number of evicted tokens
+        '''
+        if self._quantized:
+            raise ValueError('Dictionary loaded from log-odds can not be decayed')
+        evicted = 0
+        for language in self._ids.keys():
+            counts, weights = self._arrays(language)
+            decayed = np.round(counts * factor)
+            keep = decayed > 0
+            evicted += len(keep) - keep.sum()
+            self._retain(language, keep, decayed,
+                    weights * decayed / np.maximum(counts, 1))
+        return evicted
+
+    def export_log_odds(self, path, dtype='float16'):
+        '''
+        Export quantized log-odds log(p/(1-p)) of all tokens for serving. Such
+        model is smaller and it can be loaded by load() and used for
+        classification, but it can not be trained anymore.
+        @param path: path of exported file
+        @param dtype: 'float16', 'int8' (linear quantization) or 'float32'
         '''
+        languages = {}
+        for language in self._ids:
+            p = self.probabilities(language)
+            with np.errstate(divide='ignore'):
+                log_odds = np.log(p) - np.log1p(-p)
+            scale = 1.0
+            if dtype == 'int8':
+                finite = np.abs(log_odds[np.isfinite(log_odds)])
+                if len(finite):
+                    scale = max(finite.max(), 0.0000000000001) / 127
+                values = np.clip(np.round(log_odds / scale), -127, 127)
+            else:
+                values = log_odds
+            languages[language] = (self.tokens(language), dtype,
+                    values.astype(dtype).tostring(), scale)
         filehandler = open(path, 'wb')
-        pickle.dump(self.words, filehandler)
+        pickle.dump({'format':'log_odds', 'features':self.features,
+            'max_token_size':self.max_token_size, 'languages':languages},
+            filehandler, pickle.HIGHEST_PROTOCOL)
+        filehandler.close()
 
-    def to_xml(self, filename):
+    def to_xml(self, filename, specification=None):
         '''
         Export Word Dictionary object to XML file
         @param filename: word dictionary pickle file
+        @param specification: export only n-tuples containing this word
         '''
         self._logger.info('Generatingdictionary XML sorted by probability to \
                 file: ' + filename + '...')
@@ -49,12 +392,10 @@ class WordDictionary:
             print >> f, '<document ' + 'specification="' + specification + '">'
         print >> f, '<!-- Probability value is only for convenience. \
                 Its value is calculated from probability / count. -->'
-        for language in self.words:
+        for language in self.languages():
             print >> f, '   <bayes_dictionary language="' + language + '">'
-            for token in sorted(self.words[language],
-                    key=lambda x: (self.words[language][x]['weight'] / 
-                        self.words[language][x]['count'],
-                        self.words[language][x]['count']), reverse=True):
+            for token, count, weight in sorted(self.items(language),
+                    key=lambda x: (x[2] / x[1], x[1]), reverse=True):
                 # if specification is entered
                 if specification:
                     contains = False
@@ -64,10 +405,9 @@ class WordDictionary:
                             break
                     if not contains:
                         continue;
-                info = self.words[language][token]
-                probability = round((info['weight'] / info['count']) * 100, 2)
-                print >> f, '       <token weight="' + str(info['weight']) + \
-                        '" count="' + str(info['count']) + '" probability="' + \
+                probability = round((weight / count) * 100, 2)
+                print >> f, '       <token weight="' + str(weight) + \
+                        '" count="' + str(count) + '" probability="' + \
                         str(probability) + '%">'
                 for word in token:
                     print >> f, '           <word>' + word + '</word>'
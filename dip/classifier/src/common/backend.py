@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+import logging
+import socket
+import struct
+import pickle
+import hashlib
+import threading
+import traceback
+import multiprocessing
+import Queue
+
+# default port of tcp workers
+DEFAULT_PORT = 35100
+# profiler of jobs of backends created by create_backend(), None disables
+# profiling (see control.py --profile)
+job_profiler = None
+
+def _digest(data):
+    '''
+    Calculate content hash of a dataset.
+    @param data: any picklable object
+    @return: hex sha1 digest of pickled data
+    '''
+    return hashlib.sha1(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+def _recv_exactly(sock, size):
+    '''
+    Read exactly size bytes from socket.
+    @param sock: connected socket
+    @param size: number of bytes to read
+    @return: received string
+    '''
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Connection closed by peer')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _send(sock, message):
+    '''
+    Send one length prefixed pickled message.
+    @param sock: connected socket
+    @param message: picklable message
+    @return: number of bytes sent
+    '''
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!Q', len(data)))
+    sock.sendall(data)
+    return len(data) + 8
+
+def _recv(sock):
+    '''
+    Receive one length prefixed pickled message.
+    @param sock: connected socket
+    @return: tuple of message and number of received bytes
+    '''
+    size = struct.unpack('!Q', _recv_exactly(sock, 8))[0]
+    return pickle.loads(_recv_exactly(sock, size)), size + 8
+
+def _parse_address(address):
+    '''
+    Convert 'host:port' string into address tuple.
+    @param address: address string, port is optional
+    @return: tuple (host, port)
+    '''
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return (address, DEFAULT_PORT)
+
+
+class DatasetRef():
+    '''
+    Reference to a dataset shared with workers by Backend.share(). Only the
+    content hash travels with jobs, the data itself is sent to each worker
+    only when it is not in its cache. References are resolved only when
+    passed directly as job arguments.
+    '''
+    def __init__(self, digest):
+        self.digest = digest
+    def __str__(self):
+        return 'DatasetRef ({0})'.format(self.digest)
+
+
+class Backend():
+    '''
+    Execution backend interface. Jobs are submitted as a module level function
+    and a tuple of arguments, submit() returns a callable which blocks until
+    the result is available (same as pp jobs).
+    '''
+    def share(self, data):
+        '''
+        Make dataset available to workers.
+        @param data: picklable dataset
+        @return: object to be passed to jobs instead of the data
+        '''
+        return data
+
+    def submit(self, func, args=()):
+        '''
+        Submit job.
+        @param func: module level function to be called
+        @param args: tuple of arguments
+        @return: callable returning result of the job
+        '''
+        raise NotImplementedError
+
+    def destroy(self):
+        '''
+        Release all resources held by the backend.
+        '''
+        pass
+
+
+class PPBackend(Backend):
+    '''
+    Backend running jobs on the parallel python job server. Remote ppservers
+    may be specified, otherwise all local CPUs are used.
+    @param ppservers: tuple of remote ppserver addresses
+    '''
+    def __init__(self, ppservers=()):
+        import pp
+        self.job_server = pp.Server(ppservers=tuple(ppservers))
+        self.job_server.set_ncpus()
+
+    def submit(self, func, args=()):
+        return self.job_server.submit(func, args)
+
+    def destroy(self):
+        self.job_server.destroy()
+
+
+class _TCPJob():
+    '''
+    Result of a job submitted to TCPBackend.
+    '''
+    def __init__(self):
+        self._done = threading.Event()
+        self._status = None
+        self._value = None
+
+    def _finish(self, status, value):
+        self._status = status
+        self._value = value
+        self._done.set()
+
+    def __call__(self):
+        # waiting with timeout keeps main thread interruptible
+        while not self._done.wait(1):
+            pass
+        if self._status == 'error':
+            raise RuntimeError('Remote job failed:\n' + self._value)
+        return self._value
+
+
+class TCPBackend(Backend):
+    '''
+    Coordinator distributing jobs to workers (see serve_worker()) over TCP.
+    Each worker runs one job at a time, idle workers take jobs from a shared
+    queue. Shared datasets are sent only to workers which do not have them
+    in cache yet, so jobs carry just indices and parameters.
+    Messages are pickles, use workers only on trusted networks.
+    @param workers: list of worker addresses -- (host, port) or 'host:port'
+    '''
+    def __init__(self, workers):
+        self._logger = logging.getLogger()
+        self._tasks = Queue.Queue()
+        self._datasets = {}
+        self._lock = threading.Lock()
+        self._alive = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._threads = []
+        for address in workers:
+            if isinstance(address, basestring):
+                address = _parse_address(address)
+            sock = socket.create_connection(address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._alive += 1
+            thread = threading.Thread(target=self._dispatch,
+                    args=(sock, address))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._logger.info('Connected to {0} workers'.format(self._alive))
+
+    def share(self, data):
+        digest = _digest(data)
+        self._datasets[digest] = data
+        return DatasetRef(digest)
+
+    def submit(self, func, args=()):
+        job = _TCPJob()
+        if not self._alive:
+            job._finish('error', 'No worker is available')
+        else:
+            self._tasks.put((job, func, args))
+        return job
+
+    def _count(self, sent=0, received=0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def _dispatch(self, sock, address):
+        '''
+        Dispatcher thread serving one worker connection.
+        @param sock: connected socket
+        @param address: worker address
+        '''
+        # datasets which are known to be cached by the worker
+        cached = set()
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                try:
+                    _send(sock, ('close',))
+                    sock.close()
+                except socket.error:
+                    pass
+                return
+            job, func, args = task
+            try:
+                # upload datasets missing in the worker cache
+                refs = [arg.digest for arg in args
+                        if isinstance(arg, DatasetRef) and arg.digest not in cached]
+                if refs:
+                    self._count(sent=_send(sock, ('missing', refs)))
+                    missing, size = _recv(sock)
+                    self._count(received=size)
+                    for digest in missing:
+                        self._count(sent=_send(sock,
+                            ('put', digest, self._datasets[digest])))
+                    cached.update(refs)
+                # run the job, datasets evicted from the worker cache are
+                # uploaded again once
+                for attempt in xrange(2):
+                    self._count(sent=_send(sock, ('call', func, args)))
+                    (status, value), size = _recv(sock)
+                    self._count(received=size)
+                    if status != 'missing':
+                        break
+                    cached.difference_update(value)
+                    if attempt:
+                        status, value = ('error', 'Datasets {0} do not fit into '
+                                'cache of worker {1}'.format(', '.join(value), address))
+                        break
+                    for digest in value:
+                        self._count(sent=_send(sock,
+                            ('put', digest, self._datasets[digest])))
+                    cached.update(value)
+                job._finish(status, value)
+            except (socket.error, EOFError), ex:
+                self._logger.error('Worker {0} lost: {1}'.format(address, ex))
+                with self._lock:
+                    self._alive -= 1
+                    alive = self._alive
+                if alive:
+                    # let other workers finish the job
+                    self._tasks.put(task)
+                else:
+                    job._finish('error', 'All workers lost')
+                    self._fail_pending()
+                return
+
+    def _fail_pending(self):
+        '''
+        Fail all queued jobs when there is no worker left.
+        '''
+        while True:
+            try:
+                task = self._tasks.get_nowait()
+            except Queue.Empty:
+                return
+            if task is not None:
+                task[0]._finish('error', 'All workers lost')
+
+    def destroy(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._logger.info('{0} bytes sent to workers, {1} bytes received'
+                .format(self.bytes_sent, self.bytes_received))
+
+
+class LocalTCPBackend(TCPBackend):
+    '''
+    TCP backend with workers running as local processes. It uses the same
+    protocol as remote workers, only all of them listen on localhost.
+    @param processes: number of worker processes (number of CPUs by default)
+    '''
+    def __init__(self, processes=None):
+        if not processes:
+            processes = multiprocessing.cpu_count()
+        self._processes = []
+        addresses = []
+        for i in xrange(processes):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_worker,
+                    kwargs={'host':'127.0.0.1', 'port':0, 'report':child_conn})
+            process.daemon = True
+            process.start()
+            # worker reports the port it listens on
+            addresses.append(('127.0.0.1', parent_conn.recv()))
+            self._processes.append(process)
+        TCPBackend.__init__(self, addresses)
+
+    def destroy(self):
+        TCPBackend.destroy(self)
+        for process in self._processes:
+            process.join()
+
+
+def serve_worker(host='127.0.0.1', port=DEFAULT_PORT, cache_size=8, report=None):
+    '''
+    Run TCP worker. Worker serves one coordinator connection at a time and
+    runs its jobs one by one. Datasets received from the coordinator are kept
+    in cache (at most cache_size of them) for following jobs and connections.
+    @param host: interface to listen on
+    @param port: port to listen on, 0 selects free port
+    @param cache_size: maximal number of cached datasets
+    @param report: connection used to report the listening port
+    '''
+    logger = logging.getLogger()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(5)
+    if report is not None:
+        report.send(server.getsockname()[1])
+        report.close()
+    logger.info('Worker listening on {0}:{1}'.format(*server.getsockname()))
+
+    # dataset cache, list keeps order of insertion
+    cache = {}
+    order = []
+    while True:
+        conn, address = server.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.info('Coordinator {0} connected'.format(address))
+        try:
+            while True:
+                message = _recv(conn)[0]
+                if message[0] == 'missing':
+                    _send(conn, [d for d in message[1] if d not in cache])
+                elif message[0] == 'put':
+                    cache[message[1]] = message[2]
+                    order.append(message[1])
+                    if len(order) > cache_size:
+                        del cache[order.pop(0)]
+                elif message[0] == 'call':
+                    func, args = message[1], message[2]
+                    # evicted datasets are uploaded again by the coordinator
+                    missing = [arg.digest for arg in args
+                            if isinstance(arg, DatasetRef) and arg.digest not in cache]
+                    if missing:
+                        _send(conn, ('missing', missing))
+                        continue
+                    args = tuple([cache[arg.digest]
+                        if isinstance(arg, DatasetRef) else arg for arg in args])
+                    try:
+                        _send(conn, ('ok', func(*args)))
+                    except Exception:
+                        _send(conn, ('error', traceback.format_exc()))
+                elif message[0] == 'close':
+                    break
+        except (socket.error, EOFError), ex:
+            logger.warning('Coordinator {0} lost: {1}'.format(address, ex))
+        conn.close()
+        # local workers live only as long as their coordinator
+        if report is not None:
+            break
+    server.close()
+
+def create_backend(name='pp', servers=None, processes=None):
+    '''
+    Create execution backend. Jobs are profiled if profiler of jobs is set
+    (see profiling.ProfilingBackend).
+    @param name: 'pp' (parallel python), 'tcp' (remote tcp workers) or
+            'local' (tcp workers on localhost)
+    @param servers: comma separated 'host:port' list of ppservers or workers
+    @param processes: number of local worker processes
+    @return: Backend object
+    '''
+    addresses = [a.strip() for a in (servers or '').split(',') if a.strip()]
+    if name == 'pp':
+        backend = PPBackend(ppservers=addresses)
+    elif name == 'tcp':
+        backend = TCPBackend(addresses)
+    elif name == 'local':
+        backend = LocalTCPBackend(processes=processes)
+    else:
+        raise ValueError('Unknown backend "{0}"'.format(name))
+    if job_profiler is not None:
+        from profiling import ProfilingBackend
+        return ProfilingBackend(backend, job_profiler)
+    return backend
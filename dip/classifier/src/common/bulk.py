@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import collections
+import json
+import logging
+import multiprocessing
+import sqlite3
+import sys
+import time
+
+from models import load_model
+
+# model of worker process, loaded once by _init_worker()
+_model = None
+
+def _init_worker(spec, svm_max_token_size, cache_size=0, cache_mode='strict',
+        cascade_low=0.2, cascade_high=0.8):
+    global _model
+    _model = load_model(spec, svm_max_token_size, cache_size, cache_mode,
+            cascade_low, cascade_high)[1]
+
+def _counters():
+    '''
+    @return: dictionary of counters of the model of the process -- cache
+             hits and misses, texts escalated by cascade
+    '''
+    counters = {}
+    if _model.cache is not None:
+        counters['hits'] = _model.cache.hits
+        counters['misses'] = _model.cache.misses
+    if _model.kind == 'cascade':
+        counters['escalated'] = _model.escalated
+    return counters
+
+def _classify_chunk(chunk):
+    '''
+    Classify chunk of rows by model of the process.
+    @param chunk: list of (key, lang, text) tuples
+    @return: tuple (keys, numpy array of probabilities, dictionary of
+             increments of counters, see _counters())
+    '''
+    before = _counters()
+    probabilities = _model.classify([row[2] for row in chunk],
+            [row[1] for row in chunk])
+    counters = dict([(name, value - before[name])
+        for name, value in _counters().iteritems()])
+    return ([row[0] for row in chunk], probabilities, counters)
+
+def read_docs(dbfile, where=None, chunk_size=1000):
+    '''
+    Read rows of table docs in chunks ordered by rowid. Every chunk is read
+    by separate query continuing after the last rowid, so no cursor is open
+    while results are written back to the same database.
+    @param dbfile: source db file containing table docs
+    @param where: additional sql condition selecting rows
+    @param chunk_size: number of rows in chunk
+    @return: yields lists of (rowid, lang, text) tuples
+    '''
+    conn = sqlite3.connect(dbfile)
+    query = 'select rowid, lang, text from docs where rowid > ?'
+    if where:
+        query += ' and ({0})'.format(where)
+    query += ' order by rowid limit ?'
+    last = -2 ** 63
+    while True:
+        rows = conn.execute(query, (last, chunk_size)).fetchall()
+        if not rows:
+            break
+        yield rows
+        last = rows[-1][0]
+    conn.close()
+
+def read_jsonl(f, chunk_size=1000):
+    '''
+    Read JSON lines in chunks. Line is object with keys 'text' and optional
+    'id' (line number by default) and 'lang' ('en' by default), lines which
+    are not JSON are taken as plain texts.
+    @param f: input file
+    @param chunk_size: number of rows in chunk
+    @return: yields lists of (id, lang, text) tuples
+    '''
+    chunk = []
+    for i, line in enumerate(f):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = line.decode('utf-8')
+        if not isinstance(message, dict):
+            message = {'text':message}
+        chunk.append((message.get('id', i), message.get('lang', 'en'),
+            message['text']))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DocsWriter:
+    '''
+    Write results into column relevance of table docs. Updates are executed
+    by executemany in transactions of commit_size rows.
+    @param dbfile: db file containing table docs
+    @param commit_size: number of rows in transaction
+    '''
+
+    def __init__(self, dbfile, commit_size=20000):
+        self.conn = sqlite3.connect(dbfile)
+        self.commit_size = commit_size
+        self._pending = []
+
+    def write(self, keys, values):
+        self._pending.extend(zip(values, keys))
+        if len(self._pending) >= self.commit_size:
+            self.flush()
+
+    def flush(self):
+        self.conn.executemany('update docs set relevance=? where rowid=?',
+                self._pending)
+        self.conn.commit()
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class JSONLWriter:
+    '''
+    Write results as JSON lines {"id": key, name: value}. Output file is
+    closed by close() unless it is stdout.
+    @param f: output file
+    @param name: name of the value -- 'probability' or 'label'
+    '''
+
+    def __init__(self, f, name='probability'):
+        self.f = f
+        self.name = name
+
+    def write(self, keys, values):
+        for key, value in zip(keys, values):
+            self.f.write(json.dumps({'id':key, self.name:value}) + '\n')
+
+    def close(self):
+        self.f.flush()
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+def classify_bulk(spec, chunks, writer, workers=None, svm_max_token_size=1,
+        labels=False, cache_size=0, cache_mode='strict', cascade_low=0.2,
+        cascade_high=0.8):
+    '''
+    Classify stream of chunks by model in parallel and write results. Every
+    worker process loads the model once, only a bounded number of chunks is
+    in flight, results are written in input order.
+    @param spec: model specification, see load_model()
+    @param chunks: iterable of lists of (key, lang, text) tuples
+    @param writer: object with methods write(keys, values) and close()
+    @param workers: number of worker processes, all CPUs if None
+    @param svm_max_token_size: tokenization parameter of SVM models
+    @param labels: write labels 1/0 (probability >= 0.5) instead of
+                   probabilities
+    @param cache_size: size of classification cache of every worker, 0
+                       disables caching
+    @param cache_mode: normalization mode of the cache, 'strict' or 'loose'
+    @param cascade_low: lower bayesian threshold of cascade model
+    @param cascade_high: upper bayesian threshold of cascade model
+    @return: number of classified rows
+    '''
+    logger = logging.getLogger()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    start = time.time()
+    count = [0]
+    totals = {}
+
+    def write(result):
+        keys, probabilities, counters = result
+        if labels:
+            values = [int(p >= 0.5) for p in probabilities]
+        else:
+            values = [float(p) for p in probabilities]
+        writer.write(keys, values)
+        count[0] += len(keys)
+        for name, value in counters.iteritems():
+            totals[name] = totals.get(name, 0) + value
+
+    initargs = (spec, svm_max_token_size, cache_size, cache_mode, cascade_low,
+            cascade_high)
+    if workers <= 1:
+        _init_worker(*initargs)
+        for chunk in chunks:
+            write(_classify_chunk(chunk))
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                initargs=initargs)
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_classify_chunk, (chunk,)))
+            if len(pending) >= workers * 4:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+        pool.close()
+        pool.join()
+    writer.close()
+    elapsed = time.time() - start
+    logger.info('Classified {0} rows in {1:.2f}s ({2:.1f} rows/s), {3} workers'
+            .format(count[0], elapsed, count[0] / (elapsed + 0.0000000000001),
+                workers))
+    if 'hits' in totals:
+        logger.info('Classification cache: {0} hits, {1} misses ({2:.1f}% hit rate)'
+                .format(totals['hits'], totals['misses'], 100.0 * totals['hits'] /
+                    (totals['hits'] + totals['misses'] + 0.0000000000001)))
+    if 'escalated' in totals:
+        logger.info('Cascade: {0} of {1} rows escalated to SVM ({2:.1f}%)'
+                .format(totals['escalated'], count[0], 100.0 *
+                    totals['escalated'] / (count[0] + 0.0000000000001)))
+    return count[0]
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import collections
+import hashlib
+import logging
+import re
+import numpy as np
+
+import metrics
+
+_SPACE = re.compile(r'\s+', re.UNICODE)
+_MENTION = re.compile(r'@\w+:?', re.UNICODE)
+_RETWEET = re.compile(r'\brt\b|\bvia(?=\s*@)', re.UNICODE)
+
+def normalize_text(text, mode='strict'):
+    '''
+    Normalize text for duplicate detection. Strict mode only collapses
+    whitespace, so texts with the same normal form are tokenized the same
+    way. Loose mode also ignores case, retweet markers (RT, via) and
+    @mentions, so retweets and the same link sent to different users share
+    one result -- user tag features of the text are then not distinguished.
+    @param text: input text
+    @param mode: 'strict' or 'loose'
+    @return: normalized text
+    '''
+    if mode == 'loose':
+        text = _MENTION.sub(' ', _RETWEET.sub(' ', text.lower()))
+    return _SPACE.sub(' ', text).strip()
+
+def fingerprint(text, language, mode='strict', variant=None):
+    '''
+    @param text: input text
+    @param language: language of the text
+    @param mode: normalization mode, see normalize_text()
+    @param variant: anything else the result depends on (e.g. dictionary of
+                    features used to tokenize the text), None if nothing
+    @return: 16 byte digest of normalized text, language and variant
+    '''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = u'{0}\0{1}'.format(language, normalize_text(text, mode))
+    if variant is not None:
+        if isinstance(variant, dict):
+            # equal dictionaries may differ in order of items
+            variant = sorted(variant.iteritems())
+        text += u'\0' + repr(variant).decode('utf-8')
+    return hashlib.md5(text.encode('utf-8')).digest()
+
+
+class ClassificationCache:
+    '''
+    LRU cache of classification results keyed by fingerprint of normalized
+    text (see fingerprint()). Cached texts are neither tokenized nor scored
+    again, which pays off on tweet streams full of retweets and duplicates.
+    Cache belongs to one model, it has to be cleared when the model changes.
+    Results of the same text classified with different features are told
+    apart by variant of the key.
+    @param max_size: maximal number of cached results
+    @param mode: normalization mode, 'strict' or 'loose'
+    '''
+
+    def __init__(self, max_size=100000, mode='strict'):
+        if mode not in ('strict', 'loose'):
+            raise ValueError('Unknown cache mode "{0}"'.format(mode))
+        self._logger = logging.getLogger()
+        self.max_size = max_size
+        self.mode = mode
+        self._results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def key(self, text, language, variant=None):
+        return fingerprint(text, language, self.mode, variant)
+
+    def get(self, key):
+        '''
+        @param key: fingerprint of text
+        @return: cached result or None
+        '''
+        result = self._results.pop(key, None)
+        if result is None:
+            self.misses += 1
+            metrics.count('cache_misses')
+            return None
+        # reinsert as the most recently used
+        self._results[key] = result
+        self.hits += 1
+        metrics.count('cache_hits')
+        return result
+
+    def put(self, key, result):
+        self._results.pop(key, None)
+        self._results[key] = result
+        while len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    def classify_many(self, texts, languages, classify, variant=None):
+        '''
+        Classify batch of texts, only texts missing in the cache are passed
+        to classify function and every duplicate among them only once.
+        @param texts: list of input texts
+        @param languages: list of languages of the texts
+        @param classify: function (texts, languages) returning sequence of
+                         results
+        @param variant: variant of keys, see fingerprint()
+        @return: numpy array of results
+        '''
+        result = np.zeros(len(texts))
+        # {key: indexes of texts} of texts to be classified
+        missing = collections.OrderedDict()
+        for i, (text, language) in enumerate(zip(texts, languages)):
+            key = self.key(text, language, variant)
+            if key in missing:
+                # duplicate within the batch
+                self.hits += 1
+                metrics.count('cache_hits')
+                missing[key].append(i)
+                continue
+            cached = self.get(key)
+            if cached is None:
+                missing[key] = [i]
+            else:
+                result[i] = cached
+        if missing:
+            first = [indexes[0] for indexes in missing.itervalues()]
+            classified = classify([texts[i] for i in first],
+                    [languages[i] for i in first])
+            for (key, indexes), value in zip(missing.iteritems(), classified):
+                result[indexes] = value
+                self.put(key, float(value))
+        return result
+
+    def clear(self):
+        self._results.clear()
+
+    def hit_rate(self):
+        '''
+        @return: fraction of lookups answered from the cache
+        '''
+        return self.hits / (self.hits + self.misses + 0.0000000000001)
+
+    def log_stats(self, name='Classification cache'):
+        '''
+        Log hit rate and size of the cache.
+        '''
+        self._logger.info('{0}: {1} hits, {2} misses ({3:.1f}% hit rate), {4}/{5} results cached, {6} mode'
+                .format(name, self.hits, self.misses, 100 * self.hit_rate(),
+                    len(self._results), self.max_size, self.mode))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import logging
+import time
+import numpy as np
+
+class CascadeModel:
+    '''
+    Cascade of bayesian and SVM model. Bayesian model decides texts with
+    probability outside of its uncertain band (low, high) outright, only the
+    uncertain texts are escalated to the much more expensive SVM model.
+    Thresholds have the same meaning as in BayesianTest -- probability <= low
+    is irelevant, >= high relevant and anything between unknown.
+    @param bayes: BayesModel object
+    @param svm: SVMModel object
+    @param low: lower threshold of bayesian probability
+    @param high: upper threshold of bayesian probability
+    @param cache: ClassificationCache object or None
+    '''
+
+    kind = 'cascade'
+
+    def __init__(self, bayes, svm, low=0.2, high=0.8, cache=None):
+        self.bayes = bayes
+        self.svm = svm
+        self.low = float(low)
+        self.high = float(high)
+        self.cache = cache
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.texts = 0
+        self.escalated = 0
+        self.bayes_time = 0.0
+        self.svm_time = 0.0
+
+    def classify(self, texts, languages):
+        '''
+        Classify batch of texts.
+        @param texts: list of input texts
+        @param languages: list of languages of the texts
+        @return: numpy array of probabilities, texts decided by SVM have 1.0
+                 or 0.0
+        '''
+        if self.cache is not None:
+            return self.cache.classify_many(texts, languages, self._classify)
+        return self._classify(texts, languages)
+
+    def _classify(self, texts, languages):
+        start = time.time()
+        result = self.bayes.classify(texts, languages)
+        self.bayes_time += time.time() - start
+        uncertain = np.flatnonzero((result > self.low) & (result < self.high))
+        if len(uncertain):
+            start = time.time()
+            result[uncertain] = self.svm.classify([texts[i] for i in uncertain],
+                    [languages[i] for i in uncertain])
+            self.svm_time += time.time() - start
+        self.texts += len(texts)
+        self.escalated += len(uncertain)
+        return result
+
+    def stats(self):
+        '''
+        @return: dictionary with numbers of classified and escalated texts,
+                 fraction of escalated texts and time spent in both models
+        '''
+        return {'texts':self.texts, 'escalated':self.escalated,
+                'escalated_fraction':self.escalated /
+                    (self.texts + 0.0000000000001),
+                'bayes_time':self.bayes_time, 'svm_time':self.svm_time}
+
+    def log_stats(self, name='Cascade'):
+        '''
+        Log fraction of escalated texts.
+        '''
+        s = self.stats()
+        logging.getLogger().info('{0}: {1} of {2} texts escalated to SVM ({3:.1f}%), bayes {4:.2f}s, svm {5:.2f}s'
+                .format(name, s['escalated'], s['texts'],
+                    100 * s['escalated_fraction'], s['bayes_time'],
+                    s['svm_time']))
+
+
+def compare_cascade(cascade, texts, languages, labels, warmup=100):
+    '''
+    Classify texts by bayesian model, SVM model and their cascade and compare
+    accuracy and throughput. Every model first classifies a few texts without
+    measuring, so lazily compiled dictionaries and loaded models do not count
+    to the time of the first one.
+    @param cascade: CascadeModel object
+    @param texts: list of input texts
+    @param languages: list of languages of the texts
+    @param labels: numpy array of human classified labels (True for relevant)
+    @param warmup: number of texts classified by each model before timing
+    @return: list of dictionaries {model, accuracy, time, docs_per_s} for
+             bayes, svm and cascade (with escalated_fraction)
+    '''
+    logger = logging.getLogger()
+    labels = np.asarray(labels, dtype=bool)
+    results = []
+    models = (('bayes', cascade.bayes), ('svm', cascade.svm),
+            ('cascade', cascade))
+    for name, model in models:
+        model.classify(texts[:warmup], languages[:warmup])
+        if getattr(model, 'cache', None) is not None:
+            model.cache.clear()
+    cascade.reset_stats()
+    for name, model in models:
+        start = time.time()
+        probabilities = model.classify(texts, languages)
+        elapsed = time.time() - start
+        result = {'model':name, 'time':elapsed,
+                'accuracy':float(np.mean((probabilities >= 0.5) == labels)),
+                'docs_per_s':len(texts) / (elapsed + 0.0000000000001)}
+        if name == 'cascade':
+            result['escalated_fraction'] = cascade.stats()['escalated_fraction']
+        logger.info('{0}: accuracy {1:.4f}, {2:.1f} docs/s'.format(name,
+            result['accuracy'], result['docs_per_s']))
+        results.append(result)
+    return results
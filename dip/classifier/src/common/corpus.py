@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+import logging
+import multiprocessing
+import numpy as np
+
+from entry import Entry
+import metrics
+
+def _init_worker():
+    '''
+    Initialize tokenization worker. Sentence splitters are loaded once, nltk
+    keeps them cached for all following texts.
+    '''
+    import nltk
+    for language in ('en', 'de', 'cs'):
+        entry = Entry(entry=None, language=language)
+        try:
+            nltk.data.load(entry._splitter())
+        except LookupError:
+            pass
+
+def _tokenize_chunk(args):
+    '''
+    This function tokenizes chunk of rows. Tokens are interned to local ids
+    so that only compact arrays and one copy of every token are sent back.
+    @param args: tuple (rows, features, max_token_size), see tokenize_corpus()
+    @return: tuple (tokens, ids, lengths, tags, tag_ids) -- local token list
+             of (class name, data) tuples, numpy array of token ids, number
+             of tokens of every row, local tag list and numpy array of tag
+             ids (None if features are given)
+    '''
+    rows, features, max_token_size = args
+    tokens, token_ids = [], {}
+    tags, tag_ids = [], {}
+    ids, occurrence_tags, lengths = [], [], []
+    for row in rows:
+        entry = Entry(entry=row[1], language=row[0],
+                max_token_size=max_token_size)
+        if features is None:
+            tagged = entry.get_token_tagged()
+        else:
+            tagged = ((None, token) for token in entry.get_token(features))
+        count = len(ids)
+        for tag, token in tagged:
+            key = (token.__class__.__name__, token.get_data())
+            i = token_ids.get(key)
+            if i is None:
+                i = token_ids[key] = len(tokens)
+                tokens.append(key)
+            ids.append(i)
+            if features is None:
+                t = tag_ids.get(tag)
+                if t is None:
+                    t = tag_ids[tag] = len(tags)
+                    tags.append(tag)
+                occurrence_tags.append(t)
+        lengths.append(len(ids) - count)
+    if features is not None:
+        return (tokens, np.array(ids, dtype=np.int32), lengths, None, None)
+    return (tokens, np.array(ids, dtype=np.int32), lengths, tags,
+            np.array(occurrence_tags, dtype=np.int16))
+
+def tokenize_corpus(rows, features=None, max_token_size=2, workers=None,
+        chunk_size=500):
+    '''
+    Tokenize rows in parallel. Chunks of rows are tokenized by a pool of
+    worker processes, local token ids of every chunk are remapped to global
+    ones, order of rows is preserved. Rows are tokenized in the calling
+    process if only one worker is used or if token cache is enabled (see
+    Entry.token_cache), since cached texts are not worth sending to workers.
+    @param rows: list of (lang, text) tuples
+    @param features: features to be used to tokenize rows, if None all
+                     tokens of all feature variants are used and tagged
+    @param max_token_size: text tokenization parameter
+    @param workers: number of worker processes, all CPUs if None
+    @param chunk_size: maximal number of rows sent to worker at once
+    @return: TokenizedCorpus object
+    '''
+    logger = logging.getLogger()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    chunk_size = max(1, min(chunk_size, len(rows) / (workers * 4) + 1))
+    chunks = [(rows[i:i + chunk_size], features, max_token_size)
+            for i in xrange(0, len(rows), chunk_size)]
+
+    if workers <= 1 or Entry.token_cache is not None:
+        pool = None
+        results = (_tokenize_chunk(chunk) for chunk in chunks)
+    else:
+        logger.info('Tokenizing {0} rows by {1} workers...'.format(len(rows),
+            workers))
+        pool = multiprocessing.Pool(workers, initializer=_init_worker)
+        results = pool.imap(_tokenize_chunk, chunks)
+
+    corpus = TokenizedCorpus(tagged=features is None)
+    with metrics.timer('tokenize'):
+        for result in results:
+            corpus._append(*result)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        corpus._finish()
+    metrics.count('corpus_rows', len(rows))
+    metrics.count('corpus_tokens', len(corpus.ids))
+    return corpus
+
+class TokenizedCorpus:
+    '''
+    Tokens of rows stored as ragged array of token ids.
+    Attributes:
+        tokens -- list of (class name, data) tuples indexed by token ids,
+                  ordered by first occurrence
+        ids -- numpy array of concatenated token ids of all rows
+        offsets -- numpy array of starts of rows in ids followed by its length
+        tags -- list of (feature, variant) tags indexed by tag ids, None for
+                n-tuples (only if rows were tokenized with all features)
+        tag_ids -- numpy array of tag id of every token occurrence
+    @param tagged: whether tags of tokens are stored
+    '''
+
+    def __init__(self, tagged=False):
+        self.tokens = []
+        self.tags = [] if tagged else None
+        self._token_ids = {}
+        self._tag_ids = {}
+        self._ids = []
+        self._tag_arrays = []
+        self._lengths = []
+
+    def _intern(self, values, ids, items):
+        '''
+        Map local values of chunk to global ids.
+        @return: numpy array mapping local ids to global ones
+        '''
+        mapping = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            j = ids.get(value)
+            if j is None:
+                j = ids[value] = len(items)
+                items.append(value)
+            mapping[i] = j
+        return mapping
+
+    def _append(self, tokens, ids, lengths, tags, tag_ids):
+        '''
+        Append tokenized chunk of rows, see _tokenize_chunk().
+        '''
+        mapping = self._intern(tokens, self._token_ids, self.tokens)
+        self._ids.append(mapping[ids] if len(ids) else
+                np.zeros(0, dtype=np.int64))
+        self._lengths.extend(lengths)
+        if self.tags is not None:
+            mapping = self._intern(tags, self._tag_ids, self.tags)
+            self._tag_arrays.append(mapping[tag_ids] if len(tag_ids) else
+                    np.zeros(0, dtype=np.int64))
+
+    def _finish(self):
+        '''
+        Concatenate chunks.
+        '''
+        self.ids = np.concatenate(self._ids or [np.zeros(0, dtype=np.int64)])
+        self.offsets = np.append(0, np.cumsum(self._lengths)).astype(np.int64)
+        if self.tags is not None:
+            self.tag_ids = np.concatenate(self._tag_arrays or
+                    [np.zeros(0, dtype=np.int64)])
+        del self._ids, self._tag_arrays, self._lengths
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        '''
+        @return: numpy array of numbers of tokens of rows
+        '''
+        return np.diff(self.offsets)
+
+    def rows(self):
+        '''
+        @return: numpy array containing row index of every token occurrence
+        '''
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def row(self, i):
+        '''
+        @param i: index of row
+        @return: numpy array of token ids of the row
+        '''
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def is_ntuple(self):
+        '''
+        @return: numpy bool array, True for tokens which are n-tuples
+        '''
+        return np.array([cls == 'Ntuple' for cls, data in self.tokens],
+                dtype=bool)
+
+    def data_ids(self, keys):
+        '''
+        Intern tokens of rows by their data and per row key (e.g. language)
+        into dense ids.
+        @param keys: list of keys of rows
+        @return: tuple (ids, interned) -- numpy array of dense id of every
+                 token occurrence and list of (key, data) tuples indexed
+                 by dense ids
+        '''
+        data_ids = {}
+        data = []
+        token_data = self._intern([d for cls, d in self.tokens], data_ids,
+                data)
+        key_ids = {}
+        key_values = []
+        row_keys = self._intern(keys, key_ids, key_values)
+        size = max(1, len(data))
+        combined = row_keys[self.rows()] * size + token_data[self.ids]
+        unique, ids = np.unique(combined, return_inverse=True)
+        interned = [(key_values[u / size], data[u % size]) for u in unique]
+        return (ids, interned)
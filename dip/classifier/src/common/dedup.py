@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import numpy as np
+
+# modulus of universal hash functions (Mersenne prime 2^31 - 1)
+PRIME = 2 ** 31 - 1
+
+class NearDuplicates:
+    '''
+    Clusters of near-duplicate rows found by NearDuplicateFilter. Every
+    cluster is represented by its first row, the representative gets weight
+    equal to size of the cluster.
+    @param clusters: numpy array containing index of representative of every
+                     row
+    '''
+
+    def __init__(self, clusters):
+        self.clusters = clusters
+        sizes = np.bincount(clusters, minlength=len(clusters))
+        self.representatives = np.flatnonzero(clusters ==
+                np.arange(len(clusters)))
+        self.weights = sizes[self.representatives]
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def row_weights(self):
+        '''
+        @return: numpy array of weights of all rows, collapsed rows have
+                 weight 0
+        '''
+        weights = np.zeros(len(self.clusters), dtype=np.int64)
+        weights[self.representatives] = self.weights
+        return weights
+
+    def log_report(self, name='Corpus'):
+        '''
+        Log number of collapsed rows.
+        '''
+        logging.getLogger().info('{0}: {1} rows collapsed into {2} ({3} near-duplicates removed, largest cluster {4})'
+                .format(name, len(self.clusters), len(self.representatives),
+                    len(self.clusters) - len(self.representatives),
+                    self.weights.max() if len(self.weights) else 0))
+
+    def write_report(self, path, texts):
+        '''
+        Write clusters with more than one row as JSON lines {"size": size,
+        "kept": text, "collapsed": [texts]}, the largest clusters first.
+        @param path: path of the report
+        @param texts: texts of rows
+        '''
+        members = {}
+        for i, representative in enumerate(self.clusters):
+            if i != representative:
+                members.setdefault(representative, []).append(i)
+        f = open(path, 'w')
+        for representative, collapsed in sorted(members.iteritems(),
+                key=lambda item: -len(item[1])):
+            f.write(json.dumps({'size':len(collapsed) + 1,
+                'kept':texts[representative],
+                'collapsed':[texts[i] for i in collapsed]}) + '\n')
+        f.close()
+
+
+class NearDuplicateFilter:
+    '''
+    Finder of near-duplicate rows of tokenized corpus. MinHash signature of
+    every row is computed over ids of its n-tuple tokens (features like
+    sentence count are shared by too many short texts), signatures are split
+    into bands and rows sharing a band are candidates -- locality sensitive
+    hashing finds them without comparing all pairs. Candidate is collapsed into representative of earlier cluster
+    if fraction of equal signature values (estimate of Jaccard similarity of
+    their token sets) reaches threshold. Rows are clustered greedily in their
+    order, so cluster members are always similar to its representative.
+    @param threshold: minimal estimated Jaccard similarity of near-duplicates
+    @param num_perm: number of hash functions of signature
+    @param bands: number of LSH bands, num_perm has to be divisible by it
+    @param seed: seed of hash functions
+    @param report: path of report of collapsed rows, None to disable
+    '''
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=8, seed=1,
+            report=None):
+        if num_perm % bands:
+            raise ValueError('Number of hash functions {0} is not divisible by number of bands {1}'
+                    .format(num_perm, bands))
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.seed = seed
+        self.report = report
+        random = np.random.RandomState(seed)
+        self._a = random.randint(1, PRIME, size=num_perm).astype(np.int64)
+        self._b = random.randint(0, PRIME, size=num_perm).astype(np.int64)
+
+    def signatures(self, corpus):
+        '''
+        Compute MinHash signatures of n-tuples of rows of corpus.
+        @param corpus: TokenizedCorpus object
+        @return: numpy array (len(corpus), num_perm), rows without n-tuples
+                 have all values equal to PRIME
+        '''
+        signatures = np.empty((len(corpus), self.num_perm), dtype=np.int64)
+        signatures.fill(PRIME)
+        ntuple = corpus.is_ntuple()[corpus.ids]
+        lengths = np.bincount(corpus.rows()[ntuple], minlength=len(corpus))
+        nonempty = lengths > 0
+        if not nonempty.any():
+            return signatures
+        starts = (np.cumsum(lengths) - lengths)[nonempty]
+        ids = corpus.ids[ntuple].astype(np.int64)
+        for k in xrange(self.num_perm):
+            values = (self._a[k] * ids + self._b[k]) % PRIME
+            signatures[nonempty, k] = np.minimum.reduceat(values, starts)
+        return signatures
+
+    def find(self, corpus, keys, texts=None):
+        '''
+        Find clusters of near-duplicate rows. Only rows with the same key
+        (e.g. language and label) are collapsed, rows without n-tuples are
+        never collapsed.
+        @param corpus: TokenizedCorpus object
+        @param keys: list of hashable keys of rows
+        @param texts: texts of rows used by report
+        @return: NearDuplicates object
+        '''
+        signatures = self.signatures(corpus)
+        width = self.num_perm / self.bands
+        clusters = np.arange(len(corpus))
+        # {(key, band, band of signature): representative}
+        buckets = {}
+        for i in xrange(len(corpus)):
+            signature = signatures[i]
+            if signature[0] == PRIME:
+                continue
+            bands = [(keys[i], band,
+                signature[band * width:(band + 1) * width].tostring())
+                for band in xrange(self.bands)]
+            for bucket in bands:
+                j = buckets.get(bucket)
+                if j is not None and np.mean(signature == signatures[j]) >= \
+                        self.threshold:
+                    clusters[i] = j
+                    break
+            else:
+                # new representative
+                for bucket in bands:
+                    buckets.setdefault(bucket, i)
+        duplicates = NearDuplicates(clusters)
+        duplicates.log_report()
+        if self.report is not None and texts is not None:
+            duplicates.write_report(self.report, texts)
+        return duplicates
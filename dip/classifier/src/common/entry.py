@@ -1,12 +1,10 @@
 import logging
-import nltk
 import re
-# stemmer
-from nltk.stem.snowball import EnglishStemmer
 #url parser for feature extraction
 from urlparse import urlparse
 # import regexps for feature extraction
 import regexps
+import metrics
 # import feature classes
 from feature import *
 
@@ -16,8 +14,14 @@ class Entry:
     It also provideas all operations on input text (stematization, features
     selection, etc.)
     '''
-    # lemmatizer class member
-    stmr = EnglishStemmer()
+    # lemmatizer class member, nltk is imported when the first text is
+    # tokenized (see _stemmer())
+    stmr = None
+    # name and version of stemmer, part of token cache keys
+    stmr_version = None
+    # persistent token cache (TokenCache) shared by all entries, disabled
+    # if None
+    token_cache = None
 
     def __init__(self, entry, language, id=None, guid=None, label=None, max_token_size=2):
         '''
@@ -124,13 +128,34 @@ class Entry:
         '''
         if not entry:
             return []
+        import nltk
+        tokenizer = nltk.data.load(self._splitter())
+        return tokenizer.tokenize(entry)
+
+    def _splitter(self):
+        '''
+        This method selects sentence splitter according to language of text.
+        @return: nltk resource name of the splitter
+        '''
         if self.language == 'de':
-            tokenizer = nltk.data.load('tokenizers/punkt/german.pickle')
+            return 'tokenizers/punkt/german.pickle'
         elif self.language == 'cs':
-            tokenizer = nltk.data.load('tokenizers/punkt/czech.pickle')
+            return 'tokenizers/punkt/czech.pickle'
         else:
-            tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-        return tokenizer.tokenize(entry)
+            return 'tokenizers/punkt/english.pickle'
+
+    @classmethod
+    def _stemmer(cls):
+        '''
+        Create stemmer shared by all entries on first use.
+        @return: stemmer object
+        '''
+        if Entry.stmr is None:
+            import nltk
+            from nltk.stem.snowball import EnglishStemmer
+            Entry.stmr = EnglishStemmer()
+            Entry.stmr_version = 'snowball-english-' + nltk.__version__
+        return Entry.stmr
 
     def _to_words(self, text):
         '''
@@ -142,10 +167,11 @@ class Entry:
         @return: list of words
         '''
         word_list = []
+        stmr = self._stemmer()
         sentences = self._to_sentences(text)
         for sentence in sentences:
             raw_words = re.split(r'\W+', sentence)
-            words = [self.stmr.stem(word) for word in filter(None, raw_words)]
+            words = [stmr.stem(word) for word in filter(None, raw_words)]
             word_list.append(words)
         return word_list
 
@@ -503,36 +529,90 @@ class Entry:
             formated_date = self._get_formated_date(date)
             yield Date('{2}'.format(*formated_date))
 
+    def _cached_token_tagged(self):
+        '''
+        This method gets all tagged tokens from the token cache, texts which
+        are not cached yet are tokenized and added to the cache.
+        @return: list of tuples ((feature, variant), token)
+        '''
+        self._stemmer()
+        return self.token_cache.get(self.text, self.MAX_TOKEN_SIZE,
+                self._splitter(), self.stmr_version,
+                lambda: list(self._generate_token_tagged()))
+
     def get_token(self, features):
         '''
         This method yields selected tokens - features and n-tuples.
         @param features: dictionary containing chosen features and it's types
         @return: yields tokens
         '''
+        if self.token_cache is not None and self.text:
+            # group cached tokens by tags to keep the original order
+            tokens = {}
+            for tag, token in self._cached_token_tagged():
+                tokens.setdefault(tag, []).append(token)
+            for feature in features:
+                for f in tokens.get((feature, features[feature]), []):
+                    yield f
+            for ntuple in tokens.get(None, []):
+                yield ntuple
+            return
+
         # yield features
+        emitted = 0
         for feature in features:
             if self.features_func[feature][features[feature]]:
                 for f in self.features_func[feature][features[feature]]():
+                    emitted += 1
                     yield f
 
         # yield n-tuples
         for ntuple in self._get_ntuple_token():
+            emitted += 1
             yield ntuple
+        metrics.count('entries_tokenized')
+        metrics.count('tokens_emitted', emitted)
 
     def get_token_all(self):
         '''
         This method yields all possible tokens - features and n-tuples.
         @return: yields tokens
         '''
+        for tag, token in self.get_token_tagged():
+            yield token
+
+    def get_token_tagged(self):
+        '''
+        This method yields all possible tokens together with the feature
+        variant which produced them. Tokens of any feature configuration are
+        the tokens tagged by its variants plus all n-tuples.
+        @return: yields tuples ((feature, variant), token), tag of n-tuples
+                 is None
+        '''
+        if self.token_cache is not None and self.text:
+            return iter(self._cached_token_tagged())
+        return self._generate_token_tagged()
+
+    def _generate_token_tagged(self):
+        '''
+        This method tokenizes text with all feature variants, see
+        get_token_tagged().
+        @return: yields tuples ((feature, variant), token)
+        '''
+        emitted = 0
         for feature in self.features_func_count:
             for i in self.features_func_count[feature]:
                 if self.features_func[feature][i]:
                     for f in self.features_func[feature][i]():
-                        yield f
+                        emitted += 1
+                        yield ((feature, i), f)
 
         # yield n-tuples
         for ntuple in self._get_ntuple_token():
-            yield ntuple
+            emitted += 1
+            yield (None, ntuple)
+        metrics.count('entries_tokenized')
+        metrics.count('tokens_emitted', emitted)
 
     def get_id(self):
         return self.id
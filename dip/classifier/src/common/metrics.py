@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import json
+import re
+import sys
+import time
+
+# Instrumentation of stages of classifiers -- nested timers, counters and
+# gauges of the current process (metrics of worker processes are not
+# collected). Everything is disabled by default, timer() then returns shared
+# context manager doing nothing and count() and gauge() return immediately.
+# Timers are identified by their path ('svm_train/gram'), calls of the same
+# path are accumulated.
+_enabled = False
+# {path: [calls, total, min, max]}
+_timers = {}
+_counters = {}
+_gauges = {}
+# names of running timers
+_stack = []
+
+def enable(enabled=True):
+    '''
+    Enable or disable collecting of metrics.
+    '''
+    global _enabled
+    _enabled = enabled
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    '''
+    Forget all collected metrics.
+    '''
+    _timers.clear()
+    _counters.clear()
+    _gauges.clear()
+    del _stack[:]
+
+
+class _Timer:
+    '''
+    Context manager measuring time of nested stage.
+    @param name: name of stage
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _stack.append(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.start
+        path = '/'.join(_stack)
+        _stack.pop()
+        record = _timers.get(path)
+        if record is None:
+            _timers[path] = [1, elapsed, elapsed, elapsed]
+        else:
+            record[0] += 1
+            record[1] += elapsed
+            record[2] = min(record[2], elapsed)
+            record[3] = max(record[3], elapsed)
+        return False
+
+
+class _NullTimer:
+    '''
+    Timer used when metrics are disabled.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+def timer(name):
+    '''
+    Measure time of stage nested in currently running timers.
+    @param name: name of stage
+    @return: context manager
+    '''
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+def count(name, value=1):
+    '''
+    Increase counter.
+    @param name: name of counter
+    @param value: increment
+    '''
+    if not _enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + value
+
+def gauge(name, value):
+    '''
+    Set gauge to current value.
+    @param name: name of gauge
+    @param value: current value
+    '''
+    if not _enabled:
+        return
+    _gauges[name] = value
+
+def summary():
+    '''
+    @return: dictionary {timers: {path: {calls, total, mean, min, max}},
+             counters: {name: value}, gauges: {name: value}}, times are in
+             seconds
+    '''
+    timers = {}
+    for path, (calls, total, minimum, maximum) in _timers.iteritems():
+        timers[path] = {'calls':calls, 'total':total, 'mean':total / calls,
+                'min':minimum, 'max':maximum}
+    return {'timers':timers, 'counters':dict(_counters),
+            'gauges':dict(_gauges)}
+
+def format_table():
+    '''
+    @return: summary of metrics as text table, nested timers are indented
+    '''
+    lines = ['{0:<50} {1:>8} {2:>10} {3:>10} {4:>10}'.format('timer',
+        'calls', 'total s', 'mean s', 'max s')]
+    # children follow their parent
+    for path in sorted(_timers, key=lambda path: path.split('/')):
+        calls, total, minimum, maximum = _timers[path]
+        name = '  ' * path.count('/') + path.rsplit('/', 1)[-1]
+        lines.append('{0:<50} {1:>8} {2:>10.3f} {3:>10.4f} {4:>10.4f}'.format(
+            name[:50], calls, total, total / calls, maximum))
+    if _counters or _gauges:
+        lines.append('{0:<50} {1:>18}'.format('counter / gauge', 'value'))
+        for name in sorted(_counters):
+            lines.append('{0:<50} {1:>18}'.format(name, _counters[name]))
+        for name in sorted(_gauges):
+            lines.append('{0:<50} {1:>18}'.format(name, _gauges[name]))
+    return '\n'.join(lines)
+
+def _metric_name(name):
+    return 'dip_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+def format_prometheus():
+    '''
+    @return: metrics in Prometheus text exposition format
+    '''
+    lines = []
+    for name, i in (('dip_timer_seconds_total', 1), ('dip_timer_calls_total', 0)):
+        lines.append('# TYPE {0} counter'.format(name))
+        for path in sorted(_timers):
+            lines.append('{0}{{path="{1}"}} {2!r}'.format(name, path,
+                _timers[path][i]))
+    for name in sorted(_counters):
+        lines.append('# TYPE {0}_total counter'.format(_metric_name(name)))
+        lines.append('{0}_total {1}'.format(_metric_name(name),
+            _counters[name]))
+    for name in sorted(_gauges):
+        lines.append('# TYPE {0} gauge'.format(_metric_name(name)))
+        lines.append('{0} {1}'.format(_metric_name(name), _gauges[name]))
+    return '\n'.join(lines) + '\n'
+
+def dump(path, output_format='json'):
+    '''
+    Write collected metrics to file.
+    @param path: output file, - for stdout
+    @param output_format: json (see summary()) or prometheus
+    '''
+    if output_format == 'json':
+        text = json.dumps(summary(), indent=2, sort_keys=True) + '\n'
+    elif output_format == 'prometheus':
+        text = format_prometheus()
+    else:
+        raise ValueError('Unknown metrics format "{0}"'.format(output_format))
+    if path == '-':
+        sys.stdout.write(text)
+        return
+    f = open(path, 'w')
+    f.write(text)
+    f.close()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import logging
+import numpy as np
+
+import feature
+from corpus import tokenize_corpus
+from cache import ClassificationCache
+from cascade import CascadeModel
+
+class BayesModel:
+    '''
+    Stored bayesian model loaded once and used to classify batches of texts.
+    @param path: path of the model (any format accepted by
+                 BayesianClassifier.load_word_dict())
+    @param cache: ClassificationCache object or None
+    '''
+
+    kind = 'bayes'
+
+    def __init__(self, path, cache=None):
+        from ..bayes.bayesian_classifier import BayesianClassifier
+        self.path = path
+        self.cache = cache
+        self.bcl = BayesianClassifier(cache=cache)
+        self.bcl.load_word_dict(path)
+
+    def classify(self, texts, languages):
+        '''
+        Classify batch of texts, texts of every language are scored at once.
+        @param texts: list of input texts
+        @param languages: list of languages of the texts
+        @return: numpy array of probabilities that texts are relevant
+        '''
+        result = np.zeros(len(texts))
+        groups = {}
+        for i, language in enumerate(languages):
+            groups.setdefault(language, []).append(i)
+        for language, indexes in groups.iteritems():
+            result[indexes] = self.bcl.classify_many(
+                    [texts[i] for i in indexes], language,
+                    self.bcl.word_dict.features)
+        return result
+
+
+class SVMModel:
+    '''
+    Stored SVM model loaded once and used to classify batches of texts.
+    Texts are tokenized with all features the same way as training data
+    (see Data) and mapped to columns of token list of the model.
+    @param path: path of the model
+    @param max_token_size: tokenization parameter the model was trained with
+    @param cache: ClassificationCache object or None
+    '''
+
+    kind = 'svm'
+
+    def __init__(self, path, max_token_size=1, cache=None):
+        from ..svm.svm_classifier import SVM
+        self.path = path
+        self.max_token_size = max_token_size
+        self.cache = cache
+        self.svm = SVM(kernel=None, C=None)
+        self.token_list = self.svm.load_model(path)
+        self.columns = dict([(token, i)
+            for i, token in enumerate(self.token_list)])
+
+    def vectorize(self, texts, languages):
+        '''
+        Convert texts to vectors in feature space of the model.
+        @param texts: list of input texts
+        @param languages: list of languages of the texts
+        @return: numpy array (len(texts), len(token_list))
+        '''
+        corpus = tokenize_corpus(zip(languages, texts), None,
+                self.max_token_size, workers=1)
+        # tokens unknown to the model are mapped to extra column
+        unknown = len(self.token_list)
+        mapping = np.array([self.columns.get(
+            getattr(feature, cls)(data).get_data_str(), unknown)
+            for cls, data in corpus.tokens], dtype=np.int64)
+        X = np.zeros((len(texts), unknown + 1))
+        X[corpus.rows(), mapping[corpus.ids]] = 1
+        return X[:, :unknown]
+
+    def classify(self, texts, languages):
+        '''
+        Classify batch of texts, texts found in the cache are not vectorized.
+        @param texts: list of input texts
+        @param languages: list of languages of the texts
+        @return: numpy array, 1.0 for relevant and 0.0 for irelevant texts
+        '''
+        if self.cache is not None:
+            return self.cache.classify_many(texts, languages, self._classify)
+        return self._classify(texts, languages)
+
+    def _classify(self, texts, languages):
+        if not len(texts):
+            return np.zeros(0)
+        return (self.svm.predict(self.vectorize(texts, languages)) > 0) \
+                .astype(np.float64)
+
+
+def load_model(spec, svm_max_token_size=1, cache_size=0, cache_mode='strict',
+        cascade_low=0.2, cascade_high=0.8):
+    '''
+    Load model given by specification '[name=]kind:path', kind is 'bayes',
+    'svm' or 'cascade', name defaults to kind. Path of cascade model is
+    'bayes_path,svm_path'.
+    @param spec: model specification
+    @param svm_max_token_size: tokenization parameter of SVM models
+    @param cache_size: size of classification cache of the model, 0 disables
+                       caching
+    @param cache_mode: normalization mode of the cache, 'strict' or 'loose'
+    @param cascade_low: lower bayesian threshold of cascade models
+    @param cascade_high: upper bayesian threshold of cascade models
+    @return: tuple (name, model)
+    '''
+    name = None
+    if '=' in spec:
+        name, spec = spec.split('=', 1)
+    if ':' not in spec:
+        raise ValueError('Model "{0}" is not in format [name=]kind:path'
+                .format(spec))
+    kind, path = spec.split(':', 1)
+    cache = ClassificationCache(cache_size, cache_mode) if cache_size else None
+    if kind == 'bayes':
+        model = BayesModel(path, cache)
+    elif kind == 'svm':
+        model = SVMModel(path, svm_max_token_size, cache)
+    elif kind == 'cascade':
+        if ',' not in path:
+            raise ValueError('Cascade model "{0}" is not in format bayes_path,svm_path'
+                    .format(path))
+        bayes_path, svm_path = path.split(',', 1)
+        model = CascadeModel(BayesModel(bayes_path),
+                SVMModel(svm_path, svm_max_token_size), cascade_low,
+                cascade_high, cache)
+    else:
+        raise ValueError('Unknown model kind "{0}"'.format(kind))
+    logging.getLogger().info('Loaded {0} model {1}'.format(kind, path))
+    return (name or kind, model)
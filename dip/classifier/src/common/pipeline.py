@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import logging
+import multiprocessing
+import Queue
+import sqlite3
+import threading
+import time
+import traceback
+
+from corpus import TokenizedCorpus, _init_worker, _tokenize_chunk
+
+class StageStats:
+    '''
+    Throughput and backpressure counters of one pipeline stage. Time spent
+    waiting for input means the stage is starved, time spent waiting for
+    space in the output queue means the following stage is the bottleneck.
+    @param name: name of the stage
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = 0
+        self.rows = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def add(self, other):
+        '''
+        Add counters of another instance of the same stage.
+        @param other: StageStats object
+        '''
+        self.chunks += other.chunks
+        self.rows += other.rows
+        self.busy += other.busy
+        self.starved += other.starved
+        self.blocked += other.blocked
+
+    def __str__(self):
+        return '{0:<10} {1:>7} chunks {2:>9} rows {3:>8.2f}s busy {4:>8.2f}s starved {5:>8.2f}s blocked'.format(
+                self.name, self.chunks, self.rows, self.busy, self.starved,
+                self.blocked)
+
+
+def _timed_get(queue, stats, timeout=None):
+    start = time.time()
+    try:
+        return queue.get(timeout=timeout)
+    finally:
+        stats.starved += time.time() - start
+
+def _timed_put(queue, item, stats):
+    start = time.time()
+    queue.put(item)
+    stats.blocked += time.time() - start
+
+def _tokenize_worker(tasks, results, features, max_token_size):
+    '''
+    Tokenizer stage running in separate process. Chunks of rows are taken
+    from tasks queue, tokenized chunks are put to results queue, counters of
+    the worker are sent at the end together with traceback of the error which
+    stopped the worker (None if there was none).
+    '''
+    _init_worker()
+    stats = StageStats('tokenizer')
+    error = None
+    try:
+        while True:
+            task = _timed_get(tasks, stats)
+            if task is None:
+                break
+            seq, rows = task
+            start = time.time()
+            result = _tokenize_chunk(([row[:2] for row in rows], features,
+                max_token_size))
+            meta = [(row[0], row[2]) for row in rows]
+            stats.busy += time.time() - start
+            stats.chunks += 1
+            stats.rows += len(rows)
+            _timed_put(results, (seq, meta, result), stats)
+    except Exception:
+        error = traceback.format_exc()
+    results.put((None, error, stats))
+
+def read_annotated(dbfile, count):
+    '''
+    Read the same amount of relevant and irelevant entries from database.
+    Rows are fetched lazily, relevant entries first.
+    @param dbfile: source db file containing table docs
+    @param count: maximal count of relevant and irelevant entries
+    @return: yields (lang, text, label) tuples, label is 1 for relevant and
+             -1 for irelevant entries
+    '''
+    conn = sqlite3.connect(dbfile)
+    cur = conn.cursor()
+    for annotation in (1, 0):
+        cur.execute('select count(*) from (select distinct lang, text from '
+                'docs where (annotation=?))', (annotation,))
+        count = min(count, cur.fetchone()[0])
+    for annotation, label in ((1, 1), (0, -1)):
+        cur.execute('select distinct lang, text from docs where (annotation=?) '
+                'limit ?', (annotation, count))
+        while True:
+            rows = cur.fetchmany(256)
+            if not rows:
+                break
+            for row in rows:
+                yield (row[0], row[1], label)
+    conn.close()
+
+def run_pipeline(rows, consumer, features=None, max_token_size=2,
+        workers=None, chunk_size=200, queue_size=4):
+    '''
+    Tokenize and consume rows in overlapping stages connected by bounded
+    queues:
+        reader -> tokenizer workers -> counter -> trainer
+    Reader thread splits rows into chunks, tokenizer processes tokenize them,
+    counter thread turns tokenized chunks (in original order) into updates by
+    consumer.count() and trainer applies them by consumer.train() in the
+    calling thread. Only a bounded number of chunks is in flight, so memory
+    does not grow with the size of the corpus.
+    @param rows: iterable of (lang, text, label) tuples
+    @param consumer: object with methods count(corpus, meta) returning an
+                     update, train(update) and finish(); corpus is
+                     TokenizedCorpus of the chunk, meta is list of
+                     (lang, label) of its rows
+    @param features: features to be used to tokenize rows, if None all
+                     tokens of all feature variants are used and tagged
+    @param max_token_size: text tokenization parameter
+    @param workers: number of tokenizer processes, all CPUs if None
+    @param chunk_size: number of rows in chunk
+    @param queue_size: capacity of queues in chunks per worker
+    @return: result of consumer.finish()
+    '''
+    logger = logging.getLogger()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, workers)
+    tasks = multiprocessing.Queue(queue_size * workers)
+    results = multiprocessing.Queue(queue_size * workers)
+    updates = Queue.Queue(queue_size)
+    stats = dict([(name, StageStats(name))
+        for name in ('reader', 'tokenizer', 'counter', 'trainer')])
+    errors = []
+    start = time.time()
+
+    def reader():
+        try:
+            chunk = []
+            seq = 0
+            read_start = time.time()
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    stats['reader'].busy += time.time() - read_start
+                    stats['reader'].chunks += 1
+                    stats['reader'].rows += len(chunk)
+                    _timed_put(tasks, (seq, chunk), stats['reader'])
+                    chunk = []
+                    seq += 1
+                    read_start = time.time()
+            if chunk:
+                stats['reader'].busy += time.time() - read_start
+                stats['reader'].chunks += 1
+                stats['reader'].rows += len(chunk)
+                _timed_put(tasks, (seq, chunk), stats['reader'])
+        except Exception, ex:
+            errors.append(ex)
+        for i in xrange(workers):
+            tasks.put(None)
+
+    def next_result():
+        # killed worker never sends its counters, so exit codes of workers are
+        # checked while waiting
+        while True:
+            try:
+                return _timed_get(results, stats['counter'], timeout=1)
+            except Queue.Empty:
+                for process in processes:
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError('Tokenizer worker {0} exited with code {1}'
+                                .format(process.pid, process.exitcode))
+
+    def counter():
+        try:
+            # tokenized chunks are reordered by their sequence numbers
+            pending = {}
+            expected = 0
+            finished = 0
+            while finished < workers:
+                seq, meta, result = next_result()
+                if seq is None:
+                    stats['tokenizer'].add(result)
+                    if meta is not None:
+                        raise RuntimeError('Tokenizer worker failed:\n' + meta)
+                    finished += 1
+                    continue
+                pending[seq] = (meta, result)
+                while expected in pending:
+                    meta, result = pending.pop(expected)
+                    expected += 1
+                    count_start = time.time()
+                    corpus = TokenizedCorpus(tagged=features is None)
+                    corpus._append(*result)
+                    corpus._finish()
+                    update = consumer.count(corpus, meta)
+                    stats['counter'].busy += time.time() - count_start
+                    stats['counter'].chunks += 1
+                    stats['counter'].rows += len(meta)
+                    _timed_put(updates, (len(meta), update), stats['counter'])
+        except Exception, ex:
+            errors.append(ex)
+        updates.put(None)
+
+    processes = [multiprocessing.Process(target=_tokenize_worker,
+        args=(tasks, results, features, max_token_size))
+        for i in xrange(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    threads = [threading.Thread(target=reader), threading.Thread(target=counter)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # trainer
+    while True:
+        item = _timed_get(updates, stats['trainer'])
+        if item is None:
+            break
+        train_start = time.time()
+        consumer.train(item[1])
+        stats['trainer'].busy += time.time() - train_start
+        stats['trainer'].chunks += 1
+        stats['trainer'].rows += item[0]
+    # counter has finished, reader may still be blocked if counter failed
+    if errors:
+        for process in processes:
+            process.terminate()
+        raise errors[0]
+    for thread in threads:
+        thread.join()
+    for process in processes:
+        process.join()
+
+    elapsed = time.time() - start
+    logger.info('Pipeline processed {0} rows in {1:.2f}s ({2:.1f} rows/s), {3} tokenizer workers'.format(
+        stats['trainer'].rows, elapsed,
+        stats['trainer'].rows / (elapsed + 0.0000000000001), workers))
+    for name in ('reader', 'tokenizer', 'counter', 'trainer'):
+        logger.info(str(stats[name]))
+    return consumer.finish()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import signal
+import StringIO
+
+from backend import Backend
+
+class _ProfileData:
+    '''
+    Holder of stats of cProfile.Profile, pstats.Stats loads stats from it.
+    @param stats: dictionary of stats of cProfile.Profile
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    '''
+    Profiler of the current process. Deterministic profiler (cprofile)
+    records every call, sampling profiler records stack of the main thread
+    whenever the process spends interval of CPU time (SIGPROF), stacks are
+    written in collapsed format of flame graph tools. Profiles of other
+    processes (e.g. jobs of ProfilingBackend) are merged by add().
+    @param mode: 'cprofile' or 'sampling'
+    @param interval: sampling interval in seconds of CPU time
+    '''
+
+    def __init__(self, mode='sampling', interval=0.005):
+        if mode not in ('cprofile', 'sampling'):
+            raise ValueError('Unknown profiler "{0}"'.format(mode))
+        self._logger = logging.getLogger()
+        self.mode = mode
+        self.interval = interval
+        # merged stats of cProfile or {collapsed stack: number of samples}
+        self.stats = None
+        self.samples = {}
+        # number of merged profiles (the process and jobs of workers)
+        self.processes = 0
+        self._profile = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            return
+        try:
+            signal.signal(signal.SIGPROF, self._sample)
+        except ValueError:
+            # signals are handled by the main thread only
+            self._logger.warning('Sampling profiler can run only in the main thread')
+            return
+        # interrupted system calls are restarted
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            self._profile.disable()
+            self._profile.create_stats()
+            self.add(self._profile.stats)
+            self._profile = None
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.processes += 1
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            path = os.path.relpath(code.co_filename)
+            if path.startswith('..'):
+                path = code.co_filename
+            stack.append('{0} ({1}:{2})'.format(code.co_name, path,
+                code.co_firstlineno).replace(';', ':'))
+            frame = frame.f_back
+        stack = ';'.join(reversed(stack))
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def data(self):
+        '''
+        @return: picklable profile of stopped profiler, see add()
+        '''
+        if self.mode == 'cprofile':
+            return self.stats.stats if self.stats is not None else None
+        return self.samples
+
+    def add(self, data):
+        '''
+        Merge profile of another process.
+        @param data: result of data() of profiler with the same mode
+        '''
+        if data is None:
+            return
+        self.processes += 1
+        if self.mode == 'cprofile':
+            import pstats
+            if self.stats is None:
+                self.stats = pstats.Stats(_ProfileData(data))
+            else:
+                self.stats.add(_ProfileData(data))
+            return
+        for stack, count in data.iteritems():
+            self.samples[stack] = self.samples.get(stack, 0) + count
+
+    def report(self, top=30):
+        '''
+        @param top: number of reported functions
+        @return: text report of functions with the highest own time
+        '''
+        if self.mode == 'cprofile':
+            if self.stats is None:
+                return 'No profile recorded'
+            output = StringIO.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats('tottime').print_stats(top)
+            return 'Merged {0} profiles\n{1}'.format(self.processes,
+                    output.getvalue())
+        own = {}
+        total = {}
+        for stack, count in self.samples.iteritems():
+            frames = stack.split(';')
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            # recursive functions are counted once
+            for f in set(frames):
+                total[f] = total.get(f, 0) + count
+        samples = sum(self.samples.itervalues())
+        lines = ['{0} samples ({1:.3f}s of CPU time), merged {2} profiles'.format(
+            samples, samples * self.interval, self.processes),
+            '{0:>8} {1:>7} {2:>8} {3:>7}  {4}'.format('own', 'own %',
+                'total', 'total %', 'function')]
+        for f, count in sorted(own.iteritems(),
+                key=lambda item: -item[1])[:top]:
+            lines.append('{0:>8} {1:>6.1f}% {2:>8} {3:>6.1f}%  {4}'.format(
+                count, 100.0 * count / samples, total[f],
+                100.0 * total[f] / samples, f))
+        return '\n'.join(lines)
+
+    def write(self, prefix, top=30):
+        '''
+        Write merged profile and report. Deterministic profile is written to
+        prefix.pstats (pstats format), samples to prefix.collapsed (input of
+        flamegraph.pl), report to prefix.txt.
+        @param prefix: path prefix of output files
+        @param top: number of reported functions
+        @return: text report, see report()
+        '''
+        if self.mode == 'cprofile':
+            if self.stats is not None:
+                self.stats.dump_stats(prefix + '.pstats')
+        else:
+            f = open(prefix + '.collapsed', 'w')
+            for stack, count in sorted(self.samples.iteritems()):
+                f.write('{0} {1}\n'.format(stack, count))
+            f.close()
+        report = self.report(top)
+        f = open(prefix + '.txt', 'w')
+        f.write(report + '\n')
+        f.close()
+        return report
+
+
+def _profiled_job(module, name, mode, interval, *args):
+    '''
+    Run job under profiler. This is a separate function because of
+    parallelisation restrictions in python.
+    @param module: module of job function
+    @param name: name of job function
+    @param mode: mode of Profiler
+    @param interval: sampling interval of Profiler
+    @param args: arguments of job function
+    @return: tuple (result of job, profile data)
+    '''
+    import importlib
+    profiling = importlib.import_module('src.common.profiling')
+    func = getattr(importlib.import_module(module), name)
+    profiler = profiling.Profiler(mode, interval)
+    profiler.start()
+    try:
+        result = func(*args)
+    finally:
+        profiler.stop()
+    return (result, profiler.data())
+
+
+class _ProfiledJob():
+    '''
+    Result of job submitted to ProfilingBackend, profile of the job is
+    merged when the result is retrieved for the first time.
+    '''
+
+    def __init__(self, job, profiler):
+        self._job = job
+        self._profiler = profiler
+        self._merged = False
+
+    def __call__(self):
+        value = self._job()
+        if value is None:
+            # failed pp job
+            return None
+        result, data = value
+        if not self._merged:
+            self._profiler.add(data)
+            self._merged = True
+        return result
+
+
+class ProfilingBackend(Backend):
+    '''
+    Backend wrapper profiling jobs in worker processes, profiles are sent
+    back together with results of jobs and merged into profiler of the
+    coordinator. Jobs are looked up by module and name in workers, so
+    functions of __main__ are not profiled.
+    @param backend: wrapped Backend object
+    @param profiler: Profiler object
+    '''
+
+    def __init__(self, backend, profiler):
+        self.backend = backend
+        self.profiler = profiler
+
+    def share(self, data):
+        return self.backend.share(data)
+
+    def submit(self, func, args=()):
+        if func.__module__ == '__main__':
+            return self.backend.submit(func, args)
+        # arguments stay flat, shared datasets are resolved by workers
+        return _ProfiledJob(self.backend.submit(_profiled_job,
+            (func.__module__, func.__name__, self.profiler.mode,
+                self.profiler.interval) + tuple(args)), self.profiler)
+
+    def destroy(self):
+        self.backend.destroy()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+import BaseHTTPServer
+import collections
+import json
+import logging
+import os
+import Queue
+import signal
+import SocketServer
+import sys
+import threading
+import time
+import numpy as np
+
+class _Request:
+    '''
+    Texts waiting for classification by one model.
+    '''
+
+    def __init__(self, model, texts, languages):
+        self.model = model
+        self.texts = texts
+        self.languages = languages
+        self.arrived = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ServerStats:
+    '''
+    Latency and throughput counters of classification server. Latencies of
+    the last window requests are kept for percentiles.
+    @param window: number of latencies kept
+    '''
+
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add_batch(self, requests):
+        now = time.time()
+        with self._lock:
+            self.batches += 1
+            for request in requests:
+                self.requests += 1
+                self.texts += len(request.texts)
+                self.latencies.append(now - request.arrived)
+                if request.error is not None:
+                    self.errors += 1
+
+    def summary(self):
+        '''
+        @return: dictionary with p50/p99 latency in milliseconds, throughput
+                 in texts per second and counters
+        '''
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000
+            uptime = time.time() - self.started
+            return {'requests':self.requests, 'texts':self.texts,
+                    'batches':self.batches, 'errors':self.errors,
+                    'uptime':uptime,
+                    'throughput':self.texts / (uptime + 0.0000000000001),
+                    'mean_batch':self.texts / (self.batches + 0.0000000000001),
+                    'p50_ms':float(np.percentile(latencies, 50))
+                        if len(latencies) else 0.0,
+                    'p99_ms':float(np.percentile(latencies, 99))
+                        if len(latencies) else 0.0}
+
+
+class ClassificationServer:
+    '''
+    Server classifying texts by models loaded once. Requests of all clients
+    are collected into micro-batches -- batch is classified when it contains
+    max_batch texts or when its oldest request has waited max_delay seconds,
+    so queueing adds at most max_delay to latency while throughput of
+    batched classification is kept under load. Texts of one model in batch
+    are classified by one call of its classify() method.
+    Requests are accepted over localhost HTTP (POST /classify, GET /stats)
+    and over Unix socket (one JSON request per line, one JSON response per
+    line, request {"stats": true} returns statistics).
+    Request: {"model": name, "texts": [...], "language": "en"} or
+    {"model": name, "text": "..."}, model may be omitted if only one model is
+    loaded. Response: {"probabilities": [...]} or {"error": message}.
+    @param models: dictionary {name: model}, model has method
+                   classify(texts, languages) and attribute kind
+    @param max_batch: maximal number of texts in batch
+    @param max_delay: maximal waiting time of request in batch in seconds
+    '''
+
+    def __init__(self, models, max_batch=256, max_delay=0.01):
+        self._logger = logging.getLogger()
+        self.models = models
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = ServerStats()
+        self._queue = Queue.Queue()
+        self._servers = []
+        self._running = True
+
+    def submit(self, model, texts, languages):
+        '''
+        Classify texts by model, blocks until the batch containing them is
+        classified.
+        @param model: name of the model, None if only one model is loaded
+        @param texts: list of input texts
+        @param languages: list of languages of the texts
+        @return: list of probabilities
+        '''
+        if model is None and len(self.models) == 1:
+            model = self.models.keys()[0]
+        if model not in self.models:
+            raise ValueError('Unknown model "{0}"'.format(model))
+        request = _Request(model, texts, languages)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def handle(self, message):
+        '''
+        Handle decoded JSON request.
+        @param message: request dictionary
+        @return: response dictionary
+        '''
+        try:
+            if message.get('stats'):
+                return self.summary()
+            if 'texts' in message:
+                texts = message['texts']
+            else:
+                texts = [message['text']]
+            languages = message.get('languages') or \
+                    [message.get('language', 'en')] * len(texts)
+            if len(languages) != len(texts):
+                raise ValueError('{0} languages given for {1} texts'.format(
+                    len(languages), len(texts)))
+            return {'probabilities':list(self.submit(message.get('model'),
+                texts, languages))}
+        except Exception, ex:
+            return {'error':str(ex)}
+
+    def summary(self):
+        '''
+        @return: statistics of the server (see ServerStats.summary()) with
+                 hit rates of classification caches of models
+        '''
+        summary = self.stats.summary()
+        summary['cache'] = dict([(name, {'hits':model.cache.hits,
+            'misses':model.cache.misses, 'hit_rate':model.cache.hit_rate(),
+            'size':len(model.cache)})
+            for name, model in self.models.iteritems()
+            if getattr(model, 'cache', None) is not None])
+        summary['cascade'] = dict([(name, model.stats())
+            for name, model in self.models.iteritems()
+            if model.kind == 'cascade'])
+        return summary
+
+    def _batcher(self):
+        '''
+        Collect requests into batches and classify them.
+        '''
+        while self._running:
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except Queue.Empty:
+                continue
+            size = len(batch[0].texts)
+            deadline = batch[0].arrived + self.max_delay
+            while size < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            self._classify(batch)
+
+    def _classify(self, batch):
+        groups = {}
+        for request in batch:
+            groups.setdefault(request.model, []).append(request)
+        for model, requests in groups.iteritems():
+            texts = []
+            languages = []
+            for request in requests:
+                texts.extend(request.texts)
+                languages.extend(request.languages)
+            try:
+                result = self.models[model].classify(texts, languages)
+                position = 0
+                for request in requests:
+                    request.result = [float(p) for p in
+                            result[position:position + len(request.texts)]]
+                    position += len(request.texts)
+            except Exception, ex:
+                self._logger.exception('Classification by {0} failed'.format(model))
+                for request in requests:
+                    request.error = ex
+        self.stats.add_batch(batch)
+        for request in batch:
+            request.done.set()
+
+    def serve(self, http_port=None, socket_path=None, report_interval=60):
+        '''
+        Serve requests until interrupted (SIGINT or SIGTERM).
+        @param http_port: port of HTTP server on localhost, None to disable
+        @param socket_path: path of Unix socket, None to disable
+        @param report_interval: interval of logging statistics in seconds
+        '''
+        batcher = threading.Thread(target=self._batcher)
+        batcher.daemon = True
+        batcher.start()
+        if http_port is not None:
+            server = _HTTPServer(('127.0.0.1', http_port), _HTTPHandler)
+            server.classification = self
+            self._servers.append(server)
+            self._logger.info('Serving HTTP on 127.0.0.1:{0}'.format(
+                server.server_address[1]))
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = _UnixServer(socket_path, _UnixHandler)
+            server.classification = self
+            self._servers.append(server)
+            self._logger.info('Serving Unix socket {0}'.format(socket_path))
+        threads = [threading.Thread(target=s.serve_forever)
+                for s in self._servers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while threads:
+                time.sleep(report_interval)
+                self.log_stats()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        self.shutdown()
+        batcher.join()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    def shutdown(self):
+        '''
+        Stop servers and batcher.
+        '''
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        self._running = False
+        self.log_stats()
+
+    def log_stats(self):
+        '''
+        Log latency and throughput counters.
+        '''
+        s = self.stats.summary()
+        self._logger.info('Served {0} requests ({1} texts) in {2} batches, p50 {3:.1f} ms, '
+                'p99 {4:.1f} ms, {5:.1f} texts/s, {6} errors'.format(
+                    s['requests'], s['texts'], s['batches'], s['p50_ms'],
+                    s['p99_ms'], s['throughput'], s['errors']))
+        for name, model in self.models.iteritems():
+            if getattr(model, 'cache', None) is not None:
+                model.cache.log_stats('Classification cache of {0}'.format(name))
+            if model.kind == 'cascade':
+                model.log_stats('Cascade {0}'.format(name))
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, code, response):
+        data = json.dumps(response)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._respond(200, self.server.classification.summary())
+        else:
+            self._respond(404, {'error':'Unknown path'})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self._respond(404, {'error':'Unknown path'})
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            message = json.loads(self.rfile.read(length))
+        except ValueError, ex:
+            self._respond(400, {'error':str(ex)})
+            return
+        response = self.server.classification.handle(message)
+        self._respond(400 if 'error' in response else 200, response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _UnixHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                response = self.server.classification.handle(json.loads(line))
+            except ValueError, ex:
+                response = {'error':str(ex)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import itertools
+import logging
+import sqlite3
+import numpy as np
+
+# fractions of texts containing each feature, measured by regexps of
+# regexps.py on data/tweets/annotated.db (4362 texts)
+DENSITIES = {'url':0.298, 'email':0.0, 'emoticon':0.073, 'tag':0.153,
+        'user_tag':0.391, 'time':0.001, 'date':0.003}
+
+SYLLABLES = [c + v for c in 'bcdfghjklmnprstvz' for v in 'aeiou']
+EMOTICONS = [':)', ':-)', ':D', ';)', ':(', ':-(', ':P', ':/', '<3', '^_^',
+        'o.O', ':o']
+DOMAINS = ['com', 'org', 'net', 'cz', 'de']
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'oct',
+        'nov', 'dec']
+
+class SyntheticCorpus:
+    '''
+    Generator of synthetic annotated corpora for scaling tests. Texts are
+    sequences of made up words with Zipf distribution, features (urls,
+    emails, emoticons, tags, user tags, times and dates) are inserted in the
+    form matched by regexps. Label correlation is probability that a word
+    (or tag) is drawn from topic words of the label of the text instead of
+    the shared vocabulary, so 0 generates texts independent of their labels.
+    The same seed always generates the same corpus.
+    @param vocabulary: number of shared words
+    @param topic_words: number of topic words of each label
+    @param correlation: label correlation strength (0 to 1)
+    @param relevant: fraction of relevant texts
+    @param densities: dictionary {feature: fraction of texts containing it},
+                      missing features have density of DENSITIES
+    @param min_words: minimal number of words of text
+    @param max_words: maximal number of words of text
+    @param zipf: exponent of Zipf distribution of shared words
+    @param language: language of texts
+    @param seed: seed of random generator
+    '''
+
+    def __init__(self, vocabulary=10000, topic_words=200, correlation=0.2,
+            relevant=0.25, densities=None, min_words=5, max_words=26,
+            zipf=1.1, language='en', seed=1):
+        self._logger = logging.getLogger()
+        if not 0 <= correlation <= 1:
+            raise ValueError('Label correlation {0} is not between 0 and 1'
+                    .format(correlation))
+        self.vocabulary = vocabulary
+        self.topic_words = topic_words
+        self.correlation = correlation
+        self.relevant = relevant
+        self.densities = dict(DENSITIES)
+        for feature, density in (densities or {}).iteritems():
+            if feature not in DENSITIES:
+                raise ValueError('Unknown feature "{0}"'.format(feature))
+            if not 0 <= density <= 1:
+                raise ValueError('Density {0} of feature "{1}" is not between 0 and 1'
+                        .format(density, feature))
+            self.densities[feature] = density
+        self.min_words = min_words
+        self.max_words = max_words
+        self.language = language
+        self.seed = seed
+        self._random = np.random.RandomState(seed)
+        # shared words, topic words of relevant and of irelevant texts
+        self.words = self._generate_words(vocabulary + 2 * topic_words)
+        ranks = np.arange(1, vocabulary + 1, dtype=np.float64)
+        self._cdf = np.cumsum(ranks ** -zipf)
+        self._cdf /= self._cdf[-1]
+
+    def _generate_words(self, count):
+        '''
+        @return: numpy array of count distinct made up words
+        '''
+        words = []
+        seen = set()
+        while len(words) < count:
+            word = ''.join([SYLLABLES[i] for i in self._random.randint(0,
+                len(SYLLABLES), self._random.randint(1, 5))])
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        return np.array(words, dtype=object)
+
+    def _draw_words(self, labels):
+        '''
+        Draw word of every label, topical words with probability of label
+        correlation.
+        @param labels: numpy array of booleans (True for relevant)
+        @return: numpy array of words
+        '''
+        count = len(labels)
+        ids = np.minimum(np.searchsorted(self._cdf, self._random.rand(count)),
+                self.vocabulary - 1)
+        topical = self._random.rand(count) < self.correlation
+        topic = self.vocabulary + np.where(labels, 0, self.topic_words) + \
+                self._random.randint(0, max(self.topic_words, 1), count)
+        if self.topic_words:
+            ids = np.where(topical, topic, ids)
+        return self.words[ids]
+
+    def _feature(self, name):
+        '''
+        @return: random text of feature matched by its regexp
+        '''
+        random = self._random
+        word = lambda: self.words[random.randint(0, self.vocabulary)]
+        if name == 'url':
+            return 'http://www.{0}.{1}/{2}'.format(word(),
+                    DOMAINS[random.randint(len(DOMAINS))], word())
+        if name == 'email':
+            return '{0}@{1}.{2}'.format(word(), word(),
+                    DOMAINS[random.randint(len(DOMAINS))])
+        if name == 'emoticon':
+            return EMOTICONS[random.randint(len(EMOTICONS))]
+        if name == 'user_tag':
+            return '@' + word()
+        if name == 'time':
+            return '{0:02d}:{1:02d}'.format(random.randint(24),
+                    random.randint(60))
+        if name == 'date':
+            if random.rand() < 0.5:
+                return '{0}/{1}/{2}'.format(random.randint(1, 29),
+                        random.randint(1, 13), random.randint(2000, 2012))
+            return '{0} {1} {2}'.format(random.randint(1, 29),
+                    MONTHS[random.randint(len(MONTHS))],
+                    random.randint(2000, 2012))
+        raise ValueError('Unknown feature "{0}"'.format(name))
+
+    def generate(self, count, chunk_size=10000):
+        '''
+        Generate annotated texts.
+        @param count: number of texts
+        @param chunk_size: number of texts generated at once
+        @return: yields (lang, text, annotation) tuples, text is unicode (as
+                 read from database), annotation is 1 for relevant and 0 for
+                 irelevant texts
+        '''
+        features = sorted(self.densities)
+        for start in xrange(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+            labels = self._random.rand(size) < self.relevant
+            lengths = self._random.randint(self.min_words, self.max_words + 1,
+                    size)
+            words = self._draw_words(np.repeat(labels, lengths))
+            # hashtags are topical the same way as words
+            tags = ['#' + w for w in self._draw_words(labels)]
+            present = self._random.rand(len(features), size) < \
+                    np.array([self.densities[f] for f in features])[:, None]
+            offsets = np.cumsum(lengths) - lengths
+            for i in xrange(size):
+                text = list(words[offsets[i]:offsets[i] + lengths[i]])
+                # sentences end with a dot
+                text[-1] += '.'
+                if lengths[i] > 6:
+                    text[lengths[i] / 2] += '.'
+                for j, feature in enumerate(features):
+                    if present[j, i]:
+                        token = tags[i] if feature == 'tag' else \
+                                self._feature(feature)
+                        # regexps of emoticons and emails need whitespace
+                        # around, so features are inserted between words
+                        text.insert(self._random.randint(1,
+                            max(len(text), 2)), token)
+                yield (self.language, u' '.join(text), int(labels[i]))
+
+    def write(self, dbfile, count, chunk_size=10000, append=False):
+        '''
+        Write annotated texts to table docs (schema of annotated databases)
+        of database, the table is created if it does not exist.
+        @param dbfile: path of database
+        @param count: number of texts
+        @param chunk_size: number of texts generated and inserted at once
+        @param append: append texts to non-empty table, otherwise ValueError
+                       is raised for it
+        '''
+        conn = sqlite3.connect(dbfile)
+        conn.text_factory = str
+        cur = conn.cursor()
+        cur.execute('create table if not exists docs (lang varchar(2), '
+                'relevance double, text text, annotation default NULL)')
+        if not append and cur.execute('select 1 from docs limit 1').fetchone():
+            conn.close()
+            raise ValueError('Table docs of {0} is not empty'.format(dbfile))
+        rows = self.generate(count, chunk_size)
+        written = 0
+        while written < count:
+            chunk = list(itertools.islice(rows, chunk_size))
+            cur.executemany('insert into docs (lang, text, annotation) '
+                    'values (?, ?, ?)', chunk)
+            conn.commit()
+            written += len(chunk)
+            self._logger.info('{0} of {1} synthetic texts written'.format(
+                written, count))
+        conn.close()
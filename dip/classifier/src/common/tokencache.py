@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import time
+from array import array
+
+import feature
+
+class TokenCache:
+    '''
+    Persistent cache of tokenized texts stored in sqlite database. Texts are
+    cached with tokens of all feature variants (see Entry.get_token_tagged())
+    so any feature configuration can be served from the cache.
+    Key of cached text is (sha1(text), max_token_size, sentence splitter,
+    stemmer version), value is compact array of token ids and array of tag
+    ids. Tokens and tags themselves are stored only once in their own tables.
+    Cache is used only by the process which opened it (not by its forked
+    children), but several runs may share the cache file -- added texts are
+    kept in memory and written in one short exclusive transaction, ids of new
+    tokens and tags are assigned by sqlite after loading the ones added by
+    other runs.
+    @param path: path of sqlite database file
+    @param commit_interval: number of added texts after which changes are
+                            commited
+    '''
+
+    def __init__(self, path, commit_interval=1000):
+        self._logger = logging.getLogger()
+        self.path = path
+        self.commit_interval = commit_interval
+        self._pid = os.getpid()
+        # other runs hold the database locked only while committing
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.text_factory = str
+        # transactions are started explicitly
+        self._conn.isolation_level = None
+        cur = self._conn.cursor()
+        cur.execute('create table if not exists texts (digest text, '
+                'max_token_size integer, splitter text, stemmer text, '
+                'tokens blob, tags blob, '
+                'primary key (digest, max_token_size, splitter, stemmer))')
+        cur.execute('create table if not exists tokens (id integer primary key, '
+                'class text, data blob)')
+        cur.execute('create table if not exists tags (id integer primary key, '
+                'feature text, variant integer)')
+        cur.execute('create table if not exists stats (name text primary key, '
+                'value real)')
+        # tokens and tags indexed by ids and their reverse mapping, ids grow
+        # so rows added later by other runs are those with greater ids
+        self._tokens = {}
+        self._token_ids = {}
+        self._last_token = -1
+        self._tags = {}
+        self._tag_ids = {}
+        self._last_tag = -1
+        self._load_new()
+        # tokenization time of all texts ever added, used to estimate
+        # time saved by hits
+        stats = dict(cur.execute('select name, value from stats'))
+        self._total_time = stats.get('tokenize_time', 0.0)
+        self._total_count = stats.get('tokenize_count', 0.0)
+        # {key: tagged tokens} of texts not written yet and their stats
+        self._pending = {}
+        self._pending_time = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.hit_time = 0.0
+        self.miss_time = 0.0
+
+    def _token_key(self, token):
+        data = token.get_data()
+        return (token.__class__.__name__, type(data).__name__, data)
+
+    def _load_new(self):
+        '''
+        Load tokens and tags added to the database since the last call.
+        '''
+        for i, cls, data in self._conn.execute('select id, class, data from '
+                'tokens where id > ? order by id', (self._last_token,)):
+            token = getattr(feature, cls)(pickle.loads(str(data)))
+            self._tokens[i] = token
+            self._token_ids[self._token_key(token)] = i
+            self._last_token = i
+        for i, name, variant in self._conn.execute('select id, feature, '
+                'variant from tags where id > ? order by id', (self._last_tag,)):
+            tag = None if name is None else (name, variant)
+            self._tags[i] = tag
+            self._tag_ids[tag] = i
+            self._last_tag = i
+
+    def _id(self, token):
+        '''
+        Get id of token, add it to the cache if it is not there. Called only
+        within transaction of commit().
+        '''
+        key = self._token_key(token)
+        i = self._token_ids.get(key)
+        if i is None:
+            i = self._conn.execute('insert into tokens (class, data) values (?, ?)',
+                    (key[0], buffer(pickle.dumps(token.get_data(),
+                        pickle.HIGHEST_PROTOCOL)))).lastrowid
+            self._tokens[i] = token
+            self._token_ids[key] = i
+            self._last_token = i
+        return i
+
+    def _tag_id(self, tag):
+        '''
+        Get id of tag, add it to the cache if it is not there. Called only
+        within transaction of commit().
+        '''
+        i = self._tag_ids.get(tag)
+        if i is None:
+            i = self._conn.execute('insert into tags (feature, variant) values (?, ?)',
+                    (tag and tag[0], tag and tag[1])).lastrowid
+            self._tags[i] = tag
+            self._tag_ids[tag] = i
+            self._last_tag = i
+        return i
+
+    def get(self, text, max_token_size, splitter, stemmer, tokenize):
+        '''
+        Get tagged tokens of text. Tokens of texts which are not cached yet
+        are obtained by given function and added to the cache.
+        @param text: input text
+        @param max_token_size: text tokenization parameter
+        @param splitter: name of sentence splitter used for text
+        @param stemmer: name and version of used stemmer
+        @param tokenize: function returning list of (tag, token) tuples
+        @return: list of (tag, token) tuples
+        '''
+        # forked processes must not use connection of their parent
+        if os.getpid() != self._pid:
+            return tokenize()
+        start = time.time()
+        if isinstance(text, unicode):
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        else:
+            digest = hashlib.sha1(text).hexdigest()
+        key = (digest, max_token_size, splitter, stemmer)
+        result = self._pending.get(key)
+        if result is not None:
+            self.hits += 1
+            self.hit_time += time.time() - start
+            return result
+        row = self._conn.execute('select tokens, tags from texts where '
+                'digest=? and max_token_size=? and splitter=? and stemmer=?',
+                key).fetchone()
+        if row is not None:
+            ids = array('I')
+            ids.fromstring(str(row[0]))
+            tag_ids = array('H')
+            tag_ids.fromstring(str(row[1]))
+            tokens, tags = self._tokens, self._tags
+            if ids and (max(ids) > self._last_token or
+                    max(tag_ids) > self._last_tag):
+                # text added by another run
+                self._load_new()
+            result = [(tags[t], tokens[i]) for i, t in zip(ids, tag_ids)]
+            self.hits += 1
+            self.hit_time += time.time() - start
+            return result
+
+        result = tokenize()
+        elapsed = time.time() - start
+        self._pending[key] = result
+        self.misses += 1
+        self.miss_time += elapsed
+        self._total_time += elapsed
+        self._total_count += 1
+        self._pending_time += elapsed
+        if len(self._pending) >= self.commit_interval:
+            self.commit()
+        return result
+
+    def commit(self):
+        '''
+        Write added texts to the database. The database is locked for writing
+        first, so tokens and tags added by other runs get known before new
+        ones are inserted.
+        '''
+        if os.getpid() != self._pid or not self._pending:
+            return
+        self._conn.execute('begin immediate')
+        try:
+            self._load_new()
+            rows = []
+            for key, result in self._pending.iteritems():
+                ids = array('I', [self._id(token) for tag, token in result])
+                tag_ids = array('H', [self._tag_id(tag) for tag, token in result])
+                rows.append(key + (buffer(ids.tostring()),
+                    buffer(tag_ids.tostring())))
+            self._conn.executemany('insert or replace into texts values '
+                    '(?, ?, ?, ?, ?, ?)', rows)
+            # stats of all runs are summed
+            stats = [('tokenize_time', self._pending_time),
+                    ('tokenize_count', len(self._pending))]
+            self._conn.executemany('insert or ignore into stats values (?, 0)',
+                    [(name,) for name, value in stats])
+            self._conn.executemany('update stats set value = value + ? where '
+                    'name = ?', [(value, name) for name, value in stats])
+            self._conn.execute('commit')
+        except:
+            self._conn.execute('rollback')
+            raise
+        self._pending = {}
+        self._pending_time = 0.0
+
+    def time_saved(self):
+        '''
+        Estimate time saved by the cache in this run. Hits are expected to
+        take average tokenization time of all texts ever added to the cache.
+        @return: saved time in seconds
+        '''
+        if not self._total_count:
+            return 0.0
+        return (self.hits * self._total_time / self._total_count -
+                self.hit_time)
+
+    def log_stats(self):
+        '''
+        Log hit rate and time saved in this run.
+        '''
+        lookups = self.hits + self.misses
+        self._logger.info('Token cache {0}: {1} hits, {2} misses, hit rate {3:.1f}%, '
+                'time saved {4:.2f}s'.format(self.path, self.hits, self.misses,
+                    100.0 * self.hits / (lookups + 0.0000000000001),
+                    self.time_saved()))
+
+    def close(self):
+        '''
+        Commit changes and close the database.
+        '''
+        if os.getpid() != self._pid:
+            return
+        self.commit()
+        self._conn.close()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import logging
+import numpy as np
+
+class VocabularyPolicy:
+    '''
+    Policy bounding vocabulary of classifiers (tokens of word dictionary or
+    columns of SVM matrices). Entries with document frequency lower than
+    min_df are dropped, when vocabulary grows over max_size entries, entries
+    with the lowest counts are evicted. Optionally counts decay exponentially
+    so that old entries which are not seen anymore are evicted first.
+    Vocabulary may grow by slack * max_size entries before it is pruned, so
+    pruning cost is amortized over many added entries.
+    @param min_df: minimal document frequency of kept entries, applied when
+                   training is finished
+    @param max_size: maximal number of kept entries, None for unlimited
+    @param decay: factor existing counts are multiplied by before every
+                  training batch (e.g. 0.99), None disables decay
+    @param slack: allowed growth over max_size before pruning
+    '''
+
+    def __init__(self, min_df=1, max_size=None, decay=None, slack=0.25):
+        self._logger = logging.getLogger()
+        self.min_df = min_df
+        self.max_size = max_size
+        self.decay = decay
+        self.slack = slack
+        # eviction metrics
+        self.prunes = 0
+        self.evicted = 0
+
+    def needs_pruning(self, size):
+        '''
+        @param size: current size of vocabulary
+        @return: True if vocabulary has outgrown max_size
+        '''
+        return (self.max_size is not None and
+                size > self.max_size * (1 + self.slack))
+
+    def select(self, counts, doc_freqs=None, final=False, prune=True):
+        '''
+        Select entries which are kept in vocabulary. Entries with equal
+        counts are kept in order of their ids, i.e. older entries first.
+        @param counts: numpy array of counts of entries
+        @param doc_freqs: numpy array of document frequencies of entries,
+                          counts are used if not given
+        @param final: apply also min_df, which would evict all new entries
+                      during training
+        @param prune: count the call as a new prune, False for other parts
+                      of vocabulary pruned at once (e.g. other languages)
+        @return: numpy bool array, True for kept entries
+        '''
+        counts = np.asarray(counts)
+        keep = np.ones(len(counts), dtype=bool)
+        if final and self.min_df > 1:
+            if doc_freqs is None:
+                doc_freqs = counts
+            keep &= np.asarray(doc_freqs) >= self.min_df
+        if self.max_size is not None and keep.sum() > self.max_size:
+            candidates = np.flatnonzero(keep)
+            order = np.argsort(-counts[candidates], kind='mergesort')
+            keep[:] = False
+            keep[candidates[order[:self.max_size]]] = True
+        if prune:
+            self.prunes += 1
+        self.evicted += len(counts) - keep.sum()
+        return keep
+
+    def eviction_rate(self, size):
+        '''
+        @param size: current size of vocabulary
+        @return: fraction of entries which were evicted out of all entries
+                 held by vocabulary
+        '''
+        return self.evicted / (self.evicted + size + 0.0000000000001)
+
+    def log_stats(self, size, name='Vocabulary'):
+        '''
+        Log eviction metrics.
+        @param size: current size of vocabulary
+        @param name: name of the vocabulary
+        '''
+        self._logger.info('{0}: {1} entries, {2} evicted in {3} prunes, eviction rate {4:.1f}%'
+                .format(name, size, self.evicted, self.prunes,
+                    100.0 * self.eviction_rate(size)))
@@ -4,26 +4,30 @@ import numpy as np
 import random
 import math
 import logging
-import pp
+import time
 
 from data import Data
 from ..svm_classifier import SVM
+from ...common.backend import PPBackend
+from ...common import metrics
 from kernels import *
 
-def _thread_get_energy(svm, data, state, i, n_fold_cv):
+def _thread_get_energy(svm, dataset, state, i, n_fold_cv, n_splits):
     '''
     This function calculates energy of given state. This is a separate function
     because of parallelisation restrictions in python.
     @param svm: used support vector machine object
-    @param data: tuple containing X1, X2, Y1 and Y2
+    @param dataset: tuple containing X1, X2 and their weights W1 and W2
     @param state: tuple containing gamma and C
     @param i: i-th step of n-fold cross-validation
     @param n_fold_cv: specification of cross validation
+    @param n_splits: number of parts the dataset is split into
     '''
     import numpy as np
+    from src.svm.src.data import split_X1_X2, split_weights
     # get data (only for iteration 0 of 10fcv)
-    X1, Y1, X2, Y2 = data
-    svm.train(X1, Y1)
+    X1, Y1, X2, Y2 = split_X1_X2(dataset[0], dataset[1], n_splits, i)
+    svm.train(X1, Y1, split_weights(dataset[2], dataset[3], n_splits, i))
     if svm.model_exists:
         print 'n-fold c-v: iteration {0} of {1}'.format(i + 1, n_fold_cv)
         Y_predict = svm.predict(X2)
@@ -52,7 +56,8 @@ class Annealing():
     C_MAX = 35000
 
     def __init__(self, kernel=None, init_temp=100, cooling_factor=0.99,
-                 stop_temp=0.001, n_fold_cv=None, max_token_size=1):
+                 stop_temp=0.001, n_fold_cv=None, max_token_size=1,
+                 backend=None):
         '''
         init method
         @param kernel: instance of Kernel object
@@ -61,14 +66,17 @@ class Annealing():
         @param stop_temp: temperature which stops annealing
         @param n_fold_cv: cross validation setup
         @param max_token_size: tokeniation parameter
+        @param backend: execution backend for energy calculation, local
+                parallel python job server is used by default
         '''
         # add and setup logger
         self._logger = logging.getLogger()
         self._logger.setLevel(logging.DEBUG)
 
         # parallelisation
-        self.job_server = pp.Server()
-        self.job_server.set_ncpus()
+        if backend is None:
+            backend = PPBackend()
+        self.backend = backend
 
         random.seed()
         self.cooling_factor = cooling_factor
@@ -90,6 +98,9 @@ class Annealing():
             self.data = Data(dbfile=None, n_fold_cv=n_fold_cv,
                     max_token_size=max_token_size)
         self.data.load_X1_X2()
+        # workers receive whole dataset only once and split it themselves
+        self.dataset = self.backend.share((self.data.X1, self.data.X2,
+            self.data.W1, self.data.W2))
 
         self.temp = float(init_temp)
 
@@ -122,35 +133,38 @@ class Annealing():
                         .format(best_state, best_energy))
         return (best_state, best_energy)
 
-    def _generate_neighbor(self):
+    def _generate_neighbor(self, state=None):
         '''
         Generate neigbor point. Generate direction vector and find random point
         on this vector.
+        @param state: state to generate neighbor of (current state by default)
         @return: tuple representing neighbor -- (param, C)
         '''
+        if state is None:
+            state = self.state
         # generate direction point in a circle around current state
         while True:
-            direction = (random.uniform(self.state[0]-1, self.state[0]+1),
-                         random.uniform(self.state[1]-1, self.state[1]+1))
-            v = (direction[0]-self.state[0], direction[1]-self.state[1])
+            direction = (random.uniform(state[0]-1, state[0]+1),
+                         random.uniform(state[1]-1, state[1]+1))
+            v = (direction[0]-state[0], direction[1]-state[1])
             length = math.sqrt(v[0]**2 + v[1]**2)
             if length < 1:
                 break
         # left
         if v[0] < 0:
-            x_mult = (self.state[0] / v[0]) * -1
+            x_mult = (state[0] / v[0]) * -1
         # right
         else:
-            x_mult = (self.P_MAX - self.state[0]) / v[0]
+            x_mult = (self.P_MAX - state[0]) / v[0]
         # down
         if v[1] < 0:
-            y_mult = (self.state[1] / v[1]) * -1
+            y_mult = (state[1] / v[1]) * -1
         # up
         else:
-            y_mult = (self.C_MAX - self.state[1]) / v[1]
+            y_mult = (self.C_MAX - state[1]) / v[1]
         # get maximal possible multiplier
         mult = random.uniform(0, min(x_mult, y_mult))
-        return (self.state[0] + (mult * v[0]), self.state[1] + (mult * v[1]))
+        return (state[0] + (mult * v[0]), state[1] + (mult * v[1]))
 
     def _get_energy(self, state):
         '''
@@ -159,34 +173,93 @@ class Annealing():
         @param state: tuple containing gamma and C
         @return: tuple of energies, first one has higher priority than second one
         '''
+        with metrics.timer('annealing_energy'):
+            jobs = self._submit_energy(state)
+            avg_energy = sum([job() for job in jobs])
+        metrics.count('annealing_states')
+        self._logger.debug('average energy = {0}'.format(avg_energy))
+        return avg_energy
+
+    def _submit_energy(self, state):
+        '''
+        Submit n-fold cross-validation jobs calculating energy of given state
+        to the job server without waiting for them. Every state gets its own
+        kernel and svm object so several states can be evaluated concurrently.
+        @param state: tuple containing gamma and C
+        @return: list of submitted jobs, sum of their results is the energy
+        '''
         # apply state
-        self.kernel.change_param(state[0])
-        self.svm = SVM(kernel=self.kernel, C=state[1], silent=True)
+        kernel = self.kernel.__class__(param=state[0])
+        self.svm = SVM(kernel=kernel, C=state[1], silent=True)
         self._logger.info('calculating energy for state {0}'.format(state))
         jobs = []
         for i in xrange(self.n_fold_cv):
-            data = self.data.get(i)
-            jobs.append(self.job_server.submit(_thread_get_energy,
-                (self.svm, data, state, i, self.n_fold_cv)))
-        avg_energy = sum([job() for job in jobs])
-        self._logger.debug('average energy = {0}'.format(avg_energy))
-        return avg_energy
+            jobs.append(self.backend.submit(_thread_get_energy,
+                (self.svm, self.dataset, state, i, self.n_fold_cv,
+                    self.data.n_fold_cv)))
+        return jobs
 
-    def _jump_probability(self, neighbor_energy):
+    def _jump_probability(self, neighbor_energy, energy=None, temp=None):
         '''
         Method returns probability of jumping to neighbor state. If neighbor
         state has lower energy, than actual state, jump is done right away,
         If the element has higher energy, there is still slight possibility of
         jump.
         @param neighbor_energy: Energy of neighbor state
+        @param energy: energy of actual state (current energy by default)
+        @param temp: temperature of the chain (current temperature by default)
         @return: probability of jumping to neighbor state
         '''
+        if energy is None:
+            energy = self.energy
+        if temp is None:
+            temp = self.temp
         # priority is to mimimize error rate, then to minimize number of SV
-        difference = neighbor_energy - self.energy
+        difference = neighbor_energy - energy
         if difference <= 0:
             return 1.0
         else:
-            return math.e**(-difference/self.temp + 0.000000000000000001)
+            return math.e**(-difference/temp + 0.000000000000000001)
+
+    def _swap_probability(self, energy_1, temp_1, energy_2, temp_2):
+        '''
+        Method returns probability of exchanging states of two chains running
+        on different temperatures (parallel tempering). Swap is always accepted
+        when it moves lower energy state to the colder chain.
+        @param energy_1: energy of the first chain
+        @param temp_1: temperature of the first chain
+        @param energy_2: energy of the second chain
+        @param temp_2: temperature of the second chain
+        @return: probability of swapping states of both chains
+        '''
+        exponent = (energy_1 - energy_2) * (1.0 / temp_1 - 1.0 / temp_2)
+        if exponent >= 0:
+            return 1.0
+        else:
+            return math.e**exponent
+
+    def _update_best(self, state, energy):
+        '''
+        Remember given state if it is better than the best state found so far.
+        @param state: accepted state
+        @param energy: energy of accepted state
+        '''
+        if energy < self.best_energy:
+            self.best_state = state
+            self.best_energy = energy
+            self._logger.info('best_state={0}, best_energy={1}'
+                    .format(state, energy))
+        # if energies are the same, try to find states with minimal C and gamma
+        if energy == self.best_energy:
+            best_energy = (self.best_state[0]-self.P_MIN)/(self.P_MAX-self.P_MIN) + \
+                          (self.best_state[1]-self.C_MIN)/(self.C_MAX-self.C_MIN)
+            new_energy = (state[0]-self.P_MIN)/(self.P_MAX-self.P_MIN) + \
+                         (state[1]-self.C_MIN)/(self.C_MAX-self.C_MIN)
+            if new_energy < best_energy:
+                self.best_state = state
+                self.best_energy = energy
+                self._logger.info('best_state={0}, best_energy={1}'
+                        .format(state, energy))
 
     def _get_temperature(self):
         '''
@@ -204,6 +277,7 @@ class Annealing():
         while self.temp > self.stop_temp:
             iteration += 1
             self.temp = self._get_temperature()
+            metrics.gauge('annealing_temperature', self.temp)
             self._logger.info('==current temperature is {0}, iteration:{1}=='
                     .format(self.temp, iteration))
             self._logger.info('best state: {}, best_energy: {}'
@@ -220,23 +294,89 @@ class Annealing():
             prob = self._jump_probability(neighbor_energy)
             r = random.random()
             self._logger.debug('if {0} > {1} then use new'.format(prob, r))
+            metrics.count('annealing_steps')
             if prob > r:
+                metrics.count('annealing_accepted')
                 self.state = neighbor
                 self.energy = neighbor_energy
-                if self.energy < self.best_energy:
-                    self.best_state = self.state
-                    self.best_energy = self.energy
-                    self._logger.info('best_state={0}, best_energy={1}'
-                            .format(self.state, self.energy))
-                # if energies are the same, try to find states with minimal C and gamma
-                if self.energy == self.best_energy:
-                    best_energy = (self.best_state[0]-self.P_MIN)/(self.P_MAX-self.P_MIN) + \
-                                  (self.best_state[1]-self.C_MIN)/(self.C_MAX-self.C_MIN)
-                    new_energy = (self.state[0]-self.P_MIN)/(self.P_MAX-self.P_MIN) + \
-                                 (self.state[1]-self.C_MIN)/(self.C_MAX-self.C_MIN)
-                    if new_energy < best_energy:
-                        self.best_state = self.state
-                        self.best_energy = self.energy
-                        self._logger.info('best_state={0}, best_energy={1}'
-                                .format(self.state, self.energy))
+                self._update_best(self.state, self.energy)
+        return self.best_state, self.best_energy
+
+    def run_tempering(self, n_chains=4, temp_ratio=2.0, swap_interval=1):
+        '''
+        Run parallel tempering -- several annealing chains with different
+        temperatures. Neighbors of all chains are evaluated concurrently on the
+        job server and neighboring chains periodically try to swap their
+        states. Coldest chain follows the same cooling schedule as run() and
+        every other chain is temp_ratio times hotter than the previous one.
+        @param n_chains: number of concurrently running chains
+        @param temp_ratio: temperature ratio of two neighboring chains
+        @param swap_interval: number of iterations between swap attempts
+        @return: best state and energy tupple
+        '''
+        states = [self.state] * n_chains
+        energies = [self.energy] * n_chains
+        ratios = [float(temp_ratio) ** k for k in xrange(n_chains)]
+        evaluated = 0
+        start = time.time()
+
+        iteration = -1
+        while self.temp > self.stop_temp:
+            iteration += 1
+            self.temp = self._get_temperature()
+            metrics.gauge('annealing_temperature', self.temp)
+            temps = [self.temp * ratio for ratio in ratios]
+            self._logger.info('==current temperatures are {0}, iteration:{1}=='
+                    .format(temps, iteration))
+            self._logger.info('best state: {}, best_energy: {}'
+                    .format(self.best_state, self.best_energy))
+
+            # submit neighbors of all chains at once
+            neighbors = {}
+            for k in xrange(n_chains):
+                neighbor = self._generate_neighbor(states[k])
+                if neighbor == states[k]:
+                    self._logger.info('chain {0}: neighbor is same as previous '
+                            'state, skipping...'.format(k))
+                    continue
+                neighbors[k] = (neighbor, self._submit_energy(neighbor))
+
+            # metropolis step of every chain
+            for k in sorted(neighbors):
+                neighbor, jobs = neighbors[k]
+                with metrics.timer('annealing_energy'):
+                    neighbor_energy = sum([job() for job in jobs])
+                evaluated += 1
+                metrics.count('annealing_states')
+                metrics.count('annealing_steps')
+                self._logger.info('chain {0}: neighbor {1}, energy {2}'
+                        .format(k, neighbor, neighbor_energy))
+                prob = self._jump_probability(neighbor_energy, energies[k],
+                        temps[k])
+                if prob > random.random():
+                    metrics.count('annealing_accepted')
+                    states[k] = neighbor
+                    energies[k] = neighbor_energy
+                    self._update_best(states[k], energies[k])
+
+            # try to swap neighboring chains, alternate even and odd pairs
+            if (iteration + 1) % swap_interval == 0:
+                for k in xrange((iteration / swap_interval) % 2,
+                        n_chains - 1, 2):
+                    prob = self._swap_probability(energies[k], temps[k],
+                            energies[k + 1], temps[k + 1])
+                    if prob > random.random():
+                        metrics.count('annealing_swaps')
+                        self._logger.debug('swapping chains {0} and {1}'
+                                .format(k, k + 1))
+                        states[k], states[k + 1] = states[k + 1], states[k]
+                        energies[k], energies[k + 1] = \
+                                energies[k + 1], energies[k]
+
+            elapsed = time.time() - start
+            self._logger.info('{0} states evaluated, {1:.3f} states/s'.format(
+                evaluated, evaluated / (elapsed + 0.0000000000001)))
+
+        self.state = states[0]
+        self.energy = energies[0]
         return self.best_state, self.best_energy
@@ -1,20 +1,187 @@
 #!/usr/bin/env python
 
 import logging
+import os
 import numpy as np
 import sqlite3
-from ...common.entry import Entry
+from ...common import feature, metrics
+from ...common.corpus import tokenize_corpus
+from ...common.pipeline import read_annotated, run_pipeline
+
+def split_X1_X2(X1, X2, n_fold_cv, i=None):
+    '''
+    Splits X1 and X2 (vectors in feature space)to training and testing set,
+    generates Y1 and Y2 vectors (labels).
+    If i is not specified, all currently loaded data are returned
+    @param X1: relevant vectors
+    @param X2: irelevant vectors
+    @param n_fold_cv: cross-validation specification
+    @param i: iteration in n-fold cross-validation
+    @return: matrices X1, Y1 and if i is specified then also X2, Y2
+    '''
+    # number of X1 and X2 vectors
+    count_1 = X1.shape[0]
+    count_2 = X2.shape[0]
+
+    # generate Y1 and Y2
+    Y1 = np.ones(count_1)
+    Y2 = -np.ones(count_2)
+
+    if i is None:
+        # create training set
+        X_train = np.vstack((X1, X2))
+        Y_train = np.hstack((Y1, Y2))
+
+        return (X_train, Y_train)
+    else:
+        # create test set
+        X_test = X1[i*(count_1/n_fold_cv):(i+1)*(count_1/n_fold_cv)]
+        X_test = np.vstack((X_test, X2[i*(count_2/n_fold_cv):(i+1)*(
+            count_1/n_fold_cv)]))
+        Y_test = Y1[i*(count_1/n_fold_cv):(i+1)*(count_1/n_fold_cv)]
+        Y_test = np.hstack((Y_test, Y2[i*(count_2/n_fold_cv):(i+1)*(
+            count_1/n_fold_cv)]))
+        # create training set
+        X_train = X1[:i*(count_1/n_fold_cv)]
+        X_train = np.vstack((X_train, X2[:i*(count_2/n_fold_cv)]))
+        X_train = np.vstack((X_train, X1[(i+1)*(count_1/n_fold_cv):]))
+        X_train = np.vstack((X_train, X2[(i+1)*(count_2/n_fold_cv):]))
+        Y_train = Y1[:i*(count_1/n_fold_cv)]
+        Y_train = np.hstack((Y_train, Y2[:i*(count_2/n_fold_cv)]))
+        Y_train = np.hstack((Y_train, Y1[(i+1)*(count_1/n_fold_cv):]))
+        Y_train = np.hstack((Y_train, Y2[(i+1)*(count_2/n_fold_cv):]))
+
+        return (X_train, Y_train, X_test, Y_test)
+
+def split_weights(W1, W2, n_fold_cv, i=None):
+    '''
+    Splits weights of X1 and X2 vectors the same way as split_X1_X2().
+    @param W1: weights of relevant vectors
+    @param W2: weights of irelevant vectors
+    @param n_fold_cv: cross-validation specification
+    @param i: iteration in n-fold cross-validation
+    @return: weights of training vectors
+    '''
+    return split_X1_X2(W1[:, np.newaxis], W2[:, np.newaxis], n_fold_cv,
+            i)[0].ravel()
+
+class _MatrixBuilder:
+    '''
+    Consumer of data pipeline (see run_pipeline()). Counter stage converts
+    tokens of every chunk to strings, trainer stage maps them to columns and
+    stores compact coordinates of ones of X1 and X2 matrices, matrices are
+    built at the end. Columns are pruned by vocabulary policy whenever they
+    outgrow it, evicted columns are removed from stored coordinates.
+    @param vocabulary: VocabularyPolicy bounding number of columns
+    '''
+
+    def __init__(self, vocabulary=None):
+        self.vocabulary = vocabulary
+        # token strings in order of their first occurrence
+        self.strings = []
+        self.columns = {}
+        # occurrences and document frequencies of columns
+        self.occurrences = np.zeros(0, dtype=np.int64)
+        self.doc_freqs = np.zeros(0, dtype=np.int64)
+        # {label: [(row indexes, columns)]}
+        self.coordinates = {1:[], -1:[]}
+        self.counts = {1:0, -1:0}
+
+    def count(self, corpus, meta):
+        strings = [getattr(feature, cls)(data).get_data_str()
+                for cls, data in corpus.tokens]
+        labels = np.array([1 if label == 1 else -1 for lang, label in meta])
+        return (labels, corpus.rows(), corpus.ids, strings)
+
+    def _map(self, strings):
+        '''
+        Map strings of chunk to columns, new strings get new columns.
+        @return: numpy array of columns indexed by local ids
+        '''
+        mapping = np.empty(len(strings), dtype=np.int64)
+        for i, string in enumerate(strings):
+            column = self.columns.get(string)
+            if column is None:
+                column = self.columns[string] = len(self.strings)
+                self.strings.append(string)
+            mapping[i] = column
+        return mapping
+
+    def _prune(self, final=False):
+        '''
+        Evict columns selected by vocabulary policy, remaining columns are
+        renumbered in their original order.
+        '''
+        keep = self.vocabulary.select(self.occurrences, self.doc_freqs, final)
+        if keep.all():
+            return
+        remap = np.cumsum(keep) - 1
+        self.strings = [s for s, k in zip(self.strings, keep) if k]
+        self.columns = dict([(s, i) for i, s in enumerate(self.strings)])
+        self.occurrences = self.occurrences[keep]
+        self.doc_freqs = self.doc_freqs[keep]
+        for label in (1, -1):
+            self.coordinates[label] = [(rows[keep[columns]],
+                remap[columns[keep[columns]]].astype(np.int32))
+                for rows, columns in self.coordinates[label]]
+
+    def train(self, update):
+        labels, rows, ids, strings = update
+        columns = self._map(strings)[ids]
+        size = len(self.strings)
+        self.occurrences = np.append(self.occurrences, np.zeros(size -
+            len(self.occurrences), dtype=np.int64))
+        self.doc_freqs = np.append(self.doc_freqs, np.zeros(size -
+            len(self.doc_freqs), dtype=np.int64))
+        self.occurrences += np.bincount(columns, minlength=size)
+        # every column is counted once in a row
+        unique = np.unique(rows * size + columns)
+        self.doc_freqs += np.bincount(unique % size, minlength=size)
+        for label in (1, -1):
+            selected = np.flatnonzero(labels == label)
+            # index of row among rows of the same label
+            index = np.empty(len(labels), dtype=np.int64)
+            index[selected] = np.arange(len(selected)) + self.counts[label]
+            mask = labels[rows] == label
+            self.coordinates[label].append((index[rows[mask]].astype(np.int32),
+                columns[mask].astype(np.int32)))
+            self.counts[label] += len(selected)
+        if self.vocabulary is not None and \
+                self.vocabulary.needs_pruning(len(self.strings)):
+            self._prune()
+
+    def finish(self):
+        if self.vocabulary is not None:
+            self._prune(final=True)
+            self.vocabulary.log_stats(len(self.strings), 'Token list')
+        # same token order as in Data._generate_X1_X2()
+        token_list = list(set(self.strings))
+        index = dict([(token, i) for i, token in enumerate(token_list)])
+        order = np.array([index[token] for token in self.strings],
+                dtype=np.int64)
+        matrices = []
+        for label in (1, -1):
+            X = np.zeros((self.counts[label], len(token_list)))
+            for rows, columns in self.coordinates[label]:
+                X[rows, order[columns]] = 1
+            matrices.append(X)
+        return (token_list, matrices[0], matrices[1])
 
 class Data():
     '''
     class used for data extraction and preparation
     '''
-    def __init__(self, dbfile=None, n_fold_cv=10, max_token_size=1):
+    def __init__(self, dbfile=None, n_fold_cv=10, max_token_size=1,
+            workers=None, vocabulary=None, dedup=None):
         '''
         init method
         @param dbfile: source db file containing table docs
         @param n_fold_cv: cross-validation specification
         @param max_token_size: set tokenization parameter
+        @param workers: number of tokenization processes
+        @param vocabulary: VocabularyPolicy bounding token list
+        @param dedup: NearDuplicateFilter collapsing near-duplicate entries,
+                      representatives are weighted by size of their clusters
         '''
         # add and setup logger
         self._logger = logging.getLogger()
@@ -23,6 +190,9 @@ class Data():
         self.dbfile = dbfile
         self.n_fold_cv = n_fold_cv
         self.max_token_size=max_token_size
+        self.workers = workers
+        self.vocabulary = vocabulary
+        self.dedup = dedup
         # load data
         if not dbfile:
             self.load_X1_X2()
@@ -32,7 +202,7 @@ class Data():
         '''
         Method gets entries from database and
         @param count: count of relevant and irelevant entries (2*count)
-        @return: list of entry objects
+        @return: list of (lang, text, label) tuples
         '''
         # connect to database
         try:
@@ -54,114 +224,137 @@ class Data():
         irelevant = all_irelevant[:count]
 
         # join all entries together and set 1 and -1 to relevant and irelevant
-        self._logger.info('Generating entries...')
-        entries = []
-        for data in relevant:
-            entries.append(Entry(entry=data[1], language=data[0], label=1, max_token_size=self.max_token_size))
-        for data in irelevant:
-            entries.append(Entry(entry=data[1], language=data[0], label=-1, max_token_size=self.max_token_size))
-        return entries
+        rows = [(data[0], data[1], 1) for data in relevant]
+        rows.extend([(data[0], data[1], -1) for data in irelevant])
+        return rows
 
-    def _generate_X1_X2(self, entries):
+    def _generate_X1_X2(self, rows):
         '''
         Method generates X1 (vectors in feature space labeled 1) and X2 (vectors
         in feature space labeled -1) matrices svm classifier.
-        @param entries: list of input entries
+        @param rows: list of (lang, text, label) tuples
         @return matrices X1 and X2
         '''
-        self.token_list = [] # all encountered tokens
-        relevant_mapping = [] # mapping of articles into tokens
-        irelevant_mapping = []
+        # tokenize all rows with all features
+        self._logger.info('Generating entries...')
+        corpus = tokenize_corpus([row[:2] for row in rows], None,
+                self.max_token_size, self.workers)
+        labels = np.array([row[2] for row in rows])
+        weights = np.ones(len(rows))
+        if self.dedup is not None:
+            with metrics.timer('dedup'):
+                weights = self.dedup.find(corpus, [(row[0], row[2])
+                    for row in rows], [row[1] for row in rows]).row_weights()
 
         # generate all possible token list
         self._logger.info('Generating all possible token list...')
-        for entry in entries:
-            for token in entry.get_token_all():
-                self.token_list.append(token.get_data_str())
-        self.token_list = list(set(self.token_list))
+        with metrics.timer('token_list'):
+            strings = [getattr(feature, cls)(data).get_data_str()
+                    for cls, data in corpus.tokens]
+            self.token_list = list(set(strings)) # all encountered tokens
 
-        # create mapping
+        # create mapping of token ids into columns
         self._logger.info('Generating token mapping...')
-        for entry in entries:
-            to_tokens_mapping = []
-            for token in entry.get_token_all():
-                to_tokens_mapping.append(self.token_list.index(token.get_data_str()))
-            if entry.label==1:
-                relevant_mapping.append((to_tokens_mapping, entry.label))
-            else:
-                irelevant_mapping.append((to_tokens_mapping, entry.label))
+        with metrics.timer('token_mapping'):
+            index = dict([(token, i) for i, token in enumerate(self.token_list)])
+            columns = np.array([index[token] for token in strings],
+                    dtype=np.int64)
+        rows_of_tokens = corpus.rows()
+        token_columns = columns[corpus.ids]
+        if self.dedup is not None:
+            # only representatives of near-duplicates are kept
+            kept = weights > 0
+            mask = kept[rows_of_tokens]
+            rows_of_tokens = (np.cumsum(kept) - 1)[rows_of_tokens[mask]]
+            token_columns = token_columns[mask]
+            labels = labels[kept]
+            weights = weights[kept]
+            used = np.zeros(len(self.token_list), dtype=bool)
+            used[token_columns] = True
+            self.token_list = [t for t, u in zip(self.token_list, used) if u]
+            token_columns = (np.cumsum(used) - 1)[token_columns]
+        if self.vocabulary is not None:
+            rows_of_tokens, token_columns = self._prune_token_list(
+                    rows_of_tokens, token_columns)
 
         # generate X1 and X2 matrices (entry_count, token_count)
         self._logger.info('Generating X matrices...')
-        relevant_mapping_count = len(relevant_mapping)
-        irelevant_mapping_count = len(irelevant_mapping)
-        dimensions = len(self.token_list)
-        X1 = np.zeros((relevant_mapping_count, dimensions))
-        X2 = np.zeros((irelevant_mapping_count, dimensions))
-        self._logger.info('Generating X1 matrix...')
-        for i,x1 in enumerate(X1):
-            for index in relevant_mapping[i][0]:
-                x1[index] = 1
-        self._logger.info('Generating X2 matrix...')
-        for i,x2 in enumerate(X2):
-            for index in irelevant_mapping[i][0]:
-                x2[index] = 1
-        return (X1, X2)
+        with metrics.timer('matrices'):
+            X = np.zeros((len(labels), len(self.token_list)))
+            X[rows_of_tokens, token_columns] = 1
+        metrics.gauge('matrix_bytes', X.nbytes)
+        metrics.gauge('token_list_size', len(self.token_list))
+        self.W1 = weights[labels == 1]
+        self.W2 = weights[labels != 1]
+        return (X[labels == 1], X[labels != 1])
+
+    def _prune_token_list(self, rows, columns):
+        '''
+        Remove tokens evicted by vocabulary policy from token list.
+        @param rows: numpy array of row of every token occurrence
+        @param columns: numpy array of column of every token occurrence
+        @return: tuple (rows, columns) of occurrences of kept tokens, columns
+                 are renumbered
+        '''
+        size = len(self.token_list)
+        occurrences = np.bincount(columns, minlength=size)
+        doc_freqs = np.bincount(np.unique(rows * size + columns) % max(size, 1),
+                minlength=size)
+        keep = self.vocabulary.select(occurrences, doc_freqs, final=True)
+        self.token_list = [t for t, k in zip(self.token_list, keep) if k]
+        self.vocabulary.log_stats(len(self.token_list), 'Token list')
+        mask = keep[columns]
+        return (rows[mask], (np.cumsum(keep) - 1)[columns[mask]])
 
     def _split_X1_X2(self, X1, X2, i=None):
         '''
         Splits X1 and X2 (vectors in feature space)to training and testing set,
-        generates Y1 and Y2 vectors (labels).
-        If i is not specified, all currently loaded data are returned
+        generates Y1 and Y2 vectors (labels). See split_X1_X2().
         @param X1: relevant vectors
         @param X2: irelevant vectors
         @param i: iteration in n-fold cross-validation
         @return: matrices X1, Y1 and if i is specified then also X2, Y2
         '''
-        # number of X1 and X2 vectors
-        count_1 = X1.shape[0]
-        count_2 = X2.shape[0]
-
-        # generate Y1 and Y2
-        Y1 = np.ones(count_1)
-        Y2 = -np.ones(count_2)
+        return split_X1_X2(X1, X2, self.n_fold_cv, i)
 
-        if i is None:
-            # create training set
-            X_train = np.vstack((X1, X2))
-            Y_train = np.hstack((Y1, Y2))
+    def _stream_X1_X2(self, count):
+        '''
+        Method generates X1 and X2 matrices by pipeline reading entries lazily
+        from database, see _generate_X1_X2().
+        @param count: count of relevant and irelevant entries (2*count)
+        @return matrices X1 and X2
+        '''
+        self._logger.info('Streaming entries...')
+        self.token_list, X1, X2 = run_pipeline(read_annotated(self.dbfile,
+            count), _MatrixBuilder(self.vocabulary), None, self.max_token_size,
+            self.workers)
+        metrics.gauge('matrix_bytes', X1.nbytes + X2.nbytes)
+        metrics.gauge('token_list_size', len(self.token_list))
+        self.W1 = np.ones(len(X1))
+        self.W2 = np.ones(len(X2))
+        return (X1, X2)
 
-            return (X_train, Y_train)
-        else:
-            # create test set
-            X_test = X1[i*(count_1/self.n_fold_cv):(i+1)*(count_1/self.n_fold_cv)]
-            X_test = np.vstack((X_test, X2[i*(count_2/self.n_fold_cv):(i+1)*(
-                count_1/self.n_fold_cv)]))
-            Y_test = Y1[i*(count_1/self.n_fold_cv):(i+1)*(count_1/self.n_fold_cv)]
-            Y_test = np.hstack((Y_test, Y2[i*(count_2/self.n_fold_cv):(i+1)*(
-                count_1/self.n_fold_cv)]))
-            # create training set
-            X_train = X1[:i*(count_1/self.n_fold_cv)]
-            X_train = np.vstack((X_train, X2[:i*(count_2/self.n_fold_cv)]))
-            X_train = np.vstack((X_train, X1[(i+1)*(count_1/self.n_fold_cv):]))
-            X_train = np.vstack((X_train, X2[(i+1)*(count_2/self.n_fold_cv):]))
-            Y_train = Y1[:i*(count_1/self.n_fold_cv)]
-            Y_train = np.hstack((Y_train, Y2[:i*(count_2/self.n_fold_cv)]))
-            Y_train = np.hstack((Y_train, Y1[(i+1)*(count_1/self.n_fold_cv):]))
-            Y_train = np.hstack((Y_train, Y2[(i+1)*(count_2/self.n_fold_cv):]))
-
-            return (X_train, Y_train, X_test, Y_test)
-
-    def regenerate_X1_X2(self, count):
+    def regenerate_X1_X2(self, count, stream=False):
         '''
         Method regenerates X1 and X2 values from database file.
         @param count: specifies number of slected entries
+        @param stream: generate matrices by pipeline reading entries lazily
         '''
-        self.X1, self.X2 = self._generate_X1_X2(self._get_data_from_db(count=count))
+        if stream and self.dedup is not None:
+            self._logger.error('Near-duplicates can not be collapsed in streaming mode!')
+            return
+        with metrics.timer('data_matrix'):
+            if stream:
+                self.X1, self.X2 = self._stream_X1_X2(count)
+            else:
+                self.X1, self.X2 = self._generate_X1_X2(
+                        self._get_data_from_db(count=count))
         X1_output = open('models/svm/X1_X2/X1.npy', 'wb')
         X2_output = open('models/svm/X1_X2/X2.npy', 'wb')
         np.save(X1_output, self.X1)
         np.save(X2_output, self.X2)
+        np.save(open('models/svm/X1_X2/W1.npy', 'wb'), self.W1)
+        np.save(open('models/svm/X1_X2/W2.npy', 'wb'), self.W2)
 
     def load_X1_X2(self):
         '''
@@ -169,6 +362,13 @@ class Data():
         '''
         self.X1 = np.load('models/svm/X1_X2/X1.npy')
         self.X2 = np.load('models/svm/X1_X2/X2.npy')
+        # data generated without weights
+        if os.path.exists('models/svm/X1_X2/W1.npy'):
+            self.W1 = np.load('models/svm/X1_X2/W1.npy')
+            self.W2 = np.load('models/svm/X1_X2/W2.npy')
+        else:
+            self.W1 = np.ones(len(self.X1))
+            self.W2 = np.ones(len(self.X2))
 
     def get(self, i=None):
         '''
@@ -182,6 +382,14 @@ class Data():
         else:
             return self._split_X1_X2(self.X1, self.X2, i)
 
+    def get_weights(self, i=None):
+        '''
+        Get weights of training vectors returned by get().
+        @param i: iteration in n-fold cross-validation
+        @return: numpy array of weights
+        '''
+        return split_weights(self.W1, self.W2, self.n_fold_cv, i)
+
     def get_token_list(self):
         '''
         Get token mapping list
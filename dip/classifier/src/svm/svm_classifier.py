@@ -2,11 +2,10 @@
 
 import logging
 import numpy as np
-import cvxopt
-import cvxopt.solvers
 import pickle
 
 from src.kernels import *
+from ..common import metrics
 
 class SVM():
     '''
@@ -28,10 +27,9 @@ class SVM():
         else:
             self.C = None
 
-        # qp config
-        if silent:
-            cvxopt.solvers.options['show_progress'] = False
-        cvxopt.solvers.options['maxiters'] = qp_maxiter
+        # qp config, cvxopt is imported only for training
+        self.silent = silent
+        self.qp_maxiter = qp_maxiter
 
         # learned svm params
         self.lm = None
@@ -40,19 +38,43 @@ class SVM():
         self.b = None
         self.w = None
 
-    def train(self, X, Y):
+    def gram_matrix(self, X):
+        '''
+        Create gram matrix (kernel matrix) of training set
+        @param X: training set
+        @return: numpy array (n_samples, n_samples) of kernel values
+        '''
+        n_samples = X.shape[0]
+        gram = np.zeros((n_samples, n_samples))
+        for i in xrange(n_samples):
+            for j in xrange(n_samples):
+                gram[i,j] = self.kernel(X[i], X[j])
+        return gram
+
+    def train(self, X, Y, weights=None):
         '''
         Method for training svm classifier
         @param X: training set
         @param Y: testing set
+        @param weights: weights of training vectors, upper bound of lagrange
+                        multiplier of vector is C * weight (vector of weight
+                        w acts as w identical vectors), ones if None
         '''
+        with metrics.timer('svm_train'):
+            self._train(X, Y, weights)
+
+    def _train(self, X, Y, weights=None):
+        import cvxopt
+        import cvxopt.solvers
+        if self.silent:
+            cvxopt.solvers.options['show_progress'] = False
+        cvxopt.solvers.options['maxiters'] = self.qp_maxiter
         n_samples, n_features = X.shape
 
         # create gram matrix (kernel matrix)
-        gram = np.zeros((n_samples, n_samples))
-        for i in xrange(n_samples):
-            for j in xrange(n_samples):
-                gram[i,j] = self.kernel(X[i], X[j])
+        with metrics.timer('gram'):
+            gram = self.gram_matrix(X)
+        metrics.gauge('gram_bytes', gram.nbytes)
 
         # quadratic members coefficient vector
         P = cvxopt.matrix(np.outer(Y, Y) * gram)
@@ -70,14 +92,18 @@ class SVM():
             tmp2 = np.identity(n_samples)
             G = cvxopt.matrix(np.vstack((tmp1, tmp2)))
             tmp1 = np.zeros(n_samples)
-            tmp2 = np.ones(n_samples) * self.C
+            if weights is None:
+                weights = np.ones(n_samples)
+            tmp2 = np.asarray(weights, dtype=np.float64) * self.C
             h = cvxopt.matrix(np.hstack((tmp1, tmp2)))
         else:
             G = cvxopt.matrix(np.diag(np.ones(n_samples) * -1))
             h = cvxopt.matrix(np.zeros(n_samples))
 
         # solve QP problem
-        solution = cvxopt.solvers.qp(P, q, G, h, A, b)
+        with metrics.timer('qp'):
+            solution = cvxopt.solvers.qp(P, q, G, h, A, b)
+        metrics.count('qp_iterations', solution['iterations'])
 
         # get lagrange multipliers
         all_lm = np.ravel(solution['x'])
@@ -89,6 +115,7 @@ class SVM():
         # store nonzero lagrange multipliers
         self.lm = all_lm[nonzero_mask]
         self.lm_count = len(self.lm)
+        metrics.count('support_vectors', self.lm_count)
         if self.lm_count == 0:
             print '0 support vectors found - no solution!!!'
             self.model_exists = False
@@ -120,16 +147,18 @@ class SVM():
         @return: numpy array containing 1 and -1 for relevant and irelevante
                 entries
         '''
-        if self.w is not None:
-            return np.sign(np.dot(X, self.w) + self.b)
-        else:
-            predict = np.zeros(len(X))
-            for i in xrange(len(X)):
-                s = 0
-                for lm, x, y in zip(self.lm, self.X, self.Y):
-                    s += lm * y * self.kernel(X[i], x)
-                predict[i] = s
-            return np.sign(predict + self.b)
+        metrics.count('svm_predictions', len(X))
+        with metrics.timer('svm_predict'):
+            if self.w is not None:
+                return np.sign(np.dot(X, self.w) + self.b)
+            else:
+                predict = np.zeros(len(X))
+                for i in xrange(len(X)):
+                    s = 0
+                    for lm, x, y in zip(self.lm, self.X, self.Y):
+                        s += lm * y * self.kernel(X[i], x)
+                    predict[i] = s
+                return np.sign(predict + self.b)
 
     def store_model(self, path, token_list):
         '''
@@ -24,32 +24,45 @@ class SVMTest():
         else:
             logging.basicConfig(level=logging.DEBUG)
 
-    def run_annealing(self, n_fold_cv=5, max_token_size=1, kernel='RBF'):
+    def run_annealing(self, n_fold_cv=5, max_token_size=1, kernel='RBF',
+            chains=1, backend=None):
         '''
         Method for running annealing process to find out the best SVM and kernel
         configuration parameters
         @param n_fold_cv: n fold-cross validation parameter
         @param max_token_size: sets maximal size of word tokens
         @param kernel: used kernel - possibilities in src/kernels.py
+        @param chains: number of parallel tempering chains, 1 runs classical
+                simulated annealing
+        @param backend: execution backend used for energy calculation
         @return: tupple of best C and gamma parameters
         '''
         k = str2kernel[kernel]()
         a = Annealing(kernel=k, n_fold_cv=n_fold_cv,
-                max_token_size=max_token_size)
-        result = a.run()
+                max_token_size=max_token_size, backend=backend)
+        if chains > 1:
+            result = a.run_tempering(n_chains=chains)
+        else:
+            result = a.run()
         print result
         return result
 
-    def regenerate_data(self, dbfile, count=1000, max_token_size=1):
+    def regenerate_data(self, dbfile, count=1000, max_token_size=1,
+            workers=None, stream=False, vocabulary=None, dedup=None):
         '''
         Regenerate database files according to input parameters
         @param dbfile: database file containing anotated data
         @param count: used number of entries
         @param max_token_size: sets maximal size of word tokens
+        @param workers: number of tokenization processes
+        @param stream: generate data by pipeline reading entries lazily
+        @param vocabulary: VocabularyPolicy bounding token list
+        @param dedup: NearDuplicateFilter collapsing near-duplicate entries
         @return: data transformed into SVM usable format
         '''
-        data = Data(dbfile=dbfile, max_token_size=max_token_size)
-        data.regenerate_X1_X2(count)
+        data = Data(dbfile=dbfile, max_token_size=max_token_size,
+                workers=workers, vocabulary=vocabulary, dedup=dedup)
+        data.regenerate_X1_X2(count, stream)
         return data
 
     def _calculate_results(self, clas_res):
@@ -103,7 +116,7 @@ class SVMTest():
         for i in xrange(n_fold_cv):
             X1, Y1, X2, Y2 = data.get(i)
             self._logger.info('Training SVM... (i={0})'.format(str(i)))
-            self.svm.train(X1, Y1)
+            self.svm.train(X1, Y1, data.get_weights(i))
             if self.svm.model_exists:
                 # predict
                 Y_predict = self.svm.predict(X2)